@@ -0,0 +1,202 @@
+"""
+Масштабирование по размеру сценариев: время парсинга XML, загрузки проекта
+(upload_scenarios_to_repo + download_scenarios_to_ep) и задержка хода пользователя
+на синтетических сценариях из benchmarks.scenario_generator
+
+Два прогона:
+    nodes      один сценарий из 10 ... 10 000 нод
+    scenarios  проект из 1 ... 500 сценариев по --scenario-nodes нод
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_scaling [--nodes 10 100 1000 10000]
+        [--scenarios 1 10 100 500] [--scenario-nodes 50] [--backend memory]
+        [--turns 500] [--users 10] [--plot scaling.png]
+
+--plot рисует графики, если установлен matplotlib
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+import typing as tp
+
+from benchmarks.harness import BACKENDS
+from benchmarks.harness import Conversation
+from benchmarks.harness import Script
+from benchmarks.harness import make_pipeline
+from benchmarks.harness import run_conversations
+from benchmarks.scenario_generator import VALID_ANSWER
+from benchmarks.scenario_generator import ScenarioShape
+from benchmarks.scenario_generator import start_phrase
+from benchmarks.scenario_generator import write_project
+from src.domain.model import InEvent
+from src.domain.model import NodeType
+from src.domain.model import User
+from src.domain.scenario_loader import XMLParser
+from src.settings import logger
+
+PROJECT = "gen"
+
+
+class GeneratedConversation(Conversation):
+    """
+    Диалог по сгенерированному сценарию: жмет кнопки, на вопросы отвечает числом,
+    каждый третий ответ неверный, чтобы ходить через логический блок и цикл
+    """
+
+    def __init__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.answers = 0
+
+    def _waits_for_text(self, user: User) -> bool:
+        if user.current_scenario_name is None or user.current_node_id is None:
+            return False
+        scenario = self.pipeline.wrapped_ep.scenarios[
+            (self.project, user.current_scenario_name)
+        ]
+        return scenario.nodes[user.current_node_id].node_type == NodeType.inMessage
+
+    async def _next_event(self, user: User) -> InEvent:
+        event = InEvent(user=user, project_name=self.project)
+        if user.current_scenario_name is None:
+            event.text = self.script.start_text
+        elif self._waits_for_text(user):
+            self.answers += 1
+            event.text = "нет" if self.answers % 3 == 0 else VALID_ANSWER
+        else:
+            event.button_pushed_next = self.buttons[self.pushes % len(self.buttons)]
+            self.pushes += 1
+        return event
+
+
+async def measure_project(
+    scenarios_path: str,
+    names: tp.List[str],
+    backend: str,
+    turns: int,
+    users: int,
+) -> tp.Dict[str, tp.Any]:
+    parser = XMLParser()
+    start = time.perf_counter()
+    for name in names:
+        parser.parse(input_stuff=f"{scenarios_path}/{PROJECT}/{name}/scenario.xml")
+    parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline = await make_pipeline(backend, scenarios_path=scenarios_path)
+    load_time = time.perf_counter() - start
+
+    conversations = [
+        GeneratedConversation(
+            pipeline,
+            "ep",
+            Script(start_text=start_phrase(names[i % len(names)])),
+            f"scaling_{i}",
+            project=PROJECT,
+        )
+        for i in range(users)
+    ]
+    result = await run_conversations(conversations, turns, memory_turns=0)
+    return {
+        "parse_ms": parse_time * 1000,
+        "load_ms": load_time * 1000,
+        "p50_ms": result["p50_ms"],
+        "p99_ms": result["p99_ms"],
+    }
+
+
+async def sweep(
+    sizes: tp.List[int],
+    make_shape: tp.Callable[[int], tp.Tuple[int, ScenarioShape]],
+    args: argparse.Namespace,
+) -> tp.List[tp.Dict[str, tp.Any]]:
+    results = []
+    for size in sizes:
+        scenarios, shape = make_shape(size)
+        with tempfile.TemporaryDirectory() as scenarios_path:
+            names = write_project(scenarios_path, PROJECT, scenarios, shape)
+            result = await measure_project(
+                scenarios_path, names, args.backend, args.turns, args.users
+            )
+        result["size"] = size
+        results.append(result)
+        print(
+            f"{size:>10}{result['parse_ms']:>12.1f}{result['load_ms']:>12.1f}"
+            f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+        )
+    return results
+
+
+def plot(
+    results: tp.Dict[str, tp.List[tp.Dict[str, tp.Any]]],
+    labels: tp.Dict[str, str],
+    path: str,
+) -> None:
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, plot skipped")
+        return
+    fig, axes = plt.subplots(
+        1, len(results), figsize=(6 * len(results), 4.5), squeeze=False
+    )
+    for ax, (name, rows) in zip(axes[0], results.items()):
+        sizes = [x["size"] for x in rows]
+        for key in ("parse_ms", "load_ms", "p50_ms", "p99_ms"):
+            ax.plot(sizes, [x[key] for x in rows], marker="o", label=key)
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel(labels[name])
+        ax.set_ylabel("ms")
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"plot saved to {path}")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "--nodes", nargs="*", type=int, default=[10, 100, 1000, 10000]
+    )
+    arg_parser.add_argument(
+        "--scenarios", nargs="*", type=int, default=[1, 10, 100, 500]
+    )
+    arg_parser.add_argument("--scenario-nodes", type=int, default=50)
+    arg_parser.add_argument("--backend", choices=BACKENDS, default="memory")
+    arg_parser.add_argument("--turns", type=int, default=500)
+    arg_parser.add_argument("--users", type=int, default=10)
+    arg_parser.add_argument("--plot")
+    args = arg_parser.parse_args()
+
+    logger.setLevel(logging.ERROR)
+    header = f"{'parse ms':>12}{'load ms':>12}{'p50 ms':>10}{'p99 ms':>10}"
+    results = {}
+    labels = {
+        "nodes": "nodes in scenario",
+        "scenarios": f"scenarios in project ({args.scenario_nodes} nodes each)",
+    }
+    if args.nodes:
+        print(f"{'nodes':>10}{header}")
+        results["nodes"] = asyncio.run(
+            sweep(args.nodes, lambda n: (1, ScenarioShape(nodes=n)), args)
+        )
+    if args.scenarios:
+        print(f"{'scenarios':>10}{header}")
+        shape = ScenarioShape(nodes=args.scenario_nodes)
+        results["scenarios"] = asyncio.run(
+            sweep(args.scenarios, lambda n: (n, shape), args)
+        )
+    if args.plot and results:
+        plot(results, labels, args.plot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Сравнение хранения сценария в JSON (to_dict/from_dict) и в бинарном формате
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_serialization [--repeat 2000]
+"""
+import argparse
+import glob
+import json
+import os
+import timeit
+import typing as tp
+
+from src.domain.model import Scenario
+from src.domain.scenario_loader import XMLParser
+from src.domain.scenario_serializer import dump_scenario
+from src.domain.scenario_serializer import load_scenario
+
+
+def load_demo_scenarios() -> tp.List[Scenario]:
+    parser = XMLParser()
+    result = []
+    for path in sorted(glob.glob("./src/scenarios/*/*/scenario.xml")):
+        root_id, nodes = parser.parse(input_stuff=path)
+        name = os.path.basename(os.path.dirname(path))
+        result.append(
+            Scenario(name=name, root_id=root_id, nodes={x.element_id: x for x in nodes})
+        )
+    return result
+
+
+def bench_scenario(scenario: Scenario, repeat: int) -> tp.Dict[str, tp.Any]:
+    json_data = json.dumps(scenario.to_dict()).encode()
+    bin_data = dump_scenario(scenario)
+    json_load = timeit.timeit(
+        lambda: Scenario.from_dict(json.loads(json_data)), number=repeat
+    )
+    bin_load = timeit.timeit(lambda: load_scenario(bin_data), number=repeat)
+    json_dump = timeit.timeit(
+        lambda: json.dumps(scenario.to_dict()).encode(), number=repeat
+    )
+    bin_dump = timeit.timeit(lambda: dump_scenario(scenario), number=repeat)
+    return {
+        "scenario": scenario.name,
+        "nodes": len(scenario.nodes),
+        "json_bytes": len(json_data),
+        "bin_bytes": len(bin_data),
+        "json_load_us": json_load / repeat * 1e6,
+        "bin_load_us": bin_load / repeat * 1e6,
+        "json_dump_us": json_dump / repeat * 1e6,
+        "bin_dump_us": bin_dump / repeat * 1e6,
+    }
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--repeat", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    header = (
+        f"{'scenario':<14}{'nodes':>6}{'json B':>9}{'bin B':>8}"
+        f"{'json load us':>14}{'bin load us':>13}{'json dump us':>14}{'bin dump us':>13}"
+    )
+    print(header)
+    for scenario in load_demo_scenarios():
+        r = bench_scenario(scenario, args.repeat)
+        print(
+            f"{r['scenario']:<14}{r['nodes']:>6}{r['json_bytes']:>9}{r['bin_bytes']:>8}"
+            f"{r['json_load_us']:>14.1f}{r['bin_load_us']:>13.1f}"
+            f"{r['json_dump_us']:>14.1f}{r['bin_dump_us']:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Пропускная способность обработки сообщений целиком: ходы пользователей по демо-сценариям
+через EPWrapper, шину с отправкой и веб-адаптер на разных хранилищах
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_throughput [--backend memory sqlite] [--target ep bus web]
+        [--scenario quiz loop_counter] [--turns 1000] [--users 20]
+        [--save-baseline] [--compare] [--tolerance 0.2]
+
+--save-baseline записывает результаты в benchmarks/baselines/throughput.json,
+--compare сравнивает с ним и завершается с кодом 1 при падении msgs/sec больше tolerance
+Числа зависят от машины, сравнивать стоит прогоны на одном железе
+
+Через pytest-benchmark (если установлен):
+    pytest benchmarks/bench_throughput.py --benchmark-only
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import typing as tp
+
+from benchmarks.harness import BACKENDS
+from benchmarks.harness import SCRIPTS
+from benchmarks.harness import TARGETS
+from benchmarks.harness import Conversation
+from benchmarks.harness import is_supported
+from benchmarks.harness import make_pipeline
+from benchmarks.harness import measure
+from benchmarks.harness import stub_integration
+from src.settings import logger
+
+BASELINE_PATH = "./benchmarks/baselines/throughput.json"
+
+
+def result_key(backend: str, result: tp.Dict[str, tp.Any]) -> str:
+    return f"{result['target']}/{backend}/{result['scenario']}"
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+    results = {}
+    async with stub_integration():
+        for backend in args.backend:
+            for target in args.target:
+                for scenario in args.scenario:
+                    if not is_supported(target, scenario):
+                        continue
+                    pipeline = await make_pipeline(backend)
+                    result = await measure(
+                        pipeline,
+                        target=target,
+                        scenario=scenario,
+                        turns=args.turns,
+                        users=args.users,
+                    )
+                    results[result_key(backend, result)] = result
+                    print(
+                        f"{result_key(backend, result):<28}"
+                        f"{result['msgs_per_sec']:>12.0f}{result['p50_ms']:>10.2f}"
+                        f"{result['p99_ms']:>10.2f}{result['alloc_kb_per_turn']:>12.1f}"
+                    )
+    return results
+
+
+def compare(
+    results: tp.Dict[str, tp.Dict[str, tp.Any]],
+    baseline: tp.Dict[str, tp.Dict[str, tp.Any]],
+    tolerance: float,
+) -> bool:
+    """Печатает изменения относительно baseline, отдает False при регрессии"""
+    ok = True
+    print(f"\n{'':<28}{'base msg/s':>12}{'msg/s':>10}{'change':>9}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]["msgs_per_sec"]
+        change = result["msgs_per_sec"] / base - 1
+        mark = ""
+        if change < -tolerance:
+            mark = "  REGRESSION"
+            ok = False
+        print(
+            f"{key:<28}{base:>12.0f}{result['msgs_per_sec']:>10.0f}{change:>+9.1%}{mark}"
+        )
+    return ok
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "--backend", nargs="+", choices=BACKENDS, default=["memory", "sqlite"]
+    )
+    arg_parser.add_argument("--target", nargs="+", choices=TARGETS, default=TARGETS)
+    arg_parser.add_argument(
+        "--scenario", nargs="+", choices=list(SCRIPTS), default=list(SCRIPTS)
+    )
+    arg_parser.add_argument("--turns", type=int, default=1000)
+    arg_parser.add_argument("--users", type=int, default=20)
+    arg_parser.add_argument("--save-baseline", action="store_true")
+    arg_parser.add_argument("--compare", action="store_true")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    logger.setLevel(logging.ERROR)
+    print(
+        f"{'target/backend/scenario':<28}{'msg/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'alloc KB':>12}"
+    )
+    results = asyncio.run(run(args))
+
+    if args.compare:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)["results"]
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(
+                {
+                    "machine": platform.platform(),
+                    "python": platform.python_version(),
+                    "turns": args.turns,
+                    "users": args.users,
+                    "results": results,
+                },
+                f,
+                indent=2,
+                ensure_ascii=False,
+            )
+            f.write("\n")
+
+
+def test_throughput(benchmark: tp.Any) -> None:
+    """pytest-benchmark: ход одного пользователя через шину на InMemory"""
+    loop = asyncio.new_event_loop()
+    pipeline = loop.run_until_complete(make_pipeline("memory"))
+    conversation = Conversation(pipeline, "bus", SCRIPTS["loop_counter"], "bench")
+    benchmark(lambda: loop.run_until_complete(conversation.turn()))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Общая обвязка бенчмарков: сборка конвейера обработки на разных хранилищах,
+сценарные диалоги пользователей и замеры (сообщения в секунду, задержки, память)
+
+Хранилища:
+    memory  InMemoryRepo + InMemoryContextRepo
+    sqlite  SQLAlchemyRepo на sqlite в памяти (он же хранит контексты)
+    redis   InMemoryRepo + RedisContextRepo поверх fakeredis (pip install "fakeredis[lua]")
+
+Точки входа:
+    ep      EPWrapper.process_event
+    bus     ConcreteMessageBus с EPWrapper и SenderWrapper с фейковым отправителем
+    web     WebAdapter.message_handler
+"""
+import asyncio
+import dataclasses
+import statistics
+import time
+import tracemalloc
+import typing as tp
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from aiohttp import web as aiohttp_web
+
+from src import settings
+from src.adapters.alchemy.repository import SQLAlchemyRepo
+from src.adapters.ep_wrapper import EPWrapper
+from src.adapters.redis_context import RedisContextRepo
+from src.adapters.repository import AbstractContextRepo
+from src.adapters.repository import AbstractRepo
+from src.adapters.repository import InMemoryContextRepo
+from src.adapters.repository import InMemoryRepo
+from src.adapters.sender_wrapper import SenderWrapper
+from src.adapters.web_adapter import WebAdapter
+from src.bootstrap import download_scenarios_to_ep
+from src.bootstrap import upload_scenarios_to_repo
+from src.domain.events import EventProcessor
+from src.domain.model import Event
+from src.domain.model import InEvent
+from src.domain.model import OutEvent
+from src.domain.model import User
+from src.domain.scenario_loader import XMLParser
+from src.service_layer.message_bus import ConcreteMessageBus
+from src.service_layer.sender import Sender
+
+BACKENDS = ("memory", "sqlite", "redis")
+TARGETS = ("ep", "bus", "web")
+PROJECT = "demo"
+
+
+@dataclasses.dataclass
+class Script:
+    """Как пользователь ведет диалог по сценарию"""
+
+    start_text: str | None = None
+    start_intent: str | None = None
+    answer: str | None = None  # текст, когда ждут ввода, а кнопок нет
+    use_buttons: bool = False
+
+
+# hello ходит в интеграцию на localhost:8081, ее заменяет заглушка stub_integration
+# weather_demo ходит во внешнее API только после ввода верных координат, поэтому
+# пользователь все время вводит неверную широту
+SCRIPTS = {
+    "hello": Script(start_text="привет", start_intent="поздороваться"),
+    "quiz": Script(start_text="/quiz", use_buttons=True),
+    "loop_counter": Script(start_text="/loopCounter", use_buttons=True),
+    "weather_demo": Script(start_text="/start", answer="north"),
+}
+
+
+def is_supported(target: str, scenario: str) -> bool:
+    """Веб-API не умеет нажатия кнопок, сценарии на кнопках через web не гоняются"""
+    return not (target == "web" and SCRIPTS[scenario].use_buttons)
+
+
+class FakeSender(Sender):
+    """Отправитель без сети, отдает возрастающие id сообщений"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sent = 0
+
+    async def send(self, event: OutEvent, history: tp.List[tp.Dict[str, str]]) -> str:
+        self.sent += 1
+        return str(self.sent)
+
+
+@dataclasses.dataclass
+class Pipeline:
+    repo: AbstractRepo
+    ctx_repo: AbstractContextRepo
+    wrapped_ep: EPWrapper
+    bus: ConcreteMessageBus
+    web_adapter: WebAdapter
+    sender: FakeSender
+    outbox: "Outbox"
+
+
+def make_repos(backend: str) -> tp.Tuple[AbstractRepo, AbstractContextRepo]:
+    if backend == "memory":
+        return InMemoryRepo(), InMemoryContextRepo()
+    if backend == "sqlite":
+        settings.ENGINE_STRING = "sqlite+aiosqlite:///:memory:"
+        sql_repo = SQLAlchemyRepo()
+        return sql_repo, sql_repo  # type: ignore
+    if backend == "redis":
+        try:
+            import fakeredis.aioredis
+        except ImportError:
+            raise SystemExit(
+                'redis backend needs fakeredis: pip install "fakeredis[lua]"'
+            )
+        ctx_repo = RedisContextRepo(fakeredis.aioredis.FakeRedis(decode_responses=True))
+        return InMemoryRepo(), ctx_repo
+    raise ValueError(f"Unknown backend {backend}")
+
+
+async def make_pipeline(
+    backend: str, scenarios_path: str = "./src/scenarios"
+) -> Pipeline:
+    repo, ctx_repo = make_repos(backend)
+    if isinstance(repo, SQLAlchemyRepo):
+        await repo._recreate_db()  # noqa
+    await upload_scenarios_to_repo(
+        repo=repo, parser=XMLParser(), scenarios_path=scenarios_path
+    )
+
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    await download_scenarios_to_ep(wrapped_ep=wrapped_ep, repo=repo)
+    sender = FakeSender()
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep, event_type=InEvent)
+    bus.register(
+        SenderWrapper(sender=sender, repo=repo, ctx_repo=ctx_repo),
+        event_type=OutEvent,
+    )
+    outbox = Outbox()
+    bus.register(outbox, event_type=OutEvent)
+    web_adapter = WebAdapter(
+        repo=repo, ctx_repo=ctx_repo, bus=bus, ep_wrapped=wrapped_ep
+    )
+    return Pipeline(repo, ctx_repo, wrapped_ep, bus, web_adapter, sender, outbox)
+
+
+class Outbox:
+    """Подписчик шины, собирающий исходящие события по пользователям"""
+
+    def __init__(self) -> None:
+        self.events: tp.Dict[str, tp.List[Event]] = defaultdict(list)
+
+    async def handle_message(self, message: Event) -> tp.List[Event]:
+        if isinstance(message, OutEvent):
+            self.events[message.user.outer_id].append(message)
+        return []
+
+
+class Conversation:
+    """Диалог одного пользователя: отдает следующее входящее событие по прошлому ответу"""
+
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        target: str,
+        script: Script,
+        outer_id: str,
+        project: str = PROJECT,
+    ) -> None:
+        self.pipeline = pipeline
+        self.target = target
+        self.script = script
+        self.outer_id = outer_id
+        self.project = project
+        self.buttons: tp.List[str] = []
+        self.pushes = 0
+
+    async def _next_event(self, user: User) -> InEvent:
+        event = InEvent(user=user, project_name=self.project)
+        if user.current_scenario_name is None:
+            event.text = self.script.start_text
+            event.intent = self.script.start_intent
+        elif self.buttons and self.script.use_buttons and self.target != "web":
+            event.button_pushed_next = self.buttons[self.pushes % len(self.buttons)]
+            self.pushes += 1
+        else:
+            event.text = self.script.answer
+        return event
+
+    def _remember_buttons(self, events: tp.Sequence[Event]) -> None:
+        buttons = [
+            b.callback_data
+            for e in events
+            if isinstance(e, OutEvent) and e.buttons
+            for b in e.buttons
+            if b.callback_data
+        ]
+        if buttons:
+            self.buttons = buttons
+
+    async def turn(self) -> float:
+        """Один ход пользователя, отдает его длительность в секундах"""
+        user = await self.pipeline.repo.get_or_create_user(outer_id=self.outer_id)
+        event = await self._next_event(user)
+        if self.target == "ep":
+            start = time.perf_counter()
+            self._remember_buttons(await self.pipeline.wrapped_ep.process_event(event))
+        elif self.target == "bus":
+            start = time.perf_counter()
+            await self.pipeline.bus.public_message(event)
+            self._remember_buttons(self.pipeline.outbox.events.pop(self.outer_id, []))
+        else:
+            start = time.perf_counter()
+            await self.pipeline.web_adapter.message_handler(
+                {
+                    "user_id": self.outer_id,
+                    "text": event.text,
+                    "intent": event.intent,
+                    "project_name": self.project,
+                    "security": {"headers": []},
+                    "integration_url": "",
+                }
+            )
+        return time.perf_counter() - start
+
+
+@asynccontextmanager
+async def stub_integration(port: int = 8081) -> tp.AsyncIterator[None]:
+    """Заглушка внешней интеграции сценария hello (как fake_isfront, но в этом процессе)"""
+
+    async def get_info(_: aiohttp_web.Request) -> aiohttp_web.Response:
+        return aiohttp_web.json_response({"name": "Лариса", "patronymic": "Валерьевна"})
+
+    app = aiohttp_web.Application()
+    app.router.add_get("/user/get_info", get_info)
+    runner = aiohttp_web.AppRunner(app)
+    await runner.setup()
+    await aiohttp_web.TCPSite(runner, "localhost", port).start()
+    try:
+        yield
+    finally:
+        await runner.cleanup()
+
+
+def percentile(values: tp.Sequence[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_conversations(
+    conversations: tp.Sequence[Conversation],
+    turns: int,
+    warmup: int = 20,
+    memory_turns: int = 50,
+) -> tp.Dict[str, tp.Any]:
+    """
+    turns ходов, диалоги идут конкурентно
+    Память считается отдельным последовательным прогоном под tracemalloc,
+    чтобы трассировка не искажала задержки
+    """
+    users = len(conversations)
+    for i in range(warmup):
+        await conversations[i % users].turn()
+
+    latencies: tp.List[float] = []
+
+    async def run_user(conversation: Conversation, user_turns: int) -> None:
+        for _ in range(user_turns):
+            latencies.append(await conversation.turn())
+
+    per_user = max(1, turns // users)
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(c, per_user) for c in conversations))
+    elapsed = time.perf_counter() - start
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(memory_turns):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await conversations[i % users].turn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - current)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "turns": len(latencies),
+        "users": users,
+        "msgs_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "alloc_kb_per_turn": statistics.mean(peaks) / 1024 if peaks else 0.0,
+    }
+
+
+async def measure(
+    pipeline: Pipeline,
+    target: str,
+    scenario: str,
+    turns: int,
+    users: int,
+    warmup: int = 20,
+    memory_turns: int = 50,
+) -> tp.Dict[str, tp.Any]:
+    """turns ходов от users конкурентных пользователей по демо-сценарию"""
+    script = SCRIPTS[scenario]
+    conversations = [
+        Conversation(pipeline, target, script, f"{target}_{scenario}_{i}")
+        for i in range(users)
+    ]
+    result = await run_conversations(conversations, turns, warmup, memory_turns)
+    return {"target": target, "scenario": scenario} | result
@@ -0,0 +1,239 @@
+"""
+Нагрузочный генератор для веб-канала (POST /message_text)
+
+Каждый виртуальный пользователь ведет свой диалог: начинает сценарий одной из стартовых
+фраз, дальше отвечает на кнопки из ответа (отправляет text_to_bot случайной кнопки,
+как это делает веб-фронт), а без кнопок - свободным текстом; через --depth ходов или
+после ошибки начинает новый диалог. Пользователи работают по замкнутому циклу:
+следующий запрос после ответа на предыдущий (и --think-time)
+
+Нагрузка растет ступенями: на каждой ступени --users пользователей (уже созданные
+продолжают свои диалоги) работают --duration секунд, по ступени печатаются запросы
+в секунду, задержки и доля ошибок
+
+Запуск против поднятого приложения (python main.py) с fake_isfront в роли интеграции:
+    python -m fake_isfront.isfront
+    python -m benchmarks.load_generator [--url http://localhost:8080] [--project demo]
+        [--users 10 50 100 200] [--duration 30] [--start привет:поздороваться /start]
+        [--answer north] [--depth 5] [--think-time 0] [--timeout 10] [--json out.json]
+
+Модуль не импортирует src, его можно запускать с отдельной машины
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import random
+import time
+import typing as tp
+import uuid
+from collections import Counter
+
+import aiohttp
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/92.0.4515.131 Safari/537.36"
+)
+
+
+@dataclasses.dataclass
+class Start:
+    text: str
+    intent: str = ""
+
+    @classmethod
+    def parse(cls, value: str) -> "Start":
+        """Фраза в виде "текст" или "текст:интент" """
+        text, _, intent = value.partition(":")
+        return cls(text=text, intent=intent)
+
+
+class VirtualUser:
+    """Состояние диалога одного пользователя"""
+
+    def __init__(
+        self,
+        user_id: str,
+        project: str,
+        integration_url: str,
+        starts: tp.List[Start],
+        answers: tp.List[str],
+        depth: int,
+    ) -> None:
+        self.user_id = user_id
+        self.project = project
+        self.integration_url = integration_url
+        self.starts = starts
+        self.answers = answers
+        self.depth = depth
+        self.headers = [
+            ["Cookie", f"JSESSIONID={uuid.uuid4()}"],
+            ["User-Agent", USER_AGENT],
+        ]
+        self.buttons: tp.List[tp.Dict[str, str]] = []
+        self.turn = 0
+
+    def reset(self) -> None:
+        self.buttons = []
+        self.turn = 0
+
+    def next_payload(self) -> tp.Dict[str, tp.Any]:
+        intent = ""
+        if self.turn == 0:
+            start = random.choice(self.starts)
+            text, intent = start.text, start.intent
+        elif self.buttons:
+            button = random.choice(self.buttons)
+            text = button["text_to_bot"] or button["text_button"]
+        else:
+            text = random.choice(self.answers)
+        self.turn = (self.turn + 1) % self.depth
+        return {
+            "user_id": self.user_id,
+            "text": text,
+            "intent": intent,
+            "project_name": self.project,
+            "security": {"headers": self.headers},
+            "integration_url": self.integration_url,
+        }
+
+    def remember(self, response: tp.Dict[str, tp.Any]) -> None:
+        self.buttons = [
+            e["params"]
+            for e in response.get("events", [])
+            if e.get("type") == "function" and e.get("function") == "button"
+        ]
+
+
+@dataclasses.dataclass
+class StageStats:
+    users: int
+    latencies: tp.List[float] = dataclasses.field(default_factory=list)
+    errors: tp.Counter[str] = dataclasses.field(default_factory=Counter)
+    elapsed: float = 0.0
+
+    def summary(self) -> tp.Dict[str, tp.Any]:
+        requests = len(self.latencies) + sum(self.errors.values())
+        ordered = sorted(self.latencies) or [0.0]
+
+        def percentile(q: float) -> float:
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+        return {
+            "users": self.users,
+            "requests": requests,
+            "rps": requests / self.elapsed if self.elapsed else 0.0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": ordered[-1] * 1000,
+            "error_rate": sum(self.errors.values()) / requests if requests else 0.0,
+            "errors": dict(self.errors),
+        }
+
+
+async def run_user(
+    session: aiohttp.ClientSession,
+    url: str,
+    user: VirtualUser,
+    stats: StageStats,
+    deadline: float,
+    think_time: float,
+) -> None:
+    while time.monotonic() < deadline:
+        payload = user.next_payload()
+        start = time.perf_counter()
+        try:
+            async with session.post(url, json=payload) as response:
+                body = await response.read()
+                if response.status != 200:
+                    stats.errors[f"http {response.status}"] += 1
+                    user.reset()
+                else:
+                    stats.latencies.append(time.perf_counter() - start)
+                    user.remember(json.loads(body))
+        except asyncio.TimeoutError:
+            stats.errors["timeout"] += 1
+            user.reset()
+        except aiohttp.ClientError as e:
+            stats.errors[type(e).__name__] += 1
+            user.reset()
+        if think_time:
+            await asyncio.sleep(random.uniform(0, 2 * think_time))
+
+
+async def run(args: argparse.Namespace) -> tp.List[tp.Dict[str, tp.Any]]:
+    url = f"{args.url.rstrip('/')}/message_text"
+    starts = [Start.parse(x) for x in args.start]
+    users: tp.List[VirtualUser] = []
+    results = []
+    run_id = uuid.uuid4().hex[:8]
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for stage_users in args.users:
+            while len(users) < stage_users:
+                users.append(
+                    VirtualUser(
+                        user_id=f"load_{run_id}_{len(users)}",
+                        project=args.project,
+                        integration_url=args.integration_url,
+                        starts=starts,
+                        answers=args.answer,
+                        depth=args.depth,
+                    )
+                )
+            stats = StageStats(users=stage_users)
+            start = time.monotonic()
+            deadline = start + args.duration
+            await asyncio.gather(
+                *(
+                    run_user(session, url, u, stats, deadline, args.think_time)
+                    for u in users[:stage_users]
+                )
+            )
+            stats.elapsed = time.monotonic() - start
+            result = stats.summary()
+            results.append(result)
+            print(
+                f"{result['users']:>8}{result['requests']:>10}{result['rps']:>10.1f}"
+                f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                f"{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}"
+                f"{result['error_rate']:>9.1%}  {result['errors'] or ''}"
+            )
+    return results
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument("--url", default="http://localhost:8080")
+    arg_parser.add_argument("--project", default="demo")
+    arg_parser.add_argument("--integration-url", default="http://localhost:8081")
+    arg_parser.add_argument("--users", nargs="+", type=int, default=[10, 50, 100, 200])
+    arg_parser.add_argument("--duration", type=float, default=30)
+    arg_parser.add_argument(
+        "--start", nargs="+", default=["привет:поздороваться", "/start"]
+    )
+    arg_parser.add_argument("--answer", nargs="+", default=["north"])
+    arg_parser.add_argument("--depth", type=int, default=5)
+    arg_parser.add_argument("--think-time", type=float, default=0)
+    arg_parser.add_argument("--timeout", type=float, default=10)
+    arg_parser.add_argument("--json")
+    args = arg_parser.parse_args()
+
+    print(
+        f"{'users':>8}{'requests':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'max ms':>10}{'errors':>9}"
+    )
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
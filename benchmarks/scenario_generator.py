@@ -0,0 +1,258 @@
+"""
+Генератор больших синтетических сценариев в формате drawio (mxfile) для бенчмарков масштаба
+
+Сценарий собирается из блоков, пока не наберется нужное число нод:
+    кнопки  outMessage с btnArray, каждая кнопка ведет в свою ветку, ветки сходятся
+            в начале следующего блока
+    ввод    вопрос, inMessage, dataExtract:re(...) и logicalUnit:NOT; на неверный ответ
+            loopCounter возвращает к вопросу, после лимита попыток сценарий идет дальше
+В конце сценария нода без потомков, после нее пользователь может начать заново
+
+Запуск из корня проекта:
+    python -m benchmarks.scenario_generator OUT_DIR [--project gen] [--scenarios 10]
+        [--nodes 1000] [--buttons 3] [--input-every 2] [--loop-limit 2]
+Получится OUT_DIR/<project>/gen_<i>/{scenario.xml,text_templates.json}, сценарий gen_<i>
+запускается фразой /gen_<i>
+"""
+import argparse
+import dataclasses
+import json
+import os
+import typing as tp
+import xml.etree.ElementTree as et
+
+PARENT_ID = "WIyWlLk6GJQsqaUBKTNV-1"
+ROOT_ID = "WIyWlLk6GJQsqaUBKTNV-0"
+# ответ, который проходит dataExtract блока ввода
+VALID_ANSWER = "42"
+INPUT_BLOCK_NODES = 8
+CHAIN_STEP = 5
+
+
+@dataclasses.dataclass
+class ScenarioShape:
+    """Размер и форма сценария"""
+
+    nodes: int = 100
+    buttons: int = 3  # кнопок (и веток) в блоке с кнопками
+    input_every: int = 2  # каждый какой блок - ввод с логическим блоком и циклом
+    loop_limit: int = 2  # попыток неверного ввода до выхода из цикла
+
+
+def start_phrase(name: str) -> str:
+    return f"/{name}"
+
+
+class _Builder:
+    """Накапливает ячейки mxGraphModel и тексты шаблонов"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.root = et.Element("root")
+        # атрибуты parent и as передаются словарем: как ключевые аргументы SubElement
+        # их принимает только C-реализация
+        et.SubElement(self.root, "mxCell", {"id": ROOT_ID})
+        et.SubElement(self.root, "mxCell", {"id": PARENT_ID, "parent": ROOT_ID})
+        self.texts: tp.Dict[str, str] = {}
+        self.last_id = 0
+        self.messages = 0
+        self.nodes = 0
+        self.row = 0
+
+    def _next_id(self) -> str:
+        self.last_id += 1
+        return f"{self.name}-{self.last_id}"
+
+    def _vertex(self, value: str, parent: str = PARENT_ID, x: int = 160) -> str:
+        element_id = self._next_id()
+        cell = et.SubElement(
+            self.root,
+            "mxCell",
+            {
+                "id": element_id,
+                "value": value,
+                "style": "rounded=0;whiteSpace=wrap;html=1;",
+                "vertex": "1",
+                "parent": parent,
+            },
+        )
+        et.SubElement(
+            cell,
+            "mxGeometry",
+            {
+                "x": str(x),
+                "y": str(self.row * 80),
+                "width": "120",
+                "height": "60",
+                "as": "geometry",
+            },
+        )
+        self.row += 1
+        return element_id
+
+    def node(self, node_type: str, value: str | None = None, x: int = 160) -> str:
+        self.nodes += 1
+        return self._vertex(node_type if value is None else f"{node_type}:{value}", x=x)
+
+    def message(self, x: int = 160) -> str:
+        self.messages += 1
+        template = f"TEXT{self.messages}"
+        self.texts[template] = f"Сообщение {self.messages} сценария {self.name}"
+        return self.node("outMessage", template, x=x)
+
+    def buttons(self, message_id: str, count: int) -> tp.List[str]:
+        """Кнопки к последнему добавленному сообщению"""
+        array_id = self._vertex("btnArray")
+        self.edge(message_id, array_id)
+        button_ids = []
+        for i in range(count):
+            template = f"TEXT{self.messages}.{i + 1}"
+            self.texts[template] = f"Кнопка {i + 1}"
+            button_ids.append(self._vertex(template, parent=array_id))
+        return button_ids
+
+    def edge(self, source_id: str, target_id: str) -> None:
+        cell = et.SubElement(
+            self.root,
+            "mxCell",
+            {
+                "id": self._next_id(),
+                "style": "edgeStyle=orthogonalEdgeStyle;rounded=0;html=1;",
+                "edge": "1",
+                "parent": PARENT_ID,
+                "source": source_id,
+                "target": target_id,
+            },
+        )
+        et.SubElement(cell, "mxGeometry", {"relative": "1", "as": "geometry"})
+
+    def to_xml(self) -> str:
+        mxfile = et.Element("mxfile", host="dialog-constructor-generator")
+        diagram = et.SubElement(mxfile, "diagram", id=self.name, name="Page-1")
+        graph = et.SubElement(diagram, "mxGraphModel", grid="1", gridSize="10")
+        graph.append(self.root)
+        et.indent(mxfile)
+        return et.tostring(mxfile, encoding="unicode", xml_declaration=True)
+
+
+def _button_block(
+    builder: _Builder, entry_ids: tp.List[str], buttons: int
+) -> tp.List[str]:
+    """Сообщение с кнопками и по ветке на кнопку, отдает концы веток"""
+    message_id = builder.message()
+    for entry_id in entry_ids:
+        builder.edge(entry_id, message_id)
+    branch_ids = []
+    for i, button_id in enumerate(builder.buttons(message_id, buttons)):
+        branch_id = builder.message(x=160 + 160 * i)
+        builder.edge(button_id, branch_id)
+        branch_ids.append(branch_id)
+    return branch_ids
+
+
+def _input_block(
+    builder: _Builder, entry_ids: tp.List[str], loop_limit: int
+) -> tp.List[str]:
+    """
+    Вопрос и ожидание числа; на неверный ответ повтор вопроса, пока не кончатся попытки
+    Порядок стрелок важен: первый потомок logicalUnit и loopCounter - ветка повтора
+    """
+    question_id = builder.message()
+    for entry_id in entry_ids:
+        builder.edge(entry_id, question_id)
+    in_id = builder.node("inMessage")
+    extract_id = builder.node("dataExtract", r"re(^\d+$)")
+    logical_id = builder.node("logicalUnit", "NOT")
+    loop_id = builder.node("loopCounter", str(loop_limit))
+    retry_id = builder.message(x=0)
+    give_up_id = builder.message(x=320)
+    ok_id = builder.message(x=320)
+    builder.edge(question_id, in_id)
+    builder.edge(in_id, extract_id)
+    builder.edge(extract_id, logical_id)
+    builder.edge(logical_id, loop_id)
+    builder.edge(logical_id, ok_id)
+    builder.edge(loop_id, retry_id)
+    builder.edge(loop_id, give_up_id)
+    builder.edge(retry_id, in_id)
+    return [give_up_id, ok_id]
+
+
+def generate_scenario(
+    name: str, shape: ScenarioShape
+) -> tp.Tuple[str, tp.Dict[str, str]]:
+    """
+    Сценарий примерно из shape.nodes нод (не меньше одного блока)
+    :return: xml сценария и тексты шаблонов
+    """
+    builder = _Builder(name)
+    entry_ids = [builder.node("matchText", start_phrase(name))]
+    block = 0
+    while True:
+        is_input = shape.input_every and block % shape.input_every == 1
+        block_nodes = INPUT_BLOCK_NODES if is_input else shape.buttons + 1
+        # блок добавляется, только если влезает целиком, остаток добирается цепочкой
+        if block and builder.nodes + block_nodes > shape.nodes:
+            break
+        if is_input:
+            entry_ids = _input_block(builder, entry_ids, shape.loop_limit)
+        else:
+            entry_ids = _button_block(builder, entry_ids, shape.buttons)
+        block += 1
+    # цепочка сообщений до нужного числа нод; EventProcessor проходит за ход не больше
+    # 15 нод, поэтому каждое CHAIN_STEP-е сообщение ждет нажатия единственной кнопки
+    chain = 0
+    while builder.nodes < shape.nodes:
+        message_id = builder.message()
+        for entry_id in entry_ids:
+            builder.edge(entry_id, message_id)
+        entry_ids = [message_id]
+        chain += 1
+        if chain % CHAIN_STEP == 0 and builder.nodes < shape.nodes:
+            entry_ids = builder.buttons(message_id, 1)
+    return builder.to_xml(), builder.texts
+
+
+def write_scenario(path: str, name: str, shape: ScenarioShape) -> None:
+    xml, texts = generate_scenario(name, shape)
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path}/scenario.xml", "w") as f:
+        f.write(xml)
+    with open(f"{path}/text_templates.json", "w") as f:
+        json.dump(texts, f, ensure_ascii=False, indent=2)
+
+
+def write_project(
+    scenarios_path: str, project: str, scenarios: int, shape: ScenarioShape
+) -> tp.List[str]:
+    """Проект из scenarios одинаковых по форме сценариев, отдает их названия"""
+    names = [f"gen_{i}" for i in range(scenarios)]
+    for name in names:
+        write_scenario(f"{scenarios_path}/{project}/{name}", name, shape)
+    return names
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument("out_dir")
+    arg_parser.add_argument("--project", default="gen")
+    arg_parser.add_argument("--scenarios", type=int, default=10)
+    arg_parser.add_argument("--nodes", type=int, default=1000)
+    arg_parser.add_argument("--buttons", type=int, default=3)
+    arg_parser.add_argument("--input-every", type=int, default=2)
+    arg_parser.add_argument("--loop-limit", type=int, default=2)
+    args = arg_parser.parse_args()
+    shape = ScenarioShape(
+        nodes=args.nodes,
+        buttons=args.buttons,
+        input_every=args.input_every,
+        loop_limit=args.loop_limit,
+    )
+    names = write_project(args.out_dir, args.project, args.scenarios, shape)
+    print(f"{len(names)} scenarios written to {args.out_dir}/{args.project}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 import asyncio
+import typing as tp
 
+from src import settings
+from src.adapters.alchemy.batching import BatchingSQLAlchemyRepo
 from src.adapters.alchemy.repository import SQLAlchemyRepo
 from src.adapters.ep_wrapper import EPWrapper
 from src.adapters.poller_adapter import PollerAdapter
 from src.adapters.redis_context import RedisContextRepo
+from src.adapters.repository import AbstractRepo
 
 # from src.adapters.repository import InMemoryRepo, InMemoryContextRepo
 from src.adapters.sender_wrapper import SenderWrapper
@@ -11,21 +15,25 @@ from src.adapters.web_adapter import WebAdapter
 from src.bootstrap import bootstrap
 from src.domain.events import EventProcessor
 from src.entrypoints.poller import TgPoller
+from src.entrypoints.poller import TgWebhook
 from src.entrypoints.web import Web
 from src.service_layer.message_bus import ConcreteMessageBus
 from src.service_layer.sender import TgSender
 
 
 async def main() -> None:
+    repo: tp.Type[AbstractRepo] = SQLAlchemyRepo
+    if settings.DB_WRITE_BATCHING:
+        repo = BatchingSQLAlchemyRepo
     init_app = await bootstrap(
-        repo=SQLAlchemyRepo,  # InMemoryRepo,
+        repo=repo,  # InMemoryRepo,
         ctx_repo=RedisContextRepo,  # InMemoryContextRepo,
         ep=EventProcessor,
         ep_wrapper=EPWrapper,
         bus=ConcreteMessageBus,
         web=Web,
         web_adapter=WebAdapter,
-        poller=TgPoller,
+        poller=TgWebhook if settings.TG_WEBHOOK_URL else TgPoller,
         poller_adapter=PollerAdapter,
         sender=TgSender,
         sender_wrapper=SenderWrapper,
@@ -0,0 +1,260 @@
+import asyncio
+import dataclasses
+import typing as tp
+
+import sqlalchemy as sa
+from sqlalchemy.future import select
+
+from src import settings
+from src.adapters.alchemy.models import out_messages
+from src.adapters.alchemy.models import user_contexts
+from src.adapters.alchemy.models import users
+from src.adapters.alchemy.repository import _DIALECT_INSERTS
+from src.adapters.alchemy.repository import SQLAlchemyRepo
+from src.adapters.repository import strip_loop_counters
+from src.domain.model import USER_FIELDS
+from src.domain.model import User
+from src.settings import logger
+
+
+@dataclasses.dataclass
+class _Write:
+    kind: str  # user, context, clear, turn, history
+    outer_id: str
+    value: tp.Any
+    future: asyncio.Future  # type: ignore
+
+
+class BatchingSQLAlchemyRepo(SQLAlchemyRepo):
+    """
+    Склеивает записи пользователей, контекстов и истории от конкурентных обработчиков
+    Записи копятся в течение окна (или до размера пачки) и пишутся одной транзакцией,
+    вызывающий получает управление после коммита своей пачки. Пачки пишутся по одной,
+    чтобы чтение контекстов следующей видело коммит предыдущей
+    """
+
+    def __init__(
+        self, window_ms: float | None = None, batch_size: int | None = None
+    ) -> None:
+        super().__init__()
+        self.window = (
+            window_ms if window_ms is not None else settings.DB_WRITE_BATCH_WINDOW_MS
+        ) / 1000
+        self.batch_size = batch_size or settings.DB_WRITE_BATCH_SIZE
+        self.pending: tp.List[_Write] = []
+        self.flush_task: asyncio.Task | None = None  # type: ignore
+        self.flushes: tp.Set[asyncio.Task] = set()  # type: ignore
+        self.flush_lock = asyncio.Lock()
+
+    async def _enqueue(self, kind: str, outer_id: str, value: tp.Any) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(_Write(kind, outer_id, value, future))
+        if len(self.pending) >= self.batch_size:
+            self._flush_now()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        await self._flush(self._take_pending())
+
+    def _flush_now(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        task = asyncio.create_task(self._flush(self._take_pending()))
+        # держим ссылку, чтобы задачу не собрал gc
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    def _take_pending(self) -> tp.List[_Write]:
+        batch = self.pending
+        self.pending = []
+        return batch
+
+    async def _flush(self, batch: tp.List[_Write]) -> None:
+        if not batch:
+            return
+        try:
+            async with self.flush_lock:
+                await self._write_batch(batch)
+        except Exception as e:
+            logger.error("batch of %s writes failed: %s", len(batch), e)
+            for write in batch:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            return
+        for write in batch:
+            if not write.future.done():
+                write.future.set_result(None)
+
+    async def _write_batch(self, batch: tp.List[_Write]) -> None:
+        outer_ids = {x.outer_id for x in batch}
+        async_session = self.session()
+        async with async_session() as session:
+            rows = await session.execute(
+                select(users.c.id, users.c.outer_id).where(
+                    users.c.outer_id.in_(outer_ids)
+                )
+            )
+            ids = {row.outer_id: row.id for row in rows}
+
+            for write in batch:
+                if write.outer_id not in ids:
+                    write.future.set_exception(
+                        Exception(f"User {write.outer_id} not found")
+                    )
+            batch = [x for x in batch if x.outer_id in ids]
+
+            # пользователи: только измененные поля, по полю побеждает последняя запись
+            users_values: tp.Dict[str, tp.Dict[str, tp.Any]] = {}
+            for write in batch:
+                if write.kind == "user":
+                    users_values[write.outer_id] = (
+                        users_values.get(write.outer_id, {}) | write.value
+                    )
+            # один executemany на каждый набор полей
+            by_fields: tp.Dict[tp.Tuple[str, ...], tp.List[tp.Dict[str, tp.Any]]] = {}
+            for outer_id, value in users_values.items():
+                by_fields.setdefault(tuple(sorted(value)), []).append(
+                    {"b_outer_id": outer_id} | {f"b_{f}": v for f, v in value.items()}
+                )
+            for user_fields, params in by_fields.items():
+                await session.execute(
+                    sa.update(users)
+                    .where(users.c.outer_id == sa.bindparam("b_outer_id"))
+                    .values({f: sa.bindparam(f"b_{f}") for f in user_fields}),
+                    params,
+                )
+
+            # контексты: изменения применяются по порядку поверх текущих значений
+            ctx_writes = [x for x in batch if x.kind in ("context", "clear", "turn")]
+            if ctx_writes:
+                ctx_user_ids = {ids[x.outer_id] for x in ctx_writes}
+                rows = await session.execute(
+                    select(user_contexts.c.user, user_contexts.c.ctx).where(
+                        user_contexts.c.user.in_(ctx_user_ids)
+                    )
+                )
+                exists = {row.user: row.ctx for row in rows}
+                contexts: tp.Dict[int, tp.Dict[str, str]] = {}
+                for write in ctx_writes:
+                    user_id = ids[write.outer_id]
+                    ctx = contexts.get(user_id, exists.get(user_id) or {})
+                    if write.kind == "context":
+                        ctx = ctx | write.value
+                    elif write.kind == "clear":
+                        ctx = strip_loop_counters(ctx)
+                    else:
+                        ctx_to_update, scenario_finished = write.value
+                        ctx = ctx | ctx_to_update
+                        if scenario_finished:
+                            ctx = strip_loop_counters(ctx)
+                    contexts[user_id] = ctx
+                dialect_insert = _DIALECT_INSERTS.get(self.engine.dialect.name)
+                if dialect_insert is not None:
+                    # один INSERT ... VALUES (...), (...) ON CONFLICT DO UPDATE
+                    stmt = dialect_insert(user_contexts).values(
+                        [dict(user=k, ctx=v) for k, v in contexts.items()]
+                    )
+                    await session.execute(
+                        stmt.on_conflict_do_update(
+                            index_elements=[user_contexts.c.user],
+                            set_=dict(ctx=stmt.excluded.ctx),
+                        )
+                    )
+                    contexts = {}
+                to_insert = [
+                    dict(user=k, ctx=v) for k, v in contexts.items() if k not in exists
+                ]
+                to_update = [
+                    dict(b_user=k, b_ctx=v) for k, v in contexts.items() if k in exists
+                ]
+                if to_insert:
+                    await session.execute(user_contexts.insert(), to_insert)
+                if to_update:
+                    await session.execute(
+                        sa.update(user_contexts)
+                        .where(user_contexts.c.user == sa.bindparam("b_user"))
+                        .values(ctx=sa.bindparam("b_ctx")),
+                        to_update,
+                    )
+
+            history = [
+                dict(
+                    user=ids[x.outer_id],
+                    node_id=list(x.value.keys())[0],
+                    message_id=list(x.value.values())[0],
+                )
+                for x in batch
+                if x.kind == "history"
+            ]
+            if history:
+                await session.execute(out_messages.insert(), history)
+            await session.commit()
+
+    async def update_user(
+        self,
+        user: User,
+        fields: tp.Sequence[str] | None = None,
+        session: tp.Any = None,
+    ) -> User:
+        """Update user fields"""
+        if session is not None:
+            updated: User = await super().update_user(
+                user, fields=fields, session=session
+            )
+            return updated
+        if fields is None:
+            fields = USER_FIELDS
+        if fields:
+            await self._enqueue(
+                "user", user.outer_id, {x: getattr(user, x) for x in fields}
+            )
+        return dataclasses.replace(user)
+
+    async def update_user_context(
+        self, user: User, ctx_to_update: tp.Dict[str, str], session: tp.Any = None
+    ) -> None:
+        """Update user context"""
+        if session is not None:
+            await super().update_user_context(user, ctx_to_update, session=session)
+            return
+        await self._enqueue("context", user.outer_id, dict(ctx_to_update))
+
+    async def clear_user_context(self, user: User, session: tp.Any = None) -> None:
+        """Clear user context"""
+        if session is not None:
+            await super().clear_user_context(user, session=session)
+            return
+        await self._enqueue("clear", user.outer_id, None)
+
+    async def commit_turn(
+        self,
+        user: User,
+        ctx_to_update: tp.Dict[str, str],
+        scenario_finished: bool,
+        session: tp.Any = None,
+    ) -> None:
+        """Apply turn delta and strip loop counters in one transaction"""
+        if session is not None:
+            await super().commit_turn(
+                user, ctx_to_update, scenario_finished, session=session
+            )
+            return
+        await self._enqueue(
+            "turn", user.outer_id, (dict(ctx_to_update), scenario_finished)
+        )
+
+    async def add_to_user_history(
+        self, user: User, ids_pair: tp.Dict[str, str], session: tp.Any = None
+    ) -> None:
+        """Get user history of out messages"""
+        if session is not None:
+            await super().add_to_user_history(user, ids_pair, session=session)
+            return
+        if len(ids_pair) != 1:
+            raise Exception("History dict must be with length = 1")
+        await self._enqueue("history", user.outer_id, dict(ids_pair))
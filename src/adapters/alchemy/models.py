@@ -19,6 +19,8 @@ user_contexts = sa.Table(
     sa.Column("id", sa.Integer, primary_key=True),
     sa.Column("user", sa.ForeignKey("users.id", ondelete="CASCADE")),
     sa.Column("ctx", sa.JSON, default={}),  # TODO: переделать на отдельные колонки
+    # один контекст на пользователя, по нему идет INSERT ... ON CONFLICT
+    sa.Index("ix_user_contexts_user", "user", unique=True),
 )
 out_messages = sa.Table(
     "out_messages",
@@ -41,6 +43,8 @@ scenarios = sa.Table(
     sa.Column("project", sa.ForeignKey("projects.name", ondelete="CASCADE")),
     sa.Column("name", sa.String),
     sa.Column("scenario_json", sa.JSON),
+    sa.Column("content_hash", sa.String, nullable=True),
+    sa.Column("scenario_bin", sa.LargeBinary, nullable=True),
 )
 scenario_texts = sa.Table(
     "scenario_texts",
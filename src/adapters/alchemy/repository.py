@@ -1,9 +1,12 @@
+import dataclasses
 import functools
 import typing as tp
 
 import asyncpg
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.future import select
@@ -19,10 +22,20 @@ from src.adapters.alchemy.models import scenarios
 from src.adapters.alchemy.models import user_contexts
 from src.adapters.alchemy.models import users
 from src.adapters.repository import AbstractRepo
+from src.adapters.repository import strip_loop_counters
+from src.domain.model import USER_FIELDS
 from src.domain.model import Scenario
 from src.domain.model import User
+from src.domain.scenario_serializer import dump_scenario
+from src.domain.scenario_serializer import load_scenario
 from src.settings import logger
 
+# диалекты с INSERT ... ON CONFLICT
+_DIALECT_INSERTS: tp.Dict[str, tp.Callable[..., tp.Any]] = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
 
 class SQLAlchemyRepo(AbstractRepo):
     def __init__(self) -> None:
@@ -76,7 +89,11 @@ class SQLAlchemyRepo(AbstractRepo):
     async def get_or_create_user(
         self, session: tp.Any = None, **kwargs: tp.Any
     ) -> User:
-        """Get by outer_id or create user"""
+        """
+        Get by outer_id or create user
+        Существующий пользователь - один SELECT, новый создается через
+        INSERT ... ON CONFLICT DO NOTHING RETURNING без гонки между процессами
+        """
         if "outer_id" not in kwargs:
             raise Exception("User without outer_id is illegal")
         outer_id = str(kwargs["outer_id"])
@@ -86,24 +103,32 @@ class SQLAlchemyRepo(AbstractRepo):
         user = result.first()
 
         if user is None:
-            await session.execute(
-                users.insert(),
-                [
-                    dict(
-                        outer_id=outer_id,
-                        nickname=kwargs.get("nickname"),
-                        name=kwargs.get("name"),
-                        surname=kwargs.get("surname"),
-                        patronymic=kwargs.get("patronymic"),
-                        current_scenario_name=kwargs.get("current_scenario_name"),
-                        current_node_id=kwargs.get("current_node_id"),
-                    )
-                ],
-            )
-            result = await session.execute(
-                select(users).where(users.c.outer_id == outer_id)
+            values = dict(
+                outer_id=outer_id,
+                nickname=kwargs.get("nickname"),
+                name=kwargs.get("name"),
+                surname=kwargs.get("surname"),
+                patronymic=kwargs.get("patronymic"),
+                current_scenario_name=kwargs.get("current_scenario_name"),
+                current_node_id=kwargs.get("current_node_id"),
             )
-            user = result.first()
+            dialect_insert = _DIALECT_INSERTS.get(self.engine.dialect.name)
+            if dialect_insert is not None:
+                result = await session.execute(
+                    dialect_insert(users)
+                    .values(**values)
+                    .on_conflict_do_nothing(index_elements=[users.c.outer_id])
+                    .returning(*users.c)
+                )
+                user = result.first()
+            else:
+                await session.execute(users.insert(), [values])
+            if user is None:
+                # пользователя успели создать параллельно, или диалект без RETURNING
+                result = await session.execute(
+                    select(users).where(users.c.outer_id == outer_id)
+                )
+                user = result.first()
 
         return User(
             outer_id=outer_id,
@@ -116,34 +141,22 @@ class SQLAlchemyRepo(AbstractRepo):
         )
 
     @use_session
-    async def update_user(self, user: User, session: tp.Any = None) -> User:
-        """Update user fields"""
-        await session.execute(
-            sa.update(users)
-            .where(users.c.outer_id == user.outer_id)
-            .values(
-                nickname=user.nickname,
-                name=user.name,
-                surname=user.surname,
-                patronymic=user.patronymic,
-                current_scenario_name=user.current_scenario_name,
-                current_node_id=user.current_node_id,
+    async def update_user(
+        self,
+        user: User,
+        fields: tp.Sequence[str] | None = None,
+        session: tp.Any = None,
+    ) -> User:
+        """Update user fields (only listed fields if fields is set)"""
+        if fields is None:
+            fields = USER_FIELDS
+        if fields:
+            await session.execute(
+                sa.update(users)
+                .where(users.c.outer_id == user.outer_id)
+                .values({x: getattr(user, x) for x in fields})
             )
-        )
-        await session.commit()
-        result = await session.execute(
-            select(users).where(users.c.outer_id == user.outer_id)
-        )
-        user_from_db = result.first()
-        return User(
-            outer_id=user_from_db.outer_id,
-            nickname=user_from_db.nickname,
-            name=user_from_db.name,
-            surname=user_from_db.surname,
-            patronymic=user_from_db.patronymic,
-            current_scenario_name=user_from_db.current_scenario_name,
-            current_node_id=user_from_db.current_node_id,
-        )
+        return dataclasses.replace(user)
 
     # Context
     @use_session
@@ -226,6 +239,40 @@ class SQLAlchemyRepo(AbstractRepo):
         )
         await session.commit()
 
+    @use_session
+    async def commit_turn(
+        self,
+        user: User,
+        ctx_to_update: tp.Dict[str, str],
+        scenario_finished: bool,
+        session: tp.Any = None,
+    ) -> None:
+        """Apply turn delta and strip loop counters in one transaction"""
+        users_from_db = await session.execute(
+            select(users.c.id).where(users.c.outer_id == user.outer_id)
+        )
+        user_id = users_from_db.scalar_one()
+        result_ctx = await session.execute(
+            select(user_contexts.c.ctx).where(user_contexts.c.user == user_id)
+        )
+        result_ctx = result_ctx.first()
+
+        new_context = (result_ctx.ctx if result_ctx else None) or {}
+        new_context = new_context | ctx_to_update
+        if scenario_finished:
+            new_context = strip_loop_counters(new_context)
+        if result_ctx is None:
+            await session.execute(
+                user_contexts.insert(), [dict(user=user_id, ctx=new_context)]
+            )
+        else:
+            await session.execute(
+                sa.update(user_contexts)
+                .where(user_contexts.c.user == user_id)
+                .values(ctx=new_context)
+            )
+        await session.commit()
+
     @use_session
     async def get_user_context(
         self, user: User, session: tp.Any = None
@@ -300,7 +347,7 @@ class SQLAlchemyRepo(AbstractRepo):
             raise Exception(f"Project with name {project_name} not found")
 
         scenarios_from_db = await session.execute(
-            select(scenarios).where(
+            select(scenarios.c.scenario_bin).where(
                 scenarios.c.name == name, scenarios.c.project == project_from_db.name
             )
         )
@@ -309,48 +356,89 @@ class SQLAlchemyRepo(AbstractRepo):
             raise Exception(
                 f"Scenario with name {name} from project {project_name} not found"
             )
+        if scenario_from_db.scenario_bin is not None:
+            return load_scenario(scenario_from_db.scenario_bin)
 
-        need_scenario: Scenario = Scenario.from_dict(scenario_from_db.scenario_json)
+        # сценарии, загруженные до появления бинарного формата
+        scenarios_from_db = await session.execute(
+            select(scenarios.c.scenario_json).where(
+                scenarios.c.name == name, scenarios.c.project == project_from_db.name
+            )
+        )
+        need_scenario: Scenario = Scenario.from_dict(
+            scenarios_from_db.first().scenario_json
+        )
         return need_scenario
 
     @use_session
     async def add_scenario(
-        self, scenario: Scenario, project_name: str, session: tp.Any = None
+        self,
+        scenario: Scenario,
+        project_name: str,
+        session: tp.Any = None,
     ) -> None:
-        """Add scenario in repository"""
-        try:
-            await self.get_scenario_by_name(
-                name=scenario.name, project_name=project_name, session=session
+        """Add scenario in repository (хэш сбрасывается до записи текстов)"""
+        scenarios_from_db = await session.execute(
+            select(scenarios.c.id).where(
+                scenarios.c.name == scenario.name,
+                scenarios.c.project == project_name,
             )
+        )
+        scenario_from_db = scenarios_from_db.first()
+        if scenario_from_db is not None:
+            # обновляем на месте, чтобы не терять id сценария и его тексты
             await session.execute(
-                scenarios.delete().where(
-                    scenarios.c.name == scenario.name,
-                    scenarios.c.project == project_name,
-                )
-            )
-        except Exception as e:
-            logger.warning(e)
-        await session.execute(
-            scenarios.insert(),
-            [
-                dict(
-                    name=scenario.name,
-                    project=project_name,
+                sa.update(scenarios)
+                .where(scenarios.c.id == scenario_from_db.id)
+                .values(
                     scenario_json=scenario.to_dict(),
+                    scenario_bin=dump_scenario(scenario),
+                    content_hash=None,
                 )
-            ],
-        )
+            )
+        else:
+            await session.execute(
+                scenarios.insert(),
+                [
+                    dict(
+                        name=scenario.name,
+                        project=project_name,
+                        scenario_json=scenario.to_dict(),
+                        scenario_bin=dump_scenario(scenario),
+                    )
+                ],
+            )
         await session.commit()
 
+    @use_session
+    async def get_scenario_hash(
+        self, name: str, project_name: str, session: tp.Any = None
+    ) -> str | None:
+        """Get content hash of scenario sources, None if scenario is absent"""
+        scenarios_from_db = await session.execute(
+            select(scenarios.c.content_hash).where(
+                scenarios.c.name == name, scenarios.c.project == project_name
+            )
+        )
+        scenario_from_db = scenarios_from_db.first()
+        if scenario_from_db is None:
+            return None
+        content_hash: str | None = scenario_from_db.content_hash
+        return content_hash
+
     @use_session
     async def add_scenario_texts(
         self,
         scenario_name: str,
         project_name: str,
         texts: tp.Dict[str, str],
+        content_hash: str | None = None,
         session: tp.Any = None,
     ) -> None:
-        """Add texts for templating scenario"""
+        """
+        Add texts for templating scenario (only changed texts are written)
+        content_hash пишется в той же транзакции, что и тексты
+        """
         scenarios_from_db = await session.execute(
             select(scenarios).where(
                 scenarios.c.name == scenario_name, scenarios.c.project == project_name
@@ -362,26 +450,49 @@ class SQLAlchemyRepo(AbstractRepo):
                 f"Scenario with name {scenario_name} from project {project_name} not found"
             )
 
-        await session.execute(
-            scenario_texts.delete().where(
+        texts_from_db = await session.execute(
+            select(scenario_texts).where(
                 scenario_texts.c.scenario == scenario_from_db.id,
                 scenario_texts.c.project == project_name,
                 scenario_texts.c.template_name.in_(list(texts.keys())),
             )
         )
+        exists_texts = {x.template_name: x.template_value for x in texts_from_db}
+        to_insert = {k: v for k, v in texts.items() if k not in exists_texts}
+        to_update = {
+            k: v for k, v in texts.items() if k in exists_texts and exists_texts[k] != v
+        }
 
-        await session.execute(
-            scenario_texts.insert(),
-            [
-                dict(
-                    scenario=scenario_from_db.id,
-                    project=project_name,
-                    template_name=k,
-                    template_value=v,
+        if to_update:
+            await session.execute(
+                sa.update(scenario_texts)
+                .where(
+                    scenario_texts.c.scenario == scenario_from_db.id,
+                    scenario_texts.c.project == project_name,
+                    scenario_texts.c.template_name == sa.bindparam("name"),
                 )
-                for k, v in texts.items()
-            ],
-        )
+                .values(template_value=sa.bindparam("value")),
+                [dict(name=k, value=v) for k, v in to_update.items()],
+            )
+        if to_insert:
+            await session.execute(
+                scenario_texts.insert(),
+                [
+                    dict(
+                        scenario=scenario_from_db.id,
+                        project=project_name,
+                        template_name=k,
+                        template_value=v,
+                    )
+                    for k, v in to_insert.items()
+                ],
+            )
+        if content_hash is not None:
+            await session.execute(
+                sa.update(scenarios)
+                .where(scenarios.c.id == scenario_from_db.id)
+                .values(content_hash=content_hash)
+            )
 
     @use_session
     async def get_scenario_text(
@@ -416,6 +527,25 @@ class SQLAlchemyRepo(AbstractRepo):
         template_value: str = text.template_value
         return template_value
 
+    @use_session
+    async def get_scenario_texts(
+        self,
+        scenario_name: str,
+        project_name: str,
+        session: tp.Any = None,
+    ) -> tp.Dict[str, str]:
+        """Return all templates of scenario"""
+        texts_from_db = await session.execute(
+            select(scenario_texts.c.template_name, scenario_texts.c.template_value)
+            .join(scenarios, scenarios.c.id == scenario_texts.c.scenario)
+            .where(
+                scenarios.c.name == scenario_name,
+                scenarios.c.project == project_name,
+                scenario_texts.c.project == project_name,
+            )
+        )
+        return {x.template_name: x.template_value for x in texts_from_db}
+
     @use_session
     async def create_project(self, name: str, session: tp.Any = None) -> None:
         """Create project in db"""
@@ -1,14 +1,23 @@
+import dataclasses
+import time
 import typing as tp
 from abc import ABC
 from abc import abstractmethod
 
+from src import tracing
+from src.adapters.renderer import Renderer
 from src.adapters.repository import AbstractContextRepo
 from src.adapters.repository import AbstractRepo
+from src.adapters.user_lock import AbstractUserLock
+from src.adapters.user_lock import InMemoryUserLock
 from src.domain.events import EventProcessor
 from src.domain.model import Event
 from src.domain.model import InEvent
 from src.domain.model import NodeType
+from src.domain.model import OutEvent
 from src.domain.model import Scenario
+from src.domain.model import TrackedContext
+from src.domain.model import User
 
 
 class AbstractEPWrapper(ABC):
@@ -19,21 +28,33 @@ class AbstractEPWrapper(ABC):
         event_processor: EventProcessor,
         repo: AbstractRepo,
         ctx_repo: AbstractContextRepo,
+        user_lock: AbstractUserLock | None = None,
     ) -> None:
         self.event_processor = event_processor
         self.repo = repo
         self.ctx_repo = ctx_repo
+        self.user_lock = user_lock or InMemoryUserLock()
+        self.renderer = Renderer(repo=repo, ctx_repo=ctx_repo)
 
     @abstractmethod
     async def add_scenario(self, scenario_name: str, project_name: str) -> None:
         """Add scenario from repo into event processor"""
 
+    @abstractmethod
+    def register_scenario(self, scenario: Scenario, project_name: str) -> None:
+        """Put scenario into cache and start index of event processor"""
+
     @abstractmethod
     async def find(self, name: str, project_name: str) -> Scenario:
         """return self.scenarios[name]"""
 
     @abstractmethod
-    async def process_event(self, event: Event) -> tp.List[Event]:
+    async def process_event(
+        self,
+        event: Event,
+        emit: tp.Callable[[OutEvent, tp.Dict[str, str]], tp.Awaitable[None]]
+        | None = None,
+    ) -> tp.List[Event]:
         """Подмешивает контекст для исполнения сценария"""
 
     @abstractmethod
@@ -47,16 +68,31 @@ class EPWrapper(AbstractEPWrapper):
         event_processor: EventProcessor,
         repo: AbstractRepo,
         ctx_repo: AbstractContextRepo,
+        user_lock: AbstractUserLock | None = None,
     ) -> None:
-        super().__init__(event_processor=event_processor, repo=repo, ctx_repo=ctx_repo)
+        super().__init__(
+            event_processor=event_processor,
+            repo=repo,
+            ctx_repo=ctx_repo,
+            user_lock=user_lock,
+        )
+        self.scenarios: tp.Dict[tp.Tuple[str, str], Scenario] = {}
 
     async def add_scenario(self, scenario_name: str, project_name: str) -> None:
         """Add scenario from repo into event processor"""
         scenario = await self.repo.get_scenario_by_name(
             name=scenario_name, project_name=project_name
         )
+        self.register_scenario(scenario=scenario, project_name=project_name)
+
+    def register_scenario(self, scenario: Scenario, project_name: str) -> None:
+        """
+        Put scenario into cache and start index of event processor
+        Замена версии сценария атомарна: начатые ходы дорабатывают на старом объекте
+        """
         intents = [i.value for i in scenario.get_nodes_by_type(NodeType.inIntent)]
         phrases = [m.value for m in scenario.get_nodes_by_type(NodeType.matchText)]
+        self.scenarios[(project_name, scenario.name)] = scenario
         self.event_processor.add_scenario(
             scenario_name=scenario.name,
             project_name=project_name,
@@ -66,26 +102,97 @@ class EPWrapper(AbstractEPWrapper):
 
     async def find(self, name: str, project_name: str) -> Scenario:
         """return self.scenarios[name]"""
-        scenario = await self.repo.get_scenario_by_name(
-            name=name, project_name=project_name
-        )
+        scenario = self.scenarios.get((project_name, name))
+        if scenario is None:
+            scenario = await self.repo.get_scenario_by_name(
+                name=name, project_name=project_name
+            )
+            self.scenarios[(project_name, name)] = scenario
         return scenario
 
-    async def process_event(self, event: Event) -> tp.List[Event]:
-        """Подмешивает контекст для исполнения сценария в EventProcessor"""
-        if isinstance(event, InEvent):
-            ctx = await self.ctx_repo.get_user_context(event.user)
+    async def _refresh_user(self, user: User) -> None:
+        """
+        Состояние пользователя в событии могло устареть, пока ждали лок
+        (его успело поменять предыдущее событие этого же пользователя)
+        """
+        stored_user = await self.repo.get_or_create_user(**dataclasses.asdict(user))
+        user.current_scenario_name = stored_user.current_scenario_name
+        user.current_node_id = stored_user.current_node_id
+        user.mark_saved()
+
+    async def _process_turn(
+        self,
+        event: InEvent,
+        emit: tp.Callable[[OutEvent, tp.Dict[str, str]], tp.Awaitable[None]]
+        | None = None,
+    ) -> tp.List[OutEvent]:
+        with tracing.span("user_lookup"):
+            await self._refresh_user(event.user)
+        with tracing.span("context_load"):
+            ctx = TrackedContext(await self.ctx_repo.get_user_context(event.user))
+            ctx.attach(event.transport)
+        with tracing.span("scenario"):
             out_events, new_ctx = await self.event_processor.process_event(
                 event=event,
                 ctx=ctx,
                 scenario_getter=self.find,
+                emit=emit,
+            )
+        with tracing.span("persist") as persist_span:
+            changed_fields = event.user.changed_fields()
+            if changed_fields:
+                await self.repo.update_user(event.user, fields=changed_fields)
+                event.user.mark_saved()
+            ctx_delta = (
+                new_ctx.delta() if isinstance(new_ctx, TrackedContext) else new_ctx
             )
-            await self.repo.update_user(event.user)
-            await self.ctx_repo.update_user_context(event.user, new_ctx)
-            if event.user.current_scenario_name is None:
-                await self.ctx_repo.clear_user_context(event.user)
+            # счетчики циклов убираются при окончании сценария, если они есть
+            clear_loops = event.user.current_scenario_name is None and any(
+                "_loopCount" in k for k in ctx
+            )
+            if ctx_delta or clear_loops:
+                await self.ctx_repo.commit_turn(
+                    event.user, ctx_delta, scenario_finished=clear_loops
+                )
+            persist_span.set(user_fields=len(changed_fields), ctx_keys=len(ctx_delta))
+        with tracing.span("render"):
+            # события рендерятся один раз по контексту хода, подписчики шины берут готовые
             for e in out_events:
                 e.project_name = event.project_name
+            await self.renderer.render(out_events, ctx)
+        return out_events
+
+    async def process_event(
+        self,
+        event: Event,
+        emit: tp.Callable[[OutEvent, tp.Dict[str, str]], tp.Awaitable[None]]
+        | None = None,
+    ) -> tp.List[Event]:
+        """
+        Подмешивает контекст для исполнения сценария в EventProcessor
+        Весь ход (чтение контекста, сценарий, запись) идет под локом пользователя
+        Пишутся только изменения, ход без изменений не пишет ничего
+        emit получает исходящие события по мере исполнения, еще до записи хода
+        """
+        if isinstance(event, InEvent):
+            turn_emit = None
+            if emit is not None:
+                project_name, outer_emit = event.project_name, emit
+
+                async def turn_emit(e: OutEvent, ctx: tp.Dict[str, str]) -> None:
+                    e.project_name = project_name
+                    await self.renderer.render([e], ctx)
+                    await outer_emit(e, ctx)
+
+            with tracing.trace(
+                "turn", project=event.project_name, user=event.user.outer_id
+            ) as turn_span:
+                lock_start = time.perf_counter()
+                async with self.user_lock.lock(event.user):
+                    turn_span.set(
+                        lock_wait_ms=round((time.perf_counter() - lock_start) * 1000, 3)
+                    )
+                    out_events = await self._process_turn(event, turn_emit)
             return out_events  # type: ignore
         return []
 
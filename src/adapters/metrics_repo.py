@@ -0,0 +1,114 @@
+import typing as tp
+
+from src.adapters.repository import AbstractContextRepo
+from src.adapters.repository import AbstractRepo
+from src.domain.model import Scenario
+from src.domain.model import User
+from src.metrics import REPO_SECONDS
+from src.metrics import timer
+
+
+class MetricsRepo(AbstractRepo):
+    """Замер времени каждого вызова репозитория, подключается только при METRICS_ENABLED"""
+
+    def __init__(self, repo: AbstractRepo) -> None:
+        self.repo = repo
+        self.name = type(repo).__name__
+
+    async def prepare_db(self) -> None:
+        with timer(REPO_SECONDS, self.name, "prepare_db"):
+            await self.repo.prepare_db()
+
+    async def get_or_create_user(self, **kwargs: tp.Any) -> User:
+        with timer(REPO_SECONDS, self.name, "get_or_create_user"):
+            return await self.repo.get_or_create_user(**kwargs)
+
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
+        with timer(REPO_SECONDS, self.name, "update_user"):
+            return await self.repo.update_user(user, fields=fields)
+
+    async def get_user_history(self, user: User) -> tp.List[tp.Dict[str, str]]:
+        with timer(REPO_SECONDS, self.name, "get_user_history"):
+            return await self.repo.get_user_history(user)
+
+    async def add_to_user_history(
+        self, user: User, ids_pair: tp.Dict[str, str]
+    ) -> None:
+        with timer(REPO_SECONDS, self.name, "add_to_user_history"):
+            await self.repo.add_to_user_history(user, ids_pair)
+
+    async def get_scenario_by_name(self, name: str, project_name: str) -> Scenario:
+        with timer(REPO_SECONDS, self.name, "get_scenario_by_name"):
+            return await self.repo.get_scenario_by_name(name, project_name)
+
+    async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
+        with timer(REPO_SECONDS, self.name, "add_scenario"):
+            await self.repo.add_scenario(scenario, project_name)
+
+    async def get_scenario_hash(self, name: str, project_name: str) -> str | None:
+        with timer(REPO_SECONDS, self.name, "get_scenario_hash"):
+            return await self.repo.get_scenario_hash(name, project_name)
+
+    async def add_scenario_texts(
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
+    ) -> None:
+        with timer(REPO_SECONDS, self.name, "add_scenario_texts"):
+            await self.repo.add_scenario_texts(
+                scenario_name, project_name, texts, content_hash
+            )
+
+    async def get_scenario_text(
+        self, scenario_name: str, project_name: str, template_name: str
+    ) -> str:
+        with timer(REPO_SECONDS, self.name, "get_scenario_text"):
+            return await self.repo.get_scenario_text(
+                scenario_name, project_name, template_name
+            )
+
+    async def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        with timer(REPO_SECONDS, self.name, "get_scenario_texts"):
+            return await self.repo.get_scenario_texts(scenario_name, project_name)
+
+    async def create_project(self, name: str) -> None:
+        with timer(REPO_SECONDS, self.name, "create_project"):
+            await self.repo.create_project(name)
+
+    async def get_all_scenarios_metadata(self) -> tp.List[tp.Tuple[str, str]]:
+        with timer(REPO_SECONDS, self.name, "get_all_scenarios_metadata"):
+            return await self.repo.get_all_scenarios_metadata()
+
+
+class MetricsContextRepo(AbstractContextRepo):
+    """Замер времени вызовов репозитория контекстов"""
+
+    def __init__(self, ctx_repo: AbstractContextRepo) -> None:
+        self.ctx_repo = ctx_repo
+        self.name = type(ctx_repo).__name__
+
+    async def update_user_context(
+        self, user: User, ctx_to_update: tp.Dict[str, str]
+    ) -> None:
+        with timer(REPO_SECONDS, self.name, "update_user_context"):
+            await self.ctx_repo.update_user_context(user, ctx_to_update)
+
+    async def clear_user_context(self, user: User) -> None:
+        with timer(REPO_SECONDS, self.name, "clear_user_context"):
+            await self.ctx_repo.clear_user_context(user)
+
+    async def get_user_context(self, user: User) -> tp.Dict[str, str]:
+        with timer(REPO_SECONDS, self.name, "get_user_context"):
+            return await self.ctx_repo.get_user_context(user)
+
+    async def commit_turn(
+        self, user: User, ctx_to_update: tp.Dict[str, str], scenario_finished: bool
+    ) -> None:
+        with timer(REPO_SECONDS, self.name, "commit_turn"):
+            await self.ctx_repo.commit_turn(user, ctx_to_update, scenario_finished)
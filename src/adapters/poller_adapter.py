@@ -2,6 +2,7 @@ import typing as tp
 from abc import ABC
 from abc import abstractmethod
 
+from src import tracing
 from src.adapters.repository import AbstractRepo
 from src.domain.model import InEvent
 from src.domain.model import User
@@ -28,7 +29,10 @@ class PollerAdapter(AbstractPollerAdapter):
 
     async def message_handler(self, event: InEvent) -> None:
         """Process income message from poller"""
-        await self.bus.public_message(event)
+        with tracing.trace(
+            "poller_message", project=event.project_name, user=event.user.outer_id
+        ):
+            await self.bus.public_message(event)
 
     async def user_finder(self, user_dict: tp.Dict[str, str]) -> User:
         """Get from outer_id or create from dict user"""
@@ -7,44 +7,86 @@ from src import settings
 from src.adapters.repository import AbstractContextRepo
 from src.domain.model import User
 
+# KEYS[1] - хэш контекста, ARGV: закончен ли сценарий (0/1), ttl (0 - без ttl),
+# дальше пары ключ, значение (json). Значения в скрипте не разбираются: cjson в Redis
+# теряет точность чисел и путает пустые {} и [], поэтому хранятся как есть
+COMMIT_TURN_SCRIPT = """
+if #ARGV > 2 then
+    redis.call("HSET", KEYS[1], unpack(ARGV, 3))
+end
+if ARGV[1] == "1" then
+    for _, k in ipairs(redis.call("HKEYS", KEYS[1])) do
+        if string.find(k, "_loopCount", 1, true) then
+            redis.call("HDEL", KEYS[1], k)
+        end
+    end
+end
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call("EXPIRE", KEYS[1], ttl)
+end
+"""
+
 
 class RedisContextRepo(AbstractContextRepo):
-    def __init__(self) -> None:
-        self.redis = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    """
+    Контекст пользователя - хэш ctx:<outer_id>, значение каждого ключа в json
+    Контексты старого формата (строка json под outer_id) переносятся в хэш при первом чтении,
+    пока хэша еще нет (контекст читается в начале хода, до записи)
+    """
+
+    def __init__(self, client: redis.Redis | None = None) -> None:
+        self.redis = client or redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.ttl = settings.CONTEXT_TTL
+        self.commit_turn_script = self.redis.register_script(COMMIT_TURN_SCRIPT)
+
+    @staticmethod
+    def _key(user: User) -> str:
+        return f"ctx:{user.outer_id}"
 
     async def update_user_context(
         self, user: User, ctx_to_update: tp.Dict[str, str]
     ) -> None:
         """Update user fields"""
-        unparsed_ctx: str | None = await self.redis.get(user.outer_id)
-        if unparsed_ctx is None:
-            exists_ctx = {}
-        else:
-            exists_ctx = json.loads(unparsed_ctx)
-        new_context = exists_ctx | ctx_to_update
-        await self.redis.set(user.outer_id, json.dumps(new_context))
+        await self.commit_turn(user, ctx_to_update, scenario_finished=False)
 
     async def clear_user_context(
         self,
         user: User,
     ) -> None:
         """Clear user context (only loop counters)"""
-        unparsed_ctx: str | None = await self.redis.get(user.outer_id)
-        if unparsed_ctx is None:
-            exists_ctx = {}
-        else:
-            exists_ctx = json.loads(unparsed_ctx)
-        new_context = {}
-        for k in list(exists_ctx.keys()):
-            if "_loopCount" in k:
-                continue
-            new_context[k] = exists_ctx[k]
-        await self.redis.set(user.outer_id, json.dumps(new_context))
+        await self.commit_turn(user, {}, scenario_finished=True)
 
     async def get_user_context(self, user: User) -> tp.Dict[str, str]:
         """Get user context"""
-        unparsed_ctx: str | None = await self.redis.get(user.outer_id)
-        if unparsed_ctx is None:
+        unparsed_ctx = await self.redis.hgetall(self._key(user))
+        if unparsed_ctx:
+            return {k: json.loads(v) for k, v in unparsed_ctx.items()}
+        # старый формат проверяется, только пока хэша нет
+        legacy_ctx = await self.redis.get(user.outer_id)
+        if legacy_ctx is None:
             return {}
-        exists_ctx: tp.Dict[str, str] = json.loads(unparsed_ctx)
+        exists_ctx: tp.Dict[str, str] = json.loads(legacy_ctx)
+        await self._migrate(user, exists_ctx)
         return exists_ctx
+
+    async def _migrate(self, user: User, ctx: tp.Dict[str, str]) -> None:
+        """Перенос контекста старого формата в хэш"""
+        pipe = self.redis.pipeline(transaction=True)
+        if ctx:
+            pipe.hset(
+                self._key(user), mapping={k: json.dumps(v) for k, v in ctx.items()}
+            )
+            if self.ttl:
+                pipe.expire(self._key(user), self.ttl)
+        pipe.delete(user.outer_id)
+        await pipe.execute()
+
+    async def commit_turn(
+        self, user: User, ctx_to_update: tp.Dict[str, str], scenario_finished: bool
+    ) -> None:
+        """Apply turn delta, strip loop counters and set TTL in one round trip"""
+        args: tp.List[tp.Any] = [int(scenario_finished), self.ttl]
+        for k, v in ctx_to_update.items():
+            args += [k, json.dumps(v)]
+        await self.commit_turn_script(keys=[self._key(user)], args=args)
@@ -0,0 +1,62 @@
+import functools
+import typing as tp
+
+import jinja2 as j2
+
+from src.adapters.repository import AbstractContextRepo
+from src.adapters.repository import AbstractRepo
+from src.domain.model import OutEvent
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(source: str) -> j2.Template:
+    return j2.Template(source)
+
+
+class Renderer:
+    """
+    Подстановка шаблонов в исходящие события: текст и поля кнопок
+    Тексты сценария берутся одним запросом на сценарий, контекст - один на вызов.
+    Результат пишется в само событие с пометкой rendered, повторно оно не рендерится
+    """
+
+    def __init__(self, repo: AbstractRepo, ctx_repo: AbstractContextRepo) -> None:
+        self.repo = repo
+        self.ctx_repo = ctx_repo
+
+    async def render(
+        self, events: tp.Sequence[OutEvent], ctx: tp.Dict[str, str] | None = None
+    ) -> None:
+        """
+        :param events: события одного пользователя
+        :param ctx: контекст для шаблонов, если не задан - из репозитория контекстов
+        """
+        pending = [e for e in events if not e.rendered]
+        if not pending:
+            return
+        if ctx is None:
+            ctx = await self.ctx_repo.get_user_context(pending[0].user)
+        texts: tp.Dict[tp.Tuple[str, str], tp.Dict[str, str]] = {}
+        for event in pending:
+            scenario_texts: tp.Dict[str, str] = {}
+            if event.project_name is not None:
+                key = (event.project_name, event.scenario_name)
+                if key not in texts:
+                    texts[key] = await self.repo.get_scenario_texts(
+                        scenario_name=event.scenario_name,
+                        project_name=event.project_name,
+                    )
+                scenario_texts = texts[key]
+            event.text = self._render(event.text, scenario_texts, ctx)
+            for b in event.buttons or []:
+                b.text = self._render(b.text, scenario_texts, ctx)
+                b.text_to_bot = self._render(b.text_to_bot, scenario_texts, ctx)
+                b.text_to_chat = self._render(b.text_to_chat, scenario_texts, ctx)
+            event.rendered = True
+
+    @staticmethod
+    def _render(
+        template_name: str, texts: tp.Dict[str, str], ctx: tp.Dict[str, str]
+    ) -> str:
+        """Шаблон по имени из текстов сценария, без него имя считается самим шаблоном"""
+        return _compile(texts.get(template_name, template_name)).render(ctx)
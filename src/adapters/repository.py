@@ -21,8 +21,10 @@ class AbstractRepo(ABC):
         """Get by outer_id or create user"""
 
     @abstractmethod
-    async def update_user(self, user: User) -> User:
-        """Update user fields"""
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
+        """Update user fields (only listed fields if fields is set)"""
 
     @abstractmethod
     async def get_user_history(self, user: User) -> tp.List[tp.Dict[str, str]]:
@@ -40,13 +42,25 @@ class AbstractRepo(ABC):
 
     @abstractmethod
     async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
-        """Add scenario in repository"""
+        """Add scenario in repository (сохраненный хэш сбрасывается)"""
+
+    @abstractmethod
+    async def get_scenario_hash(self, name: str, project_name: str) -> str | None:
+        """Get content hash of scenario sources, None if scenario is absent"""
 
     @abstractmethod
     async def add_scenario_texts(
-        self, scenario_name: str, project_name: str, texts: tp.Dict[str, str]
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
     ) -> None:
-        """Add texts for templating scenario"""
+        """
+        Add texts for templating scenario (only changed texts are written)
+        content_hash - хэш исходников сценария, пишется вместе с текстами: пока тексты
+        не записаны, хэш не совпадает, и следующий запуск загрузит сценарий заново
+        """
 
     @abstractmethod
     async def get_scenario_text(
@@ -54,6 +68,12 @@ class AbstractRepo(ABC):
     ) -> str:
         """Return template value"""
 
+    @abstractmethod
+    async def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        """Return all templates of scenario"""
+
     @abstractmethod
     async def create_project(self, name: str) -> None:
         """Create project in db"""
@@ -82,6 +102,23 @@ class AbstractContextRepo(ABC):
     async def get_user_context(self, user: User) -> tp.Dict[str, str]:
         """Get user context"""
 
+    async def commit_turn(
+        self, user: User, ctx_to_update: tp.Dict[str, str], scenario_finished: bool
+    ) -> None:
+        """
+        Записать итог хода: изменения контекста и, если сценарий закончен, убрать счетчики циклов
+        Реализации делают это одной атомарной операцией, здесь - поведение по умолчанию
+        """
+        if ctx_to_update:
+            await self.update_user_context(user, ctx_to_update)
+        if scenario_finished:
+            await self.clear_user_context(user)
+
+
+def strip_loop_counters(ctx: tp.Dict[str, str]) -> tp.Dict[str, str]:
+    """Контекст без счетчиков циклов (они живут только до конца сценария)"""
+    return {k: v for k, v in ctx.items() if "_loopCount" not in k}
+
 
 class InMemoryRepo(AbstractRepo):
     def __init__(self) -> None:
@@ -100,7 +137,8 @@ class InMemoryRepo(AbstractRepo):
                 {
                     "name": "First scenario"
                     "scenario": {Scenario json},
-                    "texts": {"TEXT1": "some phrase", "TEXT2": "another phrase"}
+                    "texts": {"TEXT1": "some phrase", "TEXT2": "another phrase"},
+                    "content_hash": "sha256 of scenario sources" (or None)
                 },
                 {
                     "name": "Second scenario"
@@ -137,9 +175,16 @@ class InMemoryRepo(AbstractRepo):
             self.users[outer_id] = user
             return user
 
-    async def update_user(self, user: User) -> User:
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
         """Update user context"""
-        self.users[user.outer_id] = user
+        stored_user = self.users.get(user.outer_id)
+        if fields is None or stored_user is None:
+            self.users[user.outer_id] = user
+        else:
+            for field in fields:
+                setattr(stored_user, field, getattr(user, field))
         return self.users[user.outer_id]
 
     async def get_user_history(self, user: User) -> tp.List[tp.Dict[str, str]]:
@@ -164,15 +209,33 @@ class InMemoryRepo(AbstractRepo):
 
     async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
         """Add scenario in repository"""
+        for scenario_dict in self.projects[project_name]:
+            if scenario_dict["name"] == scenario.name:
+                scenario_dict["scenario"] = scenario.to_dict()
+                scenario_dict.pop("content_hash", None)
+                return
         self.projects[project_name].append({"name": scenario.name, "scenario": scenario.to_dict(), "texts": {}})  # type: ignore
 
+    async def get_scenario_hash(self, name: str, project_name: str) -> str | None:
+        """Get content hash of scenario sources, None if scenario is absent"""
+        for scenario_dict in self.projects.get(project_name, []):
+            if scenario_dict["name"] == name:
+                return scenario_dict.get("content_hash")  # type: ignore
+        return None
+
     async def add_scenario_texts(
-        self, scenario_name: str, project_name: str, texts: tp.Dict[str, str]
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
     ) -> None:
-        """Add texts for templating scenario"""
+        """Add texts for templating scenario (only changed texts are written)"""
         for scenario_dict in self.projects[project_name]:
             if scenario_dict["name"] == scenario_name:
-                scenario_dict["texts"] = texts
+                scenario_dict["texts"] = scenario_dict["texts"] | texts  # type: ignore
+                if content_hash is not None:
+                    scenario_dict["content_hash"] = content_hash
 
     async def get_scenario_text(
         self, scenario_name: str, project_name: str, template_name: str
@@ -183,10 +246,19 @@ class InMemoryRepo(AbstractRepo):
                 if scenario_dict["name"] == scenario_name:
                     return scenario_dict["texts"][template_name]  # type: ignore
         except KeyError:
-            logger.warning(f"Error, template {template_name} not found")
+            logger.warning("Error, template %s not found", template_name)
             return template_name
         raise Exception("Scenario was not found")
 
+    async def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        """Return all templates of scenario"""
+        for scenario_dict in self.projects[project_name]:
+            if scenario_dict["name"] == scenario_name:
+                return dict(scenario_dict["texts"])  # type: ignore
+        raise Exception("Scenario was not found")
+
     async def create_project(self, name: str) -> None:
         """Create project in db"""
         if name not in self.projects:
@@ -233,3 +305,12 @@ class InMemoryContextRepo(AbstractContextRepo):
     async def get_user_context(self, user: User) -> tp.Dict[str, str]:
         """Get user context"""
         return self.users_ctx[user.outer_id]
+
+    async def commit_turn(
+        self, user: User, ctx_to_update: tp.Dict[str, str], scenario_finished: bool
+    ) -> None:
+        """Apply turn delta and strip loop counters if scenario is finished"""
+        new_ctx = self.users_ctx[user.outer_id] | ctx_to_update
+        if scenario_finished:
+            new_ctx = strip_loop_counters(new_ctx)
+        self.users_ctx[user.outer_id] = new_ctx
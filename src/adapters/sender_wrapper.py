@@ -1,14 +1,15 @@
-import copy
 import typing as tp
 from abc import ABC
 from abc import abstractmethod
 
-import jinja2 as j2
-
+from src import tracing
+from src.adapters.renderer import Renderer
 from src.adapters.repository import AbstractContextRepo
 from src.adapters.repository import AbstractRepo
 from src.domain.model import Event
 from src.domain.model import OutEvent
+from src.metrics import SEND_SECONDS
+from src.metrics import timer
 from src.service_layer.sender import Sender
 
 
@@ -16,11 +17,17 @@ class AbstractSenderWrapper(ABC):
     """Хранит в себе историю отправленных сообщений пользователю"""
 
     def __init__(
-        self, sender: Sender, repo: AbstractRepo, ctx_repo: AbstractContextRepo
+        self,
+        sender: Sender,
+        repo: AbstractRepo,
+        ctx_repo: AbstractContextRepo,
+        project_name: str | None = None,
     ) -> None:
         self.sender = sender
         self.repo = repo
         self.ctx_repo = ctx_repo
+        # события только этого проекта (отправитель одного бота), None - все
+        self.project_name = project_name
 
     @abstractmethod
     async def process_templating(self, event: OutEvent) -> OutEvent:
@@ -41,49 +48,39 @@ class SenderWrapper(AbstractSenderWrapper):
         sender: Sender,
         repo: AbstractRepo,
         ctx_repo: AbstractContextRepo,
+        project_name: str | None = None,
     ) -> None:
-        super().__init__(sender=sender, repo=repo, ctx_repo=ctx_repo)
+        super().__init__(
+            sender=sender, repo=repo, ctx_repo=ctx_repo, project_name=project_name
+        )
+        self.renderer = Renderer(repo=repo, ctx_repo=ctx_repo)
 
     async def process_templating(self, event: OutEvent) -> OutEvent:
-        template_name = event.text
-        scenario_name = event.scenario_name
-        if event.project_name is not None:
-            template = await self.repo.get_scenario_text(
-                scenario_name=scenario_name,
-                template_name=template_name,
-                project_name=event.project_name,
-            )
-        else:
-            template = event.text
-        ctx = await self.ctx_repo.get_user_context(event.user)
-        jinja_template = j2.Template(template)
-        event.text = jinja_template.render(ctx)
-        if event.buttons is not None:
-            for b in event.buttons:
-                template_name = b.text
-                if event.project_name is not None:
-                    template = await self.repo.get_scenario_text(
-                        scenario_name=scenario_name,
-                        template_name=template_name,
-                        project_name=event.project_name,
-                    )
-                else:
-                    template = b.text
-                jinja_template = j2.Template(template)
-                b.text = jinja_template.render(ctx)
+        """Событие с хода приходит отрендеренным, рендер здесь - только для остальных"""
+        await self.renderer.render([event])
         return event
 
     async def process_event(self, event: Event) -> None:
         """Подмешивает историю и контекст для изменения сообщений"""
-        if isinstance(event, OutEvent) and event.to_process:
-            history = await self.repo.get_user_history(event.user)
-            templated_event = await self.process_templating(event)
-            outer_message_id = await self.sender.send(
-                event=templated_event, history=history
-            )
-            await self.repo.add_to_user_history(
-                event.user, {event.linked_node_id: outer_message_id}
-            )
+        if (
+            isinstance(event, OutEvent)
+            and event.to_process
+            and self.project_name in (None, event.project_name)
+        ):
+            with tracing.span("history_load"):
+                history = await self.repo.get_user_history(event.user)
+            with tracing.span("templating"):
+                templated_event = await self.process_templating(event)
+            with tracing.span("send", sender=type(self.sender).__name__), timer(
+                SEND_SECONDS, type(self.sender).__name__, event.project_name or ""
+            ):
+                outer_message_id = await self.sender.send(
+                    event=templated_event, history=history
+                )
+            with tracing.span("history_save"):
+                await self.repo.add_to_user_history(
+                    event.user, {event.linked_node_id: outer_message_id}
+                )
 
     async def handle_message(self, message: Event) -> tp.List[Event]:
         """Интерфейс для взаимодействия с шиной"""
@@ -0,0 +1,195 @@
+"""
+Неизменяемый снимок сценариев и их текстов в одном файле
+
+Файл отображается в память (mmap) только на чтение, поэтому несколько воркеров
+на одной машине разделяют одни и те же физические страницы, а старт воркера не требует
+чтения сценариев из БД
+
+Формат (версия 1):
+    заголовок  <4sBI: MAGIC, версия, длина индекса
+    индекс     JSON: [[проект, сценарий, смещение, длина, смещение текстов, длина текстов], ...]
+    данные     сценарии в бинарном формате (scenario_serializer) и тексты в JSON
+"""
+import json
+import mmap
+import os
+import struct
+import typing as tp
+
+from src.adapters.repository import AbstractRepo
+from src.domain.model import Scenario
+from src.domain.model import User
+from src.domain.scenario_serializer import dump_scenario
+from src.domain.scenario_serializer import load_scenario
+
+MAGIC = b"DCSN"
+VERSION = 1
+_HEADER = struct.Struct("<4sBI")
+
+
+async def build_snapshot(repo: AbstractRepo, path: str) -> None:
+    """Собирает снимок всех сценариев репозитория, файл заменяется атомарно"""
+    index = []
+    chunks = []
+    offset = 0
+    for project, name in await repo.get_all_scenarios_metadata():
+        scenario = await repo.get_scenario_by_name(name=name, project_name=project)
+        texts = await repo.get_scenario_texts(scenario_name=name, project_name=project)
+        scenario_data = dump_scenario(scenario)
+        texts_data = json.dumps(texts, ensure_ascii=False).encode()
+        index.append(
+            [
+                project,
+                name,
+                offset,
+                len(scenario_data),
+                offset + len(scenario_data),
+                len(texts_data),
+            ]
+        )
+        chunks += [scenario_data, texts_data]
+        offset += len(scenario_data) + len(texts_data)
+    index_data = json.dumps(index, ensure_ascii=False).encode()
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(index_data)))
+        f.write(index_data)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class ScenarioSnapshot:
+    """Чтение снимка сценариев через mmap"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)
+        magic, version, index_len = _HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"File {path} is not a scenario snapshot")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        data_offset = _HEADER.size + index_len
+        self.index: tp.Dict[tp.Tuple[str, str], tp.Tuple[int, int, int, int]] = {}
+        for project, name, offset, length, texts_offset, texts_length in json.loads(
+            bytes(self.data[_HEADER.size : data_offset])
+        ):
+            self.index[(project, name)] = (
+                data_offset + offset,
+                length,
+                data_offset + texts_offset,
+                texts_length,
+            )
+
+    def metadata(self) -> tp.List[tp.Tuple[str, str]]:
+        """Get all scenarios names and projects"""
+        return list(self.index.keys())
+
+    def _get_position(self, name: str, project_name: str) -> tp.Tuple[int, ...]:
+        try:
+            return self.index[(project_name, name)]
+        except KeyError:
+            raise Exception(
+                f"Scenario with name {name} from project {project_name} not found"
+            )
+
+    def get_scenario(self, name: str, project_name: str) -> Scenario:
+        offset, length, _, _ = self._get_position(name, project_name)
+        return load_scenario(self.data[offset : offset + length])
+
+    def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        _, _, offset, length = self._get_position(scenario_name, project_name)
+        texts: tp.Dict[str, str] = json.loads(
+            bytes(self.data[offset : offset + length])
+        )
+        return texts
+
+    def close(self) -> None:
+        self.data.release()
+        self.mmap.close()
+
+
+class SnapshotRepo(AbstractRepo):
+    """
+    Репозиторий, отдающий сценарии и тексты из снимка, остальное берется из вложенного репозитория
+    """
+
+    def __init__(self, repo: AbstractRepo, path: str) -> None:
+        self.repo = repo
+        self.path = path
+        self.snapshot = ScenarioSnapshot(path)
+        self.texts: tp.Dict[tp.Tuple[str, str], tp.Dict[str, str]] = {}
+
+    def reload(self) -> None:
+        """Переоткрыть файл снимка после его пересборки"""
+        old_snapshot = self.snapshot
+        self.snapshot = ScenarioSnapshot(self.path)
+        self.texts = {}
+        old_snapshot.close()
+
+    async def prepare_db(self) -> None:
+        await self.repo.prepare_db()
+
+    async def get_or_create_user(self, **kwargs: tp.Any) -> User:
+        return await self.repo.get_or_create_user(**kwargs)
+
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
+        return await self.repo.update_user(user, fields=fields)
+
+    async def get_user_history(self, user: User) -> tp.List[tp.Dict[str, str]]:
+        return await self.repo.get_user_history(user)
+
+    async def add_to_user_history(
+        self, user: User, ids_pair: tp.Dict[str, str]
+    ) -> None:
+        await self.repo.add_to_user_history(user, ids_pair)
+
+    async def get_scenario_by_name(self, name: str, project_name: str) -> Scenario:
+        return self.snapshot.get_scenario(name=name, project_name=project_name)
+
+    async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
+        await self.repo.add_scenario(scenario, project_name)
+
+    async def get_scenario_hash(self, name: str, project_name: str) -> str | None:
+        return await self.repo.get_scenario_hash(name, project_name)
+
+    async def add_scenario_texts(
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
+    ) -> None:
+        await self.repo.add_scenario_texts(
+            scenario_name, project_name, texts, content_hash
+        )
+
+    async def get_scenario_text(
+        self, scenario_name: str, project_name: str, template_name: str
+    ) -> str:
+        texts = await self.get_scenario_texts(scenario_name, project_name)
+        return texts.get(template_name, template_name)
+
+    async def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        key = (project_name, scenario_name)
+        if key not in self.texts:
+            self.texts[key] = self.snapshot.get_scenario_texts(
+                scenario_name=scenario_name, project_name=project_name
+            )
+        return self.texts[key]
+
+    async def create_project(self, name: str) -> None:
+        await self.repo.create_project(name)
+
+    async def get_all_scenarios_metadata(self) -> tp.List[tp.Tuple[str, str]]:
+        return self.snapshot.metadata()
@@ -0,0 +1,119 @@
+import dataclasses
+import time
+import typing as tp
+from collections import OrderedDict
+
+from src.adapters.repository import AbstractRepo
+from src.domain.model import USER_FIELDS
+from src.domain.model import Scenario
+from src.domain.model import User
+
+
+class CachedUserRepo(AbstractRepo):
+    """
+    Кэш пользователей (LRU + TTL) перед репозиторием, запись сквозная
+    В кэше лежат копии последнего записанного состояния, по ним update_user
+    определяет изменившиеся поля и пишет только их
+    Кэш локален для процесса: при нескольких процессах состояние может устаревать на время TTL
+    """
+
+    def __init__(self, repo: AbstractRepo, max_size: int, ttl: float) -> None:
+        self.repo = repo
+        self.max_size = max_size
+        self.ttl = ttl
+        # outer_id -> (время записи в кэш, копия пользователя)
+        self.users: OrderedDict[str, tp.Tuple[float, User]] = OrderedDict()
+
+    def _get_cached(self, outer_id: str) -> User | None:
+        cached = self.users.get(outer_id)
+        if cached is None:
+            return None
+        cached_at, user = cached
+        if time.monotonic() - cached_at > self.ttl:
+            del self.users[outer_id]
+            return None
+        self.users.move_to_end(outer_id)
+        return user
+
+    def _put(self, user: User) -> None:
+        self.users[user.outer_id] = (time.monotonic(), dataclasses.replace(user))
+        self.users.move_to_end(user.outer_id)
+        while len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+
+    async def prepare_db(self) -> None:
+        await self.repo.prepare_db()
+
+    async def get_or_create_user(self, **kwargs: tp.Any) -> User:
+        if "outer_id" not in kwargs:
+            raise Exception("User without outer_id is illegal")
+        user = self._get_cached(str(kwargs["outer_id"]))
+        if user is None:
+            user = await self.repo.get_or_create_user(**kwargs)
+            self._put(user)
+        return dataclasses.replace(user)
+
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
+        if fields is None:
+            fields = USER_FIELDS
+        cached = self._get_cached(user.outer_id)
+        if cached is not None:
+            fields = [x for x in fields if getattr(user, x) != getattr(cached, x)]
+        if not fields:
+            return dataclasses.replace(user)
+        updated_user = await self.repo.update_user(user, fields=fields)
+        if cached is not None:
+            # в кэш попадают только записанные поля, остальные остаются как в хранилище
+            written = {x: getattr(updated_user, x) for x in fields}
+            self._put(dataclasses.replace(cached, **written))
+        elif set(fields) == set(USER_FIELDS):
+            self._put(updated_user)
+        return dataclasses.replace(updated_user)
+
+    async def get_user_history(self, user: User) -> tp.List[tp.Dict[str, str]]:
+        return await self.repo.get_user_history(user)
+
+    async def add_to_user_history(
+        self, user: User, ids_pair: tp.Dict[str, str]
+    ) -> None:
+        await self.repo.add_to_user_history(user, ids_pair)
+
+    async def get_scenario_by_name(self, name: str, project_name: str) -> Scenario:
+        return await self.repo.get_scenario_by_name(name, project_name)
+
+    async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
+        await self.repo.add_scenario(scenario, project_name)
+
+    async def get_scenario_hash(self, name: str, project_name: str) -> str | None:
+        return await self.repo.get_scenario_hash(name, project_name)
+
+    async def add_scenario_texts(
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
+    ) -> None:
+        await self.repo.add_scenario_texts(
+            scenario_name, project_name, texts, content_hash
+        )
+
+    async def get_scenario_text(
+        self, scenario_name: str, project_name: str, template_name: str
+    ) -> str:
+        return await self.repo.get_scenario_text(
+            scenario_name, project_name, template_name
+        )
+
+    async def get_scenario_texts(
+        self, scenario_name: str, project_name: str
+    ) -> tp.Dict[str, str]:
+        return await self.repo.get_scenario_texts(scenario_name, project_name)
+
+    async def create_project(self, name: str) -> None:
+        await self.repo.create_project(name)
+
+    async def get_all_scenarios_metadata(self) -> tp.List[tp.Tuple[str, str]]:
+        return await self.repo.get_all_scenarios_metadata()
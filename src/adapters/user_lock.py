@@ -0,0 +1,73 @@
+import asyncio
+import typing as tp
+from abc import ABC
+from abc import abstractmethod
+from contextlib import asynccontextmanager
+
+import redis.asyncio as redis
+
+from src import settings
+from src.domain.model import User
+
+
+class AbstractUserLock(ABC):
+    """
+    Последовательная обработка событий одного пользователя
+    Разные пользователи обрабатываются конкурентно
+    """
+
+    @abstractmethod
+    def lock(self, user: User) -> tp.AsyncContextManager[None]:
+        """Context manager holding lock of user for the whole turn"""
+
+
+class InMemoryUserLock(AbstractUserLock):
+    """Блокировка в пределах одного процесса"""
+
+    def __init__(self) -> None:
+        # outer_id -> (лок, количество ожидающих и владельца)
+        self.locks: tp.Dict[str, tp.Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def lock(self, user: User) -> tp.AsyncIterator[None]:
+        key = user.outer_id
+        user_lock, waiters = self.locks.get(key, (asyncio.Lock(), 0))
+        self.locks[key] = (user_lock, waiters + 1)
+        try:
+            async with user_lock:
+                yield
+        finally:
+            user_lock, waiters = self.locks[key]
+            if waiters == 1:
+                # локи не копятся для пользователей, которые больше не пишут
+                del self.locks[key]
+            else:
+                self.locks[key] = (user_lock, waiters - 1)
+
+
+class RedisUserLock(AbstractUserLock):
+    """
+    Блокировка между процессами через Redis
+    Внутри процесса ожидающие сначала встают в локальную очередь, чтобы не опрашивать Redis
+    """
+
+    def __init__(
+        self,
+        timeout: float | None = None,
+        blocking_timeout: float | None = None,
+    ) -> None:
+        self.redis = redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.local = InMemoryUserLock()
+        # время жизни лока, если процесс-владелец упал
+        self.timeout = timeout or settings.USER_LOCK_TIMEOUT
+        self.blocking_timeout = blocking_timeout or settings.USER_LOCK_TIMEOUT
+
+    @asynccontextmanager
+    async def lock(self, user: User) -> tp.AsyncIterator[None]:
+        async with self.local.lock(user):
+            async with self.redis.lock(
+                f"user_lock:{user.outer_id}",
+                timeout=self.timeout,
+                blocking_timeout=self.blocking_timeout,
+            ):
+                yield
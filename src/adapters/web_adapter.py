@@ -1,16 +1,20 @@
+import asyncio
 import json
 import typing as tp
 from abc import ABC
 from abc import abstractmethod
 
-import jinja2 as j2
-
+from src import settings
+from src import tracing
 from src.adapters.ep_wrapper import AbstractEPWrapper
+from src.adapters.renderer import Renderer
 from src.adapters.repository import AbstractContextRepo
 from src.adapters.repository import AbstractRepo
 from src.domain.model import InEvent
 from src.domain.model import OutEvent
+from src.domain.model import User
 from src.service_layer.message_bus import MessageBus
+from src.settings import logger
 
 
 class AbstractWebAdapter(ABC):
@@ -32,6 +36,46 @@ class AbstractWebAdapter(ABC):
     ) -> tp.Dict[str, tp.Any]:
         """Process income message from poller"""
 
+    async def batch_handler(
+        self, unparsed_events: tp.List[tp.Dict[str, tp.Any]]
+    ) -> tp.List[tp.Dict[str, tp.Any]]:
+        """
+        Пачка сообщений разных пользователей: пользователи обрабатываются параллельно
+        (не больше WEB_BATCH_CONCURRENCY), сообщения одного пользователя - по порядку.
+        Результаты в порядке входа, ошибка одного сообщения не прерывает остальные
+        """
+        results: tp.List[tp.Dict[str, tp.Any]] = [{} for _ in unparsed_events]
+        by_user: tp.Dict[str, tp.List[int]] = {}
+        for i, unparsed_event in enumerate(unparsed_events):
+            by_user.setdefault(str(unparsed_event.get("user_id")), []).append(i)
+        semaphore = asyncio.Semaphore(settings.WEB_BATCH_CONCURRENCY)
+
+        async def process_user(indexes: tp.List[int]) -> None:
+            async with semaphore:
+                for i in indexes:
+                    unparsed_event = unparsed_events[i]
+                    try:
+                        results[i] = await self.message_handler(unparsed_event)
+                    except Exception as e:
+                        logger.exception("batch message failed: %s", unparsed_event)
+                        results[i] = {
+                            "user_id": unparsed_event.get("user_id"),
+                            "error": repr(e),
+                        }
+
+        await asyncio.gather(*(process_user(x) for x in by_user.values()))
+        return results
+
+    @abstractmethod
+    async def open_session(self, unparsed_event: tp.Dict[str, tp.Any]) -> "WebSession":
+        """Привязка пользователя к постоянному подключению (WebSocket)"""
+
+    @abstractmethod
+    def stream_handler(
+        self, unparsed_event: tp.Dict[str, tp.Any]
+    ) -> tp.AsyncIterator[tp.Dict[str, tp.Any]]:
+        """Ответы по одному исходящему событию, по мере исполнения хода"""
+
 
 class WebAdapter(AbstractWebAdapter):
     def __init__(
@@ -42,58 +86,18 @@ class WebAdapter(AbstractWebAdapter):
         ep_wrapped: AbstractEPWrapper,
     ) -> None:
         super().__init__(repo=repo, ctx_repo=ctx_repo, bus=bus, ep_wrapped=ep_wrapped)
+        self.renderer = Renderer(repo=repo, ctx_repo=ctx_repo)
+        # ходы потоковых запросов, клиент которых отключился: дорабатывают в фоне
+        self._detached_turns: tp.Set[asyncio.Task[None]] = set()
 
-    async def process_templating(self, event: OutEvent) -> OutEvent:
-        template_name = event.text
-        scenario_name = event.scenario_name
-        if event.project_name is not None:
-            template = await self.repo.get_scenario_text(
-                scenario_name=scenario_name,
-                template_name=template_name,
-                project_name=event.project_name,
-            )
-        else:
-            template = event.text
-        ctx = await self.ctx_repo.get_user_context(event.user)
-        jinja_template = j2.Template(template)
-        event.text = jinja_template.render(ctx)
-        if event.buttons is not None:
-            for b in event.buttons:
-                template_name = b.text
-                if event.project_name is not None:
-                    template = await self.repo.get_scenario_text(
-                        scenario_name=scenario_name,
-                        template_name=template_name,
-                        project_name=event.project_name,
-                    )
-                else:
-                    template = b.text
-                jinja_template = j2.Template(template)
-                b.text = jinja_template.render(ctx)
-
-                template_name = b.text_to_bot
-                if event.project_name is not None:
-                    template = await self.repo.get_scenario_text(
-                        scenario_name=scenario_name,
-                        template_name=template_name,
-                        project_name=event.project_name,
-                    )
-                else:
-                    template = b.text_to_bot
-                jinja_template = j2.Template(template)
-                b.text_to_bot = jinja_template.render(ctx)
-
-                template_name = b.text_to_chat
-                if event.project_name is not None:
-                    template = await self.repo.get_scenario_text(
-                        scenario_name=scenario_name,
-                        template_name=template_name,
-                        project_name=event.project_name,
-                    )
-                else:
-                    template = b.text_to_chat
-                jinja_template = j2.Template(template)
-                b.text_to_chat = jinja_template.render(ctx)
+    async def process_templating(
+        self, event: OutEvent, ctx: tp.Dict[str, str] | None = None
+    ) -> OutEvent:
+        """
+        Событие с хода приходит отрендеренным (EPWrapper), рендер здесь - только
+        для остальных; ctx - контекст на момент события, иначе из репозитория
+        """
+        await self.renderer.render([event], ctx)
         return event
 
     @staticmethod
@@ -104,6 +108,16 @@ class WebAdapter(AbstractWebAdapter):
         self, unparsed_event: tp.Dict[str, tp.Any]
     ) -> tp.Dict[str, tp.Any]:
         """Process income message from poller"""
+        with tracing.trace(
+            "web_message",
+            project=unparsed_event.get("project_name"),
+            user=unparsed_event.get("user_id"),
+        ):
+            return await self._handle_message(unparsed_event)
+
+    async def _handle_message(
+        self, unparsed_event: tp.Dict[str, tp.Any]
+    ) -> tp.Dict[str, tp.Any]:
         """
         "project_name": "WEB_UL",
         "integration_url": "https://test-delo.ru",
@@ -111,71 +125,202 @@ class WebAdapter(AbstractWebAdapter):
         "user_id": "13517462",
         "text": "Мой тариф",
         "intent": "",
-        "security": 
+        "security":
         {
-            "headers": 
+            "headers":
                         [
-                            ["Cookie", "JSESSIONID=8558c932-6777-46b5-9504-97a711cc9203"], 
-                            [   
-                                "User-Agent", 
+                            ["Cookie", "JSESSIONID=8558c932-6777-46b5-9504-97a711cc9203"],
+                            [
+                                "User-Agent",
                                 "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.131 Safari/537.36"
                             ]
                         ]
         }
         """
-        user_outer_id = unparsed_event["user_id"]
-        text = unparsed_event["text"]
-        intent = unparsed_event.get("intent")
-        project_name = unparsed_event["project_name"]
-        headers = self._get_headers(unparsed_event["security"]["headers"])
-        integration_url = unparsed_event["integration_url"]
-        user = await self.repo.get_or_create_user(outer_id=user_outer_id)
-        await self.ctx_repo.update_user_context(
-            user,
-            {
-                "__headers__": json.dumps(headers),
-                "__integration_url__": integration_url,
-            },
-        )
-        message = InEvent(
-            user=user,
-            text=text,
-            intent=intent,
-            to_process=False,
-            project_name=project_name,
-        )
+        message = await self._in_event(unparsed_event)
         await self.bus.public_message(message=message)
         events: tp.List[OutEvent] = await self.ep.process_event(message)  # type: ignore
         new_events = []
         for e in events:
-            templated_event = await self.process_templating(e)
+            with tracing.span("templating"):
+                templated_event = await self.process_templating(e)
             e.to_process = False
             await self.bus.public_message(message=e)
             new_events.append(templated_event)
         results = []
         for i in new_events:
+            results += self._transform(i)
+        transformed_events = {"user_id": message.user.outer_id, "events": results}
+        return transformed_events
+
+    async def _in_event(self, unparsed_event: tp.Dict[str, tp.Any]) -> InEvent:
+        text = unparsed_event["text"]
+        intent = unparsed_event.get("intent")
+        project_name = unparsed_event["project_name"]
+        transport = self._transport(unparsed_event)
+        with tracing.span("user_lookup"):
+            user = await self.repo.get_or_create_user(
+                outer_id=unparsed_event["user_id"]
+            )
+        return InEvent(
+            user=user,
+            text=text,
+            intent=intent,
+            to_process=False,
+            project_name=project_name,
+            transport=transport,
+        )
+
+    def _transport(self, unparsed_event: tp.Dict[str, tp.Any]) -> tp.Dict[str, str]:
+        """Заголовки и integration_url запроса, живут только в контексте хода"""
+        headers = self._get_headers(unparsed_event["security"]["headers"])
+        return {
+            "__headers__": json.dumps(headers),
+            "__integration_url__": unparsed_event["integration_url"],
+        }
+
+    @staticmethod
+    def _transform(event: OutEvent) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Исходящее событие в формат ответа: текст и кнопки функциями"""
+        results: tp.List[tp.Dict[str, tp.Any]] = [
+            {
+                "type": "text",
+                "project_name": event.project_name,
+                "intent_name": event.scenario_name,
+                "text": event.text,
+            }
+        ]
+        for b in event.buttons or []:
             results.append(
                 {
-                    "type": "text",
-                    "project_name": project_name,
-                    "intent_name": i.scenario_name,
-                    "text": i.text,
+                    "project_name": event.project_name,
+                    "intent_name": event.scenario_name,
+                    "function": "button",
+                    "params": {
+                        "text_button": b.text,
+                        "text_to_chat": b.text_to_chat,
+                        "text_to_bot": b.text_to_bot,
+                    },
+                    "type": "function",
                 }
             )
-            if i.buttons:
-                for b in i.buttons:
-                    results.append(
-                        {
-                            "project_name": project_name,
-                            "intent_name": i.scenario_name,
-                            "function": "button",
-                            "params": {
-                                "text_button": b.text,
-                                "text_to_chat": b.text_to_chat,
-                                "text_to_bot": b.text_to_bot,
-                            },
-                            "type": "function",
-                        }
-                    )
-        transformed_events = {"user_id": user.outer_id, "events": results}
-        return transformed_events
+        return results
+
+    async def stream_handler(
+        self, unparsed_event: tp.Dict[str, tp.Any]
+    ) -> tp.AsyncIterator[tp.Dict[str, tp.Any]]:
+        """
+        Потоковый ответ: каждое исходящее событие отдается, как только нода исполнена
+        и шаблон отрендерен, не дожидаясь конца хода (например, remoteRequest дальше).
+        Последняя запись - {"done": true} или {"error": ...}, если ход упал
+        """
+        user_id = unparsed_event.get("user_id")
+        try:
+            message = await self._in_event(unparsed_event)
+            async for event in self._stream_turn(message, "web_stream"):
+                yield {"user_id": user_id, "events": self._transform(event)}
+        except Exception as e:
+            logger.exception("stream message failed: %s", unparsed_event)
+            yield {"user_id": user_id, "error": repr(e)}
+            return
+        yield {"user_id": user_id, "done": True}
+
+    async def _stream_turn(
+        self, message: InEvent, trace_name: str
+    ) -> tp.AsyncIterator[OutEvent]:
+        """Ход с отдачей отрендеренных исходящих событий по мере исполнения"""
+        queue: asyncio.Queue[tp.Tuple[OutEvent, tp.Dict[str, str]] | None]
+        queue = asyncio.Queue()
+
+        async def emit(event: OutEvent, ctx: tp.Dict[str, str]) -> None:
+            await queue.put((event, ctx))
+
+        async def run_turn() -> None:
+            try:
+                with tracing.trace(
+                    trace_name, project=message.project_name, user=message.user.outer_id
+                ):
+                    await self.bus.public_message(message=message)
+                    await self.ep.process_event(message, emit=emit)
+            finally:
+                await queue.put(None)
+
+        turn = asyncio.create_task(run_turn())
+        try:
+            while (item := await queue.get()) is not None:
+                event, ctx = item
+                templated_event = await self.process_templating(event, ctx)
+                event.to_process = False
+                await self.bus.public_message(message=event)
+                yield templated_event
+            await turn
+        finally:
+            if not turn.done():
+                # клиент отключился посреди хода: ход доводится до конца без отдачи
+                self._detached_turns.add(turn)
+                turn.add_done_callback(self._detached_turns.discard)
+
+    async def open_session(self, unparsed_event: tp.Dict[str, tp.Any]) -> "WebSession":
+        transport = self._transport(unparsed_event)
+        with tracing.span("user_lookup"):
+            user = await self.repo.get_or_create_user(
+                outer_id=unparsed_event["user_id"]
+            )
+        return WebSession(
+            adapter=self,
+            user=user,
+            project_name=unparsed_event["project_name"],
+            transport=transport,
+        )
+
+
+class WebSession:
+    """
+    Постоянное подключение веб-чата: пользователь находится и заголовки разбираются
+    один раз на подключение, а не на каждое сообщение
+    """
+
+    def __init__(
+        self,
+        adapter: WebAdapter,
+        user: User,
+        project_name: str,
+        transport: tp.Dict[str, str],
+    ) -> None:
+        self.adapter = adapter
+        self.user = user
+        self.project_name = project_name
+        self.transport = transport
+
+    async def handle(
+        self, unparsed_event: tp.Dict[str, tp.Any]
+    ) -> tp.AsyncIterator[tp.Dict[str, tp.Any]]:
+        """
+        Сообщение {"text", "intent"}, при наличии security и integration_url
+        они заменяют заданные при подключении. Кадр на каждое исходящее событие: message_id -
+        нода сообщения, edit - нода сообщения, которое надо заменить этим
+        """
+        user_id = self.user.outer_id
+        try:
+            if "security" in unparsed_event and "integration_url" in unparsed_event:
+                self.transport = self.adapter._transport(unparsed_event)
+            message = InEvent(
+                user=self.user,
+                text=unparsed_event.get("text"),
+                intent=unparsed_event.get("intent"),
+                to_process=False,
+                project_name=self.project_name,
+                transport=self.transport,
+            )
+            async for event in self.adapter._stream_turn(message, "web_socket"):
+                yield {
+                    "user_id": user_id,
+                    "message_id": event.linked_node_id,
+                    "edit": event.node_to_edit,
+                    "events": self.adapter._transform(event),
+                }
+        except Exception as e:
+            logger.exception("socket message failed: %s", unparsed_event)
+            yield {"user_id": user_id, "error": repr(e)}
+            return
+        yield {"user_id": user_id, "done": True}
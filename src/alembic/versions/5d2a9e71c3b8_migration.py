@@ -0,0 +1,29 @@
+"""migration
+
+Revision ID: 5d2a9e71c3b8
+Revises: 8b5e0d4c27f6
+Create Date: 2026-10-19 11:02:17.604381
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5d2a9e71c3b8"
+down_revision = "8b5e0d4c27f6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # дубли контекстов одного пользователя: остается последняя запись
+    op.execute(
+        "DELETE FROM user_contexts WHERE id NOT IN "
+        '(SELECT max(id) FROM user_contexts GROUP BY "user")'
+    )
+    op.create_index("ix_user_contexts_user", "user_contexts", ["user"], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_user_contexts_user", table_name="user_contexts")
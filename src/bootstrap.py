@@ -1,31 +1,119 @@
 import asyncio
+import hashlib
 import importlib
 import json
 import os
+import sys
 import typing as tp
 
 from aiogram import Bot
+from aiogram.bot.api import TELEGRAM_PRODUCTION
+from aiogram.bot.api import TelegramAPIServer
+from fastapi import FastAPI
 
 from src import settings
+from src import tracing
 from src.adapters.ep_wrapper import AbstractEPWrapper
+from src.adapters.metrics_repo import MetricsContextRepo
+from src.adapters.metrics_repo import MetricsRepo
 from src.adapters.poller_adapter import AbstractPollerAdapter
 from src.adapters.repository import AbstractContextRepo
 from src.adapters.repository import AbstractRepo
 from src.adapters.sender_wrapper import AbstractSenderWrapper
+from src.adapters.snapshot import SnapshotRepo
+from src.adapters.snapshot import build_snapshot
+from src.adapters.user_cache import CachedUserRepo
+from src.adapters.user_lock import AbstractUserLock
+from src.adapters.user_lock import InMemoryUserLock
+from src.adapters.user_lock import RedisUserLock
 from src.adapters.web_adapter import AbstractWebAdapter
 from src.domain.events import EventProcessor
+from src.domain.model import InEvent
+from src.domain.model import OutEvent
 from src.domain.model import Scenario
 from src.domain.scenario_loader import Parser
 from src.domain.scenario_loader import XMLParser
+from src.domain.scenario_validator import ScenarioValidator
 from src.entrypoints.poller import Poller
+from src.entrypoints.poller import TgPoller
+from src.entrypoints.poller import TgWebhook
+from src.entrypoints.scenario_watcher import ScenarioWatcher
 from src.entrypoints.web import Web
+from src.log import setup_logging
 from src.service_layer.message_bus import MessageBus
 from src.service_layer.sender import Sender
+from src.service_layer.worker_pool import KeyedWorkerPool
 from src.settings import logger
 
+WEB_WORKER_COMPONENTS_ENV = "WEB_WORKER_COMPONENTS"
 
-async def upload_scenarios_to_repo(repo: AbstractRepo, parser: Parser) -> None:
-    tree = os.walk("./src/scenarios")
+
+def scenario_hash(path: str) -> str:
+    """Хэш содержимого папки сценария (имена и содержимое файлов, без __pycache__)"""
+    digest = hashlib.sha256()
+    # обход сверху вниз: dirs правится на месте, чтобы walk не заходил в __pycache__
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(x for x in dirs if x != "__pycache__")
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+async def upload_scenario(
+    repo: AbstractRepo,
+    parser: Parser,
+    project: str,
+    scenario: str,
+    scenarios_path: str = "./src/scenarios",
+) -> bool:
+    """
+    Загрузка одного сценария проекта в репозиторий
+    :return: True если сценарий изменился и был загружен
+    """
+    scenario_path = f"{scenarios_path}/{project}/{scenario}"
+    content_hash = scenario_hash(scenario_path)
+    stored_hash = await repo.get_scenario_hash(name=scenario, project_name=project)
+    if stored_hash == content_hash:
+        logger.debug("scenario %s/%s not changed, skip", project, scenario)
+        return False
+    scenario_files = os.listdir(scenario_path)
+    logger.debug("scenario %s/%s files: %s", project, scenario, scenario_files)
+
+    if "scenario.py" in scenario_files:
+        module_name = f"src.scenarios.{project}.{scenario}.scenario"
+        if module_name in sys.modules:
+            make_scenario_file = importlib.reload(sys.modules[module_name])
+        else:
+            make_scenario_file = importlib.import_module(module_name)
+        created_scenario = make_scenario_file.make_scenario()
+    elif "scenario.xml" in scenario_files:
+        root_id, nodes = parser.parse(input_stuff=f"{scenario_path}/scenario.xml")
+        parsed_nodes = {x.element_id: x for x in nodes}
+        created_scenario = Scenario(name=scenario, root_id=root_id, nodes=parsed_nodes)
+    else:
+        return False
+    ScenarioValidator().validate(created_scenario)
+    with open(f"{scenario_path}/text_templates.json", "r") as f:
+        text_dict = json.load(f)
+    # хэш пишется вместе с текстами: если тексты не записались, при следующем запуске
+    # хэш не совпадет и сценарий загрузится заново
+    await repo.add_scenario(scenario=created_scenario, project_name=project)
+    await repo.add_scenario_texts(
+        scenario_name=scenario,
+        project_name=project,
+        texts=text_dict,
+        content_hash=content_hash,
+    )
+    return True
+
+
+async def upload_scenarios_to_repo(
+    repo: AbstractRepo, parser: Parser, scenarios_path: str = "./src/scenarios"
+) -> None:
+    tree = os.walk(scenarios_path)
     paths = []
     for item in tree:
         if "__pycache__" not in item[0]:
@@ -33,51 +121,24 @@ async def upload_scenarios_to_repo(repo: AbstractRepo, parser: Parser) -> None:
 
     projects = paths[0][1]
     projects = [x for x in projects if x != "__pycache__"]
-    logger.info(f"found projects: {projects}")
+    logger.info("found projects: %s", projects)
 
     for project in projects:
         await repo.create_project(project)
-        tree = os.walk(f"./src/scenarios/{project}")
+        tree = os.walk(f"{scenarios_path}/{project}")
         for item in tree:
             scenario_paths = item[1]
             scenario_paths = [x for x in scenario_paths if x != "__pycache__"]
             for scenario in scenario_paths:
-                logger.info(f"current scenario: {scenario}")
-                tree = os.walk(f"./src/scenarios/{project}/{scenario}")
-                for stage in tree:
-                    scenario_files = stage[2]
-                    logger.info(f"scenario files: {scenario_files}")
-
-                    if "scenario.py" in scenario_files:
-                        make_scenario_file = importlib.import_module(
-                            f"src.scenarios.{project}.{scenario}.scenario"
-                        )
-                        created_scenario = make_scenario_file.make_scenario()
-                    elif "scenario.xml" in scenario_files:
-                        root_id, nodes = parser.parse(
-                            input_stuff=f"./src/scenarios/{project}/{scenario}/scenario.xml"
-                        )
-                        parsed_nodes = {x.element_id: x for x in nodes}
-                        created_scenario = Scenario(
-                            name=scenario, root_id=root_id, nodes=parsed_nodes
-                        )
-                    else:
-                        continue
-                    with open(
-                        f"./src/scenarios/{project}/{scenario}/text_templates.json", "r"
-                    ) as f:
-                        text_dict = json.load(f)
-                    await repo.add_scenario(
-                        scenario=created_scenario, project_name=project
-                    )
-                    await repo.add_scenario_texts(
-                        scenario_name=scenario, project_name=project, texts=text_dict
-                    )
-
-                    break
-                logger.info("######")
+                logger.debug("current scenario: %s/%s", project, scenario)
+                await upload_scenario(
+                    repo=repo,
+                    parser=parser,
+                    project=project,
+                    scenario=scenario,
+                    scenarios_path=scenarios_path,
+                )
             break
-        logger.info("*****")
 
 
 async def download_scenarios_to_ep(
@@ -88,6 +149,148 @@ async def download_scenarios_to_ep(
         await wrapped_ep.add_scenario(scenario_name=name, project_name=project)
 
 
+def tg_user_prefix(project: str) -> str:
+    """
+    Пространство id пользователей бота: один человек в разных ботах - разные
+    пользователи. Префикс зависит только от проекта, поэтому добавление бота не меняет
+    id уже сохраненных пользователей; у бота TG_PLAIN_ID_PROJECT id без префикса,
+    как у единственного бота до появления TG_BOTS
+    """
+    return "" if project == settings.TG_PLAIN_ID_PROJECT else f"{project}:"
+
+
+async def poll_with_shared_pool(
+    pollers: tp.Sequence[Poller], pool: KeyedWorkerPool | None
+) -> None:
+    """Запуск поллеров; общий пул ботов останавливается один раз, после всех поллеров"""
+    try:
+        await asyncio.gather(*(x.poll() for x in pollers))
+    finally:
+        if pool is not None:
+            await pool.stop()
+
+
+def wrap_metrics(
+    repo: AbstractRepo, ctx_repo: AbstractContextRepo
+) -> tp.Tuple[AbstractRepo, AbstractContextRepo]:
+    """Замер вызовов хранилищ (под кэшем и снимком, то есть время самих БД)"""
+    if not settings.METRICS_ENABLED:
+        return repo, ctx_repo
+    return MetricsRepo(repo), MetricsContextRepo(ctx_repo)
+
+
+def wrap_user_cache(repo: AbstractRepo) -> AbstractRepo:
+    if not settings.USER_CACHE_SIZE:
+        return repo
+    if settings.WEB_WORKERS > 1:
+        # кэш у каждого воркера свой, воркер читал бы устаревшего пользователя
+        raise Exception(
+            "user cache is local for every web worker and would serve stale users, "
+            "set USER_CACHE_SIZE=0 or WEB_WORKERS=1"
+        )
+    return CachedUserRepo(
+        repo=repo, max_size=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL
+    )
+
+
+def make_user_lock() -> AbstractUserLock:
+    if settings.USER_LOCK_BACKEND == "redis":
+        return RedisUserLock()
+    if settings.WEB_WORKERS > 1:
+        logger.warning(
+            "in-memory user lock does not serialize users between web workers, "
+            "set USER_LOCK_BACKEND=redis"
+        )
+    return InMemoryUserLock()
+
+
+def make_web(
+    repo: AbstractRepo,
+    ctx_repo: AbstractContextRepo,
+    ep: tp.Type[EventProcessor],
+    ep_wrapper: tp.Type[AbstractEPWrapper],
+    bus: tp.Type[MessageBus],
+    web: tp.Type[Web],
+    web_adapter: tp.Type[AbstractWebAdapter],
+) -> tp.Tuple[AbstractEPWrapper, MessageBus, Web]:
+    """Сборка обработки сообщений и веба поверх готовых репозиториев"""
+    concrete_ep = ep()
+    wrapped_ep = ep_wrapper(
+        event_processor=concrete_ep,
+        repo=repo,
+        ctx_repo=ctx_repo,
+        user_lock=make_user_lock(),
+    )
+
+    concrete_bus = bus()
+    concrete_bus.register(wrapped_ep, event_type=InEvent)
+
+    concrete_web_adapter = web_adapter(
+        repo=repo,
+        ctx_repo=ctx_repo,
+        bus=concrete_bus,
+        ep_wrapped=wrapped_ep,
+    )
+    concrete_web = web(
+        host=settings.WEB_HOST,
+        port=settings.WEB_PORT,
+        message_handler=concrete_web_adapter.message_handler,
+        batch_handler=concrete_web_adapter.batch_handler,
+        stream_handler=concrete_web_adapter.stream_handler,
+        session_opener=concrete_web_adapter.open_session,
+    )
+    return wrapped_ep, concrete_bus, concrete_web
+
+
+def _class_path(cls: tp.Type[tp.Any]) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_class(path: str) -> tp.Any:
+    module_name, _, qualname = path.partition(":")
+    result: tp.Any = importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        result = getattr(result, attr)
+    return result
+
+
+def create_web_worker_app() -> FastAPI:
+    """
+    Фабрика приложения для воркера веба (uvicorn --factory)
+    Классы компонентов передаются главным процессом через переменную окружения,
+    все изменяемое состояние живет во внешних хранилищах (БД, Redis)
+    """
+    setup_logging()
+    tracing.setup_export()
+    components = {
+        k: _import_class(v)
+        for k, v in json.loads(os.environ[WEB_WORKER_COMPONENTS_ENV]).items()
+    }
+    concrete_repo, concrete_ctx_repo = wrap_metrics(
+        components["repo"](), components["ctx_repo"]()
+    )
+    concrete_repo = wrap_user_cache(concrete_repo)
+    if settings.SCENARIO_SNAPSHOT_PATH:
+        concrete_repo = SnapshotRepo(
+            repo=concrete_repo, path=settings.SCENARIO_SNAPSHOT_PATH
+        )
+    wrapped_ep, _, concrete_web = make_web(
+        repo=concrete_repo,
+        ctx_repo=concrete_ctx_repo,
+        ep=components["ep"],
+        ep_wrapper=components["ep_wrapper"],
+        bus=components["bus"],
+        web=components["web"],
+        web_adapter=components["web_adapter"],
+    )
+
+    async def load_scenarios() -> None:
+        await download_scenarios_to_ep(wrapped_ep=wrapped_ep, repo=concrete_repo)
+
+    concrete_web.app.add_event_handler("startup", load_scenarios)
+    return concrete_web.app
+
+
 async def bootstrap(
     repo: tp.Type[AbstractRepo],
     ctx_repo: tp.Type[AbstractContextRepo],
@@ -102,54 +305,151 @@ async def bootstrap(
     sender_wrapper: tp.Type[AbstractSenderWrapper] | None = None,
 ) -> tp.Any:
 
-    concrete_repo = repo()
+    if settings.WEB_WORKERS > 1 and settings.SCENARIOS_WATCH:
+        # перезагрузка сценариев идет в этом процессе, воркеры веба ее не видят
+        raise Exception(
+            "SCENARIOS_WATCH reloads scenarios only in the main process, "
+            "web workers would serve stale scenarios, set WEB_WORKERS=1"
+        )
+    setup_logging()
+    tracing.setup_export()
+    concrete_repo: AbstractRepo = repo()
     await concrete_repo.prepare_db()
     parser = XMLParser()
     await upload_scenarios_to_repo(repo=concrete_repo, parser=parser)
+    concrete_repo, concrete_ctx_repo = wrap_metrics(concrete_repo, ctx_repo())
+    concrete_repo = wrap_user_cache(concrete_repo)
+    if settings.SCENARIO_SNAPSHOT_PATH:
+        await build_snapshot(repo=concrete_repo, path=settings.SCENARIO_SNAPSHOT_PATH)
+        concrete_repo = SnapshotRepo(
+            repo=concrete_repo, path=settings.SCENARIO_SNAPSHOT_PATH
+        )
 
-    concrete_ctx_repo = ctx_repo()
-
-    concrete_ep = ep()
-    wrapped_ep = ep_wrapper(
-        event_processor=concrete_ep, repo=concrete_repo, ctx_repo=concrete_ctx_repo
-    )
-    await download_scenarios_to_ep(wrapped_ep=wrapped_ep, repo=concrete_repo)
-
-    concrete_bus = bus()
-    concrete_bus.register(wrapped_ep)
-
-    concrete_web_adapter = web_adapter(
+    wrapped_ep, concrete_bus, concrete_web = make_web(
         repo=concrete_repo,
         ctx_repo=concrete_ctx_repo,
-        bus=concrete_bus,
-        ep_wrapped=wrapped_ep,
-    )
-    concrete_web = web(
-        host=settings.WEB_HOST,
-        port=settings.WEB_PORT,
-        message_handler=concrete_web_adapter.message_handler,
+        ep=ep,
+        ep_wrapper=ep_wrapper,
+        bus=bus,
+        web=web,
+        web_adapter=web_adapter,
     )
+    await download_scenarios_to_ep(wrapped_ep=wrapped_ep, repo=concrete_repo)
 
+    # все боты делят репозитории, кэши, шину и пул воркеров, различаются проектом
+    bots: tp.Dict[str, Bot] = {}
     if sender is not None or poller is not None:
-        bot = Bot(token="5023614422:AAEIwysH_RgMug_GpVV8b3ZpEw4kVnRL3IU")
+        server = (
+            TelegramAPIServer.from_base(settings.TG_API_SERVER)
+            if settings.TG_API_SERVER
+            else TELEGRAM_PRODUCTION
+        )
+        bots = {
+            project: Bot(token=token, server=server)
+            for project, token in settings.TG_BOTS.items()
+        }
+    multi_bot = len(bots) > 1
 
     if sender is not None and sender_wrapper is not None:
-        concrete_sender = sender(bot=bot, project_name="demo")
-        wrapped_sender = sender_wrapper(
-            sender=concrete_sender, repo=concrete_repo, ctx_repo=concrete_ctx_repo
-        )
-        concrete_bus.register(wrapped_sender)
+        for project, bot in bots.items():
+            concrete_sender = sender(
+                bot=bot, project_name=project, user_prefix=tg_user_prefix(project)
+            )
+            wrapped_sender = sender_wrapper(
+                sender=concrete_sender,
+                repo=concrete_repo,
+                ctx_repo=concrete_ctx_repo,
+                project_name=project,
+            )
+            concrete_bus.register(
+                wrapped_sender, event_type=OutEvent, project_name=project
+            )
 
+    concrete_pollers: tp.List[Poller] = []
+    shared_pool: KeyedWorkerPool | None = None
     if poller is not None and poller_adapter is not None:
         concrete_poller_adapter = poller_adapter(bus=concrete_bus, repo=concrete_repo)
-        concrete_poller = poller(
-            message_handler=concrete_poller_adapter.message_handler,
-            user_finder=concrete_poller_adapter.user_finder,
-            bot=bot,
-            project_name="demo",
-        )
+        poller_kwargs: tp.Dict[str, tp.Any] = {}
+        if issubclass(poller, TgPoller):
+            shared_pool = KeyedWorkerPool(
+                workers=settings.TG_WORKERS, max_in_flight=settings.TG_MAX_IN_FLIGHT
+            )
+            poller_kwargs.update(pool=shared_pool)
+        if issubclass(poller, TgWebhook):
+            if settings.WEB_WORKERS > 1:
+                raise Exception(
+                    "Telegram webhook is served by the main web process, "
+                    "set WEB_WORKERS=1 and scale by instances behind a load balancer"
+                )
+            poller_kwargs.update(
+                url=settings.TG_WEBHOOK_URL,
+                secret_token=settings.TG_WEBHOOK_SECRET or None,
+                queue_size=settings.TG_WEBHOOK_QUEUE_SIZE,
+            )
+        for project, bot in bots.items():
+            if issubclass(poller, TgPoller):
+                poller_kwargs.update(user_prefix=tg_user_prefix(project))
+            if issubclass(poller, TgWebhook):
+                poller_kwargs.update(
+                    path=f"{settings.TG_WEBHOOK_PATH}/{project}"
+                    if multi_bot
+                    else settings.TG_WEBHOOK_PATH
+                )
+            concrete_poller = poller(
+                message_handler=concrete_poller_adapter.message_handler,
+                user_finder=concrete_poller_adapter.user_finder,
+                bot=bot,
+                project_name=project,
+                **poller_kwargs,
+            )
+            concrete_poller.mount(concrete_web)
+            concrete_pollers.append(concrete_poller)
 
-    if poller is not None and poller_adapter is not None:
-        return asyncio.gather(concrete_poller.poll(), concrete_web.start())
+    if settings.WEB_WORKERS > 1:
+        # веб в отдельных процессах, здесь остаются поллер и отправка
+        os.environ[WEB_WORKER_COMPONENTS_ENV] = json.dumps(
+            dict(
+                repo=_class_path(repo),
+                ctx_repo=_class_path(ctx_repo),
+                ep=_class_path(ep),
+                ep_wrapper=_class_path(ep_wrapper),
+                bus=_class_path(bus),
+                web=_class_path(web),
+                web_adapter=_class_path(web_adapter),
+            )
+        )
+        tasks = [
+            concrete_web.start_workers(
+                workers=settings.WEB_WORKERS,
+                app_factory=f"{__name__}:{create_web_worker_app.__name__}",
+            )
+        ]
     else:
-        return asyncio.gather(concrete_web.start())
+        tasks = [concrete_web.start()]
+    if concrete_pollers:
+        tasks.append(poll_with_shared_pool(concrete_pollers, shared_pool))
+
+    if settings.SCENARIOS_WATCH:
+
+        async def reload_scenario(project: str, scenario: str) -> None:
+            await concrete_repo.create_project(project)
+            if await upload_scenario(
+                repo=concrete_repo, parser=parser, project=project, scenario=scenario
+            ):
+                if isinstance(concrete_repo, SnapshotRepo):
+                    await build_snapshot(
+                        repo=concrete_repo.repo, path=concrete_repo.path
+                    )
+                    concrete_repo.reload()
+                await wrapped_ep.add_scenario(
+                    scenario_name=scenario, project_name=project
+                )
+
+        watcher = ScenarioWatcher(
+            path="./src/scenarios",
+            on_change=reload_scenario,
+            interval=settings.SCENARIOS_WATCH_INTERVAL,
+        )
+        tasks.append(watcher.watch())
+
+    return asyncio.gather(*tasks)
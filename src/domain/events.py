@@ -1,12 +1,19 @@
 import copy
+import time
 import typing as tp
 from collections import defaultdict
 
+from src import settings
+from src import tracing
 from src.domain.model import Event
+from src.domain.model import ExecuteNode
 from src.domain.model import InEvent
 from src.domain.model import NodeType
 from src.domain.model import OutEvent
 from src.domain.model import Scenario
+from src.domain.model import User
+from src.metrics import NODE_SECONDS
+from src.settings import logger
 
 
 class EventProcessor:
@@ -45,6 +52,40 @@ class EventProcessor:
             "phrases": phrases,
         }
 
+    @staticmethod
+    async def _execute(
+        node: ExecuteNode,
+        scenario: Scenario,
+        project_name: str,
+        user: User,
+        ctx: tp.Dict[str, str],
+        in_text: str | None,
+    ) -> tp.Tuple[tp.List[OutEvent], tp.Dict[str, str], str]:
+        """Исполнение ноды с замером времени при включенных метриках и трассировке"""
+        if not settings.METRICS_ENABLED and not tracing.is_active():
+            return await node.execute(user, ctx, in_text)
+        with tracing.span(
+            "node",
+            scenario=scenario.name,
+            node_type=node.node_type.value,
+            node_id=node.element_id,
+            in_text_len=len(in_text or ""),
+        ) as node_span:
+            start = time.perf_counter()
+            try:
+                result = await node.execute(user, ctx, in_text)
+            finally:
+                if settings.METRICS_ENABLED:
+                    NODE_SECONDS.observe(
+                        time.perf_counter() - start,
+                        project_name,
+                        scenario.name,
+                        node.node_type.value,
+                        node.element_id,
+                    )
+            node_span.set(out_text_len=len(result[2]))
+            return result
+
     async def check_scenario_start(
         self, scenario: Scenario, event: InEvent
     ) -> tp.List[str]:
@@ -65,8 +106,13 @@ class EventProcessor:
             raise Exception("InEvent must have text or intent")
 
         if len(match_phrases_nodes) == 1:
-            _, _, filtered_text = await match_phrases_nodes[0].execute(
-                event.user, {}, event.text
+            _, _, filtered_text = await self._execute(
+                match_phrases_nodes[0],
+                scenario,
+                event.project_name,
+                event.user,
+                {},
+                event.text,
             )
             if filtered_text:
                 if not match_phrases_nodes[0].next_ids:
@@ -84,7 +130,9 @@ class EventProcessor:
                     raise Exception("matchText node need some child")
                 if or_node.element_id not in n.next_ids:
                     raise Exception("Not only one child for matchText nodes")
-                _, _, filtered_text = await n.execute(event.user, {}, event.text)
+                _, _, filtered_text = await self._execute(
+                    n, scenario, event.project_name, event.user, {}, event.text
+                )
                 if filtered_text:
                     return or_node.next_ids
         else:
@@ -104,6 +152,8 @@ class EventProcessor:
         event: InEvent,
         ctx: tp.Dict[str, str],
         scenario_getter: tp.Callable[[str, str], tp.Awaitable[Scenario]],
+        emit: tp.Callable[[OutEvent, tp.Dict[str, str]], tp.Awaitable[None]]
+        | None = None,
     ) -> tp.Tuple[tp.List[OutEvent], tp.Dict[str, str]]:
         """
         Ветвление исполнения только в логических блоках, иначе только один потомок
@@ -111,15 +161,36 @@ class EventProcessor:
         :param event: входящее событие, текст или нажатая кнопка
         :param ctx: контекст юзера в данном сценарии
         :param scenario_getter: отдает сценарий по названию
+        :param emit: вызывается с каждым исходящим событием и копией контекста на этот
+            момент сразу после исполнения ноды, до конца хода (потоковая отдача)
         :return: список исходящих событий и словарь для обновления контекста
         """
         user = event.user
         current_scenario_name = user.current_scenario_name
         current_node_id = user.current_node_id
         if current_scenario_name and current_node_id:
+            # сценарий могли перезагрузить, пока пользователь был в середине диалога
+            # если его нода (или нажатая кнопка) пропала в новой версии, начинаем заново
             current_scenario = await scenario_getter(
                 current_scenario_name, event.project_name
             )
+            if current_node_id not in current_scenario.nodes or (
+                event.button_pushed_next
+                and event.button_pushed_next not in current_scenario.nodes
+            ):
+                logger.warning(
+                    "node %s not found in scenario %s, reset dialog",
+                    current_node_id,
+                    current_scenario_name,
+                )
+                user.current_scenario_name = None
+                user.current_node_id = None
+                if not event.text and not event.intent:
+                    return [], ctx
+                event.button_pushed_next = None
+                current_scenario_name = None
+                current_node_id = None
+        if current_scenario_name and current_node_id:
             current_node = current_scenario.get_node_by_id(current_node_id)
             nodes_id = current_node.next_ids
         elif current_node_id and not current_scenario_name:
@@ -178,16 +249,26 @@ class EventProcessor:
                 NodeType.remoteRequest,
                 NodeType.dataExtract,
             ):
-                out_events, update_ctx, pipeline_text = await current_node.execute(
-                    user, ctx, pipeline_text
+                out_events, update_ctx, pipeline_text = await self._execute(
+                    current_node,
+                    current_scenario,
+                    event.project_name,
+                    user,
+                    ctx,
+                    pipeline_text,
                 )
                 output += out_events
                 ctx.update(update_ctx)
+                if emit is not None:
+                    for e in out_events:
+                        await emit(e, dict(ctx))
             elif current_node.node_type == NodeType.inMessage:
                 user.current_node_id = current_node.element_id
                 return output, ctx
             elif current_node.node_type == NodeType.loopCounter:
-                _, update_ctx, next_node_id = await current_node.execute(user, ctx, "")
+                _, update_ctx, next_node_id = await self._execute(
+                    current_node, current_scenario, event.project_name, user, ctx, ""
+                )
                 ctx.update(update_ctx)
                 current_node = current_scenario.get_node_by_id(next_node_id)
                 continue
@@ -197,8 +278,13 @@ class EventProcessor:
                     current_node.element_id
                 )  # родители логического блока
                 if len(parents) == 1:
-                    _, _, next_node_id = await current_node.execute(
-                        user, ctx, pipeline_text
+                    _, _, next_node_id = await self._execute(
+                        current_node,
+                        current_scenario,
+                        event.project_name,
+                        user,
+                        ctx,
+                        pipeline_text,
                     )
                     current_node = current_scenario.get_node_by_id(next_node_id)
                     continue
@@ -212,14 +298,28 @@ class EventProcessor:
                     )
                     internal_res: tp.List[str] = []
                     for ip in internal_parents:
-                        _, _, result_text = await ip.execute(user, ctx, "")
+                        _, _, result_text = await self._execute(
+                            ip, current_scenario, event.project_name, user, ctx, ""
+                        )
                         internal_res.append(result_text)
                     res_for_parent = "###$###".join(internal_res)
-                    _, _, result_text = await p.execute(user, ctx, res_for_parent)
+                    _, _, result_text = await self._execute(
+                        p,
+                        current_scenario,
+                        event.project_name,
+                        user,
+                        ctx,
+                        res_for_parent,
+                    )
                     lu_in_res.append(result_text)
                 resulted_text = "###$###".join(lu_in_res)
-                _, _, next_node_id = await current_node.execute(
-                    user, ctx, resulted_text
+                _, _, next_node_id = await self._execute(
+                    current_node,
+                    current_scenario,
+                    event.project_name,
+                    user,
+                    ctx,
+                    resulted_text,
                 )
                 current_node = current_scenario.get_node_by_id(next_node_id)
                 """
@@ -236,11 +336,19 @@ class EventProcessor:
                 """
                 continue
             elif current_node.node_type == NodeType.editMessage:
-                out_events, update_ctx, pipeline_text = await current_node.execute(
-                    user, ctx, pipeline_text
+                out_events, update_ctx, pipeline_text = await self._execute(
+                    current_node,
+                    current_scenario,
+                    event.project_name,
+                    user,
+                    ctx,
+                    pipeline_text,
                 )
                 output += out_events
                 ctx.update(update_ctx)
+                if emit is not None:
+                    for e in out_events:
+                        await emit(e, dict(ctx))
                 if current_node.next_ids is None:
                     raise Exception("EditNode must have at least one child")
                 elif len(current_node.next_ids) == 1:
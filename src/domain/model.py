@@ -6,6 +6,8 @@ import typing as tp
 from abc import ABC
 from abc import abstractmethod
 from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import fields
 from enum import Enum
 
 import aiohttp
@@ -13,6 +15,7 @@ import curlparser
 import jinja2 as j2
 from jsonpath_ng import parse
 
+from src import tracing
 from src.settings import logger
 
 
@@ -39,6 +42,57 @@ class User:
     async def update_current_scenario_name(self, name: str | None) -> None:
         self.current_scenario_name = name
 
+    def __post_init__(self) -> None:
+        self.mark_saved()
+
+    def mark_saved(self) -> None:
+        """Запомнить текущее состояние как совпадающее с хранилищем"""
+        self._saved_state = {x: getattr(self, x) for x in USER_FIELDS}
+
+    def changed_fields(self) -> tp.List[str]:
+        """Поля, изменившиеся с последнего сохранения"""
+        return [x for x in USER_FIELDS if self._saved_state[x] != getattr(self, x)]
+
+
+# изменяемые поля пользователя (все, кроме outer_id)
+USER_FIELDS = tuple(x.name for x in fields(User) if x.name != "outer_id")
+
+
+class TrackedContext(tp.Dict[str, str]):
+    """Контекст пользователя, запоминающий ключи, измененные за ход"""
+
+    def __init__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.changed_keys: tp.Set[str] = set()
+
+    def __setitem__(self, key: str, value: str) -> None:
+        if key not in self or self[key] != value:
+            self.changed_keys.add(key)
+        super().__setitem__(key, value)
+
+    def update(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other: tp.Any) -> TrackedContext:  # type: ignore
+        self.update(other)
+        return self
+
+    def setdefault(self, key: str, default: str) -> str:  # type: ignore
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def attach(self, values: tp.Dict[str, str]) -> None:
+        """Значения только на время хода (метаданные транспорта), в delta не попадают"""
+        for key, value in values.items():
+            super().__setitem__(key, value)
+            self.changed_keys.discard(key)
+
+    def delta(self) -> tp.Dict[str, str]:
+        """Только изменившиеся ключи"""
+        return {k: self[k] for k in self.changed_keys if k in self}
+
 
 @dataclass(kw_only=True)
 class InEvent(Event):  # noqa
@@ -47,6 +101,9 @@ class InEvent(Event):  # noqa
     text: tp.Optional[str] = None
     button_pushed_next: tp.Optional[str] = None
     intent: tp.Optional[str] = None
+    # метаданные запроса (__headers__, __integration_url__): видны нодам и шаблонам
+    # в контексте хода, но в хранилище контекста не пишутся
+    transport: tp.Dict[str, str] = field(default_factory=dict)
 
 
 @dataclass
@@ -66,6 +123,8 @@ class OutEvent(Event):  # noqa
     project_name: tp.Optional[str] = None
     buttons: tp.Optional[tp.List[Button]] = None
     node_to_edit: tp.Optional[str] = None
+    # текст и кнопки уже отрендерены по шаблонам (Renderer), повторно не рендерятся
+    rendered: bool = False
     ...
 
 
@@ -337,22 +396,27 @@ class RemoteRequest(ExecuteNode):
         jinja_template = j2.Template(request_url)
         request_url = jinja_template.render(ctx)
         if "__headers__" in ctx:
-            headers = ctx["__headers__"]
-            headers = json.loads(headers)
+            headers = json.loads(ctx["__headers__"])
         else:
             headers = None
-        if parsed_curl.method == "GET":
-            async with aiohttp.ClientSession() as session:
-                async with session.get(request_url, headers=headers) as resp:
-                    res = await resp.text()
-        elif parsed_curl.method == "POST":
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    request_url, headers=headers, json=parsed_curl.json
-                ) as resp:
-                    res = await resp.text()
-        else:
-            raise NotImplementedError(f"{parsed_curl.method} method not implemented")
+        with tracing.span(
+            "remote_request", method=parsed_curl.method, url=request_url
+        ) as request_span:
+            if parsed_curl.method == "GET":
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(request_url, headers=headers) as resp:
+                        res = await resp.text()
+            elif parsed_curl.method == "POST":
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(
+                        request_url, headers=headers, json=parsed_curl.json
+                    ) as resp:
+                        res = await resp.text()
+            else:
+                raise NotImplementedError(
+                    f"{parsed_curl.method} method not implemented"
+                )
+            request_span.set(status=resp.status, response_len=len(res))
         return [], {}, res
 
 
@@ -82,7 +82,7 @@ class XMLParser(Parser):
                     node_type = NodeType(self._get_node_type(xml_value))
                 except ValueError:
                     # todo: сделать грамотную обработку если это заметка
-                    logger.warning(f"unknown NodeType, {xml_value}")
+                    logger.warning("unknown NodeType, %s", xml_value)
                     continue
                 node_value = self._get_template(xml_value)
                 if node_value is None:
@@ -0,0 +1,154 @@
+"""
+Компактный бинарный формат скомпилированного сценария
+
+Формат (версия 1):
+    заголовок  <4sBII: MAGIC, версия, длина блока строк, количество чисел
+    числа      int32 little-endian, структура сценария из индексов в таблице строк
+    строки     utf-8, уникальные строки сценария через \\x00
+
+Списки кодируются длиной и индексами элементов, None кодируется как -1
+Порядок чисел: имя, root_id, intent_names, match_strings, количество нод, затем для каждой ноды
+тип, element_id, value, next_ids, кнопки (по 4 строки на кнопку), procedural_source
+"""
+import struct
+import sys
+import typing as tp
+from array import array
+
+from src.domain.model import ExecuteNode
+from src.domain.model import NodeType
+from src.domain.model import Scenario
+from src.domain.model import class_dict
+
+MAGIC = b"DCSC"
+VERSION = 1
+_HEADER = struct.Struct("<4sBII")
+_NONE = -1
+_SEPARATOR = "\x00"
+_NODE_TYPES = {x.value: x for x in NodeType}
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.ints: tp.List[int] = []
+        self.strings: tp.List[str] = []
+        self.indexes: tp.Dict[str, int] = {}
+
+    def string(self, value: str) -> None:
+        index = self.indexes.get(value)
+        if index is None:
+            if _SEPARATOR in value:
+                raise ValueError("Scenario strings must not contain NUL character")
+            index = len(self.strings)
+            self.indexes[value] = index
+            self.strings.append(value)
+        self.ints.append(index)
+
+    def strings_list(self, values: tp.Sequence[str] | None) -> None:
+        if values is None:
+            self.ints.append(_NONE)
+            return
+        self.ints.append(len(values))
+        for value in values:
+            self.string(value)
+
+
+def dump_scenario(scenario: Scenario) -> bytes:
+    """Сериализация сценария в компактный бинарный вид"""
+    writer = _Writer()
+    writer.string(scenario.name)
+    writer.string(scenario.root_id)
+    writer.strings_list(scenario.intent_names)
+    writer.strings_list(scenario.match_strings)
+    writer.ints.append(len(scenario.nodes))
+    for node in scenario.nodes.values():
+        writer.string(node.node_type.value)
+        writer.string(node.element_id)
+        writer.string(node.value)
+        writer.strings_list(node.next_ids)
+        if node.buttons is None:
+            writer.ints.append(_NONE)
+        else:
+            writer.ints.append(len(node.buttons))
+            for button in node.buttons:
+                for field in button:
+                    writer.string(field)
+        writer.ints.append(1 if node.procedural_source else 0)
+
+    ints = array("i", writer.ints)
+    if sys.byteorder == "big":
+        ints.byteswap()
+    strings = _SEPARATOR.join(writer.strings).encode()
+    header = _HEADER.pack(MAGIC, VERSION, len(strings), len(ints))
+    return header + ints.tobytes() + strings
+
+
+def load_scenario(data: bytes | memoryview) -> Scenario:
+    """Восстановление сценария из бинарного вида"""
+    magic, version, strings_len, ints_count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Data is not a serialized scenario")
+    if version != VERSION:
+        raise ValueError(f"Unsupported scenario format version {version}")
+    offset = _HEADER.size
+    ints_array = array("i")
+    ints_array.frombytes(data[offset : offset + ints_count * ints_array.itemsize])
+    if sys.byteorder == "big":
+        ints_array.byteswap()
+    ints = ints_array.tolist()
+    offset += ints_count * ints_array.itemsize
+    strings = bytes(data[offset : offset + strings_len]).decode().split(_SEPARATOR)
+
+    position = 0
+
+    def read_list() -> tp.List[str] | None:
+        nonlocal position
+        count = ints[position]
+        position += 1
+        if count == _NONE:
+            return None
+        values = [strings[i] for i in ints[position : position + count]]
+        position += count
+        return values
+
+    name = strings[ints[0]]
+    root_id = strings[ints[1]]
+    position = 2
+    intent_names = read_list()
+    match_strings = read_list()
+    nodes_count = ints[position]
+    position += 1
+
+    nodes: tp.Dict[str, ExecuteNode] = {}
+    for _ in range(nodes_count):
+        node_type = strings[ints[position]]
+        element_id = strings[ints[position + 1]]
+        value = strings[ints[position + 2]]
+        position += 3
+        next_ids = read_list()
+        buttons_count = ints[position]
+        position += 1
+        buttons = None
+        if buttons_count != _NONE:
+            buttons = []
+            for _ in range(buttons_count):
+                a, b, c, d = ints[position : position + 4]
+                buttons.append((strings[a], strings[b], strings[c], strings[d]))
+                position += 4
+        procedural_source = ints[position] == 1
+        position += 1
+        nodes[element_id] = class_dict[node_type](  # type: ignore
+            element_id=element_id,
+            next_ids=next_ids,
+            value=value,
+            node_type=_NODE_TYPES[node_type],
+            buttons=buttons,
+            procedural_source=procedural_source,
+        )
+    return Scenario(
+        name=name,
+        root_id=root_id,
+        nodes=nodes,
+        intent_names=intent_names,
+        match_strings=match_strings,
+    )
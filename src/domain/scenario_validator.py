@@ -1,3 +1,8 @@
+import typing as tp
+
+from src.domain.model import Scenario
+
+
 class ScenarioValidator:
     """
     Проверяет на правильность файлы сценариев и/или их распарсенные варианты
@@ -5,4 +10,27 @@ class ScenarioValidator:
     Понадобится для вызова из апи, и при загрузке из/в БД
     """
 
-    ...
+    @staticmethod
+    def _get_errors(scenario: Scenario) -> tp.List[str]:
+        errors: tp.List[str] = []
+        if scenario.root_id not in scenario.nodes:
+            errors.append(f"root node {scenario.root_id} not found")
+        for node_id, node in scenario.nodes.items():
+            for next_id in node.next_ids or []:
+                if next_id not in scenario.nodes:
+                    errors.append(f"node {node_id} refers to unknown node {next_id}")
+            for button in node.buttons or []:
+                for next_id in button[1].split(","):
+                    if next_id and next_id not in scenario.nodes:
+                        errors.append(
+                            f"button of node {node_id} refers to unknown node {next_id}"
+                        )
+        return errors
+
+    def validate(self, scenario: Scenario) -> None:
+        """Проверка ссылок между нодами сценария"""
+        errors = self._get_errors(scenario)
+        if errors:
+            raise ValueError(
+                f"Scenario {scenario.name} is not valid: " + "; ".join(errors)
+            )
@@ -1,3 +1,4 @@
+import asyncio
 import typing as tp
 from abc import ABC
 from abc import abstractmethod
@@ -6,8 +7,16 @@ import aiogram
 
 from src.domain.model import InEvent
 from src.domain.model import User
+from src.entrypoints.web import Web
+from src.log import SAMPLED
+from src.service_layer.worker_pool import KeyedWorkerPool
 from src.settings import logger
 
+TELEGRAM_SECRET_HEADER = "x-telegram-bot-api-secret-token"
+# long polling: ожидание обновлений на стороне Telegram и пауза после ошибки, в секундах
+POLL_TIMEOUT = 20
+POLL_ERROR_SLEEP = 5
+
 
 class Poller(ABC):
     def __init__(
@@ -25,6 +34,10 @@ class Poller(ABC):
     async def poll(self) -> None:
         """Poll from outer service"""
 
+    def mount(self, web: Web) -> None:
+        """Маршруты на вебе, если они нужны для приема (вебхук)"""
+        return None
+
 
 class TgPoller(Poller):
     def __init__(
@@ -33,67 +46,216 @@ class TgPoller(Poller):
         user_finder: tp.Callable[[tp.Dict[str, str]], tp.Awaitable[User]],
         project_name: str,
         bot: aiogram.Bot,
+        workers: int = 32,
+        max_in_flight: int = 1000,
+        pool: KeyedWorkerPool | None = None,
+        user_prefix: str = "",
     ) -> None:
-        """Initialize of entrypoints"""
+        """
+        Initialize of entrypoints
+        Обновления разбираются воркерами по чатам: чат всегда у одного воркера (порядок
+        сохраняется), медленный ход одного чата не держит остальные. При max_in_flight
+        обновлений в работе раскладка ждет, и следующая пачка не запрашивается
+        pool - общий пул нескольких ботов (останавливает его создавший), иначе свой
+        из workers и max_in_flight
+        user_prefix - пространство id пользователей бота, чтобы диалоги одного человека
+        с разными ботами не смешивались
+        """
         super().__init__(message_handler, user_finder, project_name)
         self.bot = bot
         self.dp = aiogram.Dispatcher(self.bot)
         self.dp.register_message_handler(self.process_message)
         self.dp.register_callback_query_handler(self.process_button_push)
+        self.pool = pool or KeyedWorkerPool(
+            workers=workers, max_in_flight=max_in_flight
+        )
+        self.owns_pool = pool is None
+        self.user_prefix = user_prefix
 
     async def process_message(self, tg_message: aiogram.types.Message) -> None:
         """Process message from telegram"""
-        logger.info(f"new text from entrypoints {tg_message.text}")
+        logger.debug(
+            "new text from user %s: %s",
+            tg_message.from_user.id,
+            tg_message.text,
+            extra=SAMPLED,
+        )
         try:
             text = tg_message.text
         except Exception as e:
             raise e
 
-        user = await self.user_finder(
-            dict(
-                outer_id=str(tg_message.from_user.id),
-                nickname=tg_message.from_user.username,
-                name=tg_message.from_user.first_name,
-                surname=tg_message.from_user.last_name,
+        async def job() -> None:
+            user = await self.user_finder(
+                dict(
+                    outer_id=f"{self.user_prefix}{tg_message.from_user.id}",
+                    nickname=tg_message.from_user.username,
+                    name=tg_message.from_user.first_name,
+                    surname=tg_message.from_user.last_name,
+                )
             )
-        )
-        logger.debug(type(user.outer_id))
-        message = InEvent(user=user, text=text, project_name=self.project_name)
-        await self.message_handler(message)
+            message = InEvent(user=user, text=text, project_name=self.project_name)
+            await self.message_handler(message)
+
+        await self.pool.submit((self.project_name, tg_message.chat.id), job)
 
     async def process_button_push(
         self,
         query: aiogram.types.CallbackQuery,
     ) -> None:
         """Process pushed button"""
-        logger.info("button pushed")
-        logger.info(query.data)
+        logger.debug(
+            "button pushed by user %s: %s",
+            query.from_user.id,
+            query.data,
+            extra=SAMPLED,
+        )
         await query.answer()
         try:
             pushed_button = str(query.data)
         except Exception as e:
             raise e
 
-        user = await self.user_finder(
-            dict(
-                outer_id=str(query.from_user.id),
-                nickname=query.from_user.username,
-                name=query.from_user.first_name,
-                surname=query.from_user.last_name,
+        async def job() -> None:
+            user = await self.user_finder(
+                dict(
+                    outer_id=f"{self.user_prefix}{query.from_user.id}",
+                    nickname=query.from_user.username,
+                    name=query.from_user.first_name,
+                    surname=query.from_user.last_name,
+                )
             )
-        )
-        message = InEvent(
-            user=user, button_pushed_next=pushed_button, project_name=self.project_name
-        )
-        await self.message_handler(message)
+            message = InEvent(
+                user=user,
+                button_pushed_next=pushed_button,
+                project_name=self.project_name,
+            )
+            await self.message_handler(message)
+
+        chat_id = query.message.chat.id if query.message else query.from_user.id
+        await self.pool.submit((self.project_name, chat_id), job)
+
+    async def dispatch(self, update: aiogram.types.Update) -> None:
+        """Раскладка обновления по воркерам через диспетчер aiogram"""
+        try:
+            await self.dp.process_update(update)
+        except Exception:
+            logger.exception("telegram update failed: %s", update)
 
     async def poll(self) -> None:
-        """Poll from outer service. Must be run in background task"""
+        """
+        Poll from outer service. Must be run in background task
+        Свой цикл вместо Dispatcher.start_polling: тот разбирает каждую пачку в отдельной
+        задаче и сразу запрашивает следующую, поэтому ожидание места в пуле копило бы
+        задачи без ограничения. Здесь следующая пачка запрашивается после раскладки
+        предыдущей, и при заполненном пуле обновления ждут на стороне Telegram
+        """
         logger.info("Start polling")
+        aiogram.Bot.set_current(self.bot)
+        aiogram.Dispatcher.set_current(self.dp)
+        offset = None
+        try:
+            await self.dp.reset_webhook(check=False)
+            while True:
+                try:
+                    updates = await self.bot.get_updates(
+                        offset=offset, timeout=POLL_TIMEOUT
+                    )
+                except Exception:
+                    logger.exception("telegram get_updates failed")
+                    await asyncio.sleep(POLL_ERROR_SLEEP)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    await self.dispatch(update)
+        finally:
+            if self.owns_pool:
+                await self.pool.stop()
+            await self.bot.close()
+
+
+class TgWebhook(TgPoller):
+    """
+    Прием обновлений Telegram через вебхук на приложении Web вместо long polling
+    Обновление подтверждается сразу и кладется в очередь, из нее - в воркеры чатов;
+    при полной очереди Telegram получает 503 и повторит доставку позже
+    """
+
+    def __init__(
+        self,
+        message_handler: tp.Callable[[InEvent], tp.Awaitable[None]],
+        user_finder: tp.Callable[[tp.Dict[str, str]], tp.Awaitable[User]],
+        project_name: str,
+        bot: aiogram.Bot,
+        url: str,
+        path: str = "/telegram/webhook",
+        secret_token: str | None = None,
+        workers: int = 32,
+        max_in_flight: int = 1000,
+        pool: KeyedWorkerPool | None = None,
+        user_prefix: str = "",
+        queue_size: int = 1000,
+    ) -> None:
+        """Initialize of entrypoints"""
+        super().__init__(
+            message_handler,
+            user_finder,
+            project_name,
+            bot,
+            workers,
+            max_in_flight,
+            pool,
+            user_prefix,
+        )
+        self.url = url.rstrip("/") + path
+        self.path = path
+        self.secret_token = secret_token
+        self.queue: asyncio.Queue[tp.Dict[str, tp.Any]] = asyncio.Queue(
+            maxsize=queue_size
+        )
+
+    def mount(self, web: Web) -> None:
+        web.add_webhook(path=self.path, handler=self.enqueue_update)
+
+    async def enqueue_update(
+        self, update: tp.Dict[str, tp.Any], headers: tp.Mapping[str, str]
+    ) -> bool:
+        """Постановка обновления в очередь, False - очередь заполнена"""
+        if (
+            self.secret_token
+            and headers.get(TELEGRAM_SECRET_HEADER) != self.secret_token
+        ):
+            raise PermissionError("wrong telegram secret token")
         try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("telegram webhook queue is full, update rejected")
+            return False
+        return True
+
+    async def process_updates(self) -> None:
+        """
+        Разбор очереди обновлений через диспетчер aiogram: он только раскладывает их
+        по воркерам чатов, поэтому разборщик один и порядок внутри чата сохраняется
+        """
+        aiogram.Bot.set_current(self.bot)
+        aiogram.Dispatcher.set_current(self.dp)
+        while True:
+            update = await self.queue.get()
             try:
-                await self.dp.start_polling()
-            except Exception as e:
-                raise e
+                await self.dispatch(aiogram.types.Update.to_object(update))
+            except Exception:
+                logger.exception("telegram update is malformed: %s", update)
+            finally:
+                self.queue.task_done()
+
+    async def poll(self) -> None:
+        """Регистрация вебхука в Telegram и запуск воркеров. Must be run in background task"""
+        logger.info("Start telegram webhook %s", self.url)
+        await self.bot.set_webhook(self.url, secret_token=self.secret_token)
+        try:
+            await self.process_updates()
         finally:
+            if self.owns_pool:
+                await self.pool.stop()
             await self.bot.close()
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import typing as tp
+
+from src.settings import logger
+
+
+class ScenarioWatcher:
+    """
+    Следит за папкой сценариев и сообщает об изменившихся сценариях
+    Изменения определяются по времени изменения и размеру файлов, без чтения их содержимого
+    """
+
+    def __init__(
+        self,
+        path: str,
+        on_change: tp.Callable[[str, str], tp.Awaitable[None]],
+        interval: float = 1.0,
+    ) -> None:
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.signatures: tp.Dict[tp.Tuple[str, str], tp.Tuple[tp.Any, ...]] = {}
+
+    @staticmethod
+    def _list_dirs(path: str) -> tp.List[str]:
+        return sorted(
+            x.name for x in os.scandir(path) if x.is_dir() and x.name != "__pycache__"
+        )
+
+    @staticmethod
+    def _signature(path: str) -> tp.Tuple[tp.Any, ...]:
+        signature = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [x for x in dirs if x != "__pycache__"]
+            for file_name in files:
+                stat = os.stat(os.path.join(root, file_name))
+                signature.append((root, file_name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(signature))
+
+    def scan(self) -> tp.List[tp.Tuple[str, str]]:
+        """Отдает список (проект, сценарий), новых или изменившихся с прошлого сканирования"""
+        changed = []
+        for project in self._list_dirs(self.path):
+            for scenario in self._list_dirs(f"{self.path}/{project}"):
+                signature = self._signature(f"{self.path}/{project}/{scenario}")
+                key = (project, scenario)
+                if self.signatures.get(key) != signature:
+                    changed.append(key)
+                    self.signatures[key] = signature
+        return changed
+
+    async def watch(self) -> None:
+        """Watch for scenarios changes. Must be run in background task"""
+        logger.info("Start watching %s", self.path)
+        self.scan()
+        while True:
+            await asyncio.sleep(self.interval)
+            for project, scenario in self.scan():
+                logger.info("scenario %s/%s changed, reload", project, scenario)
+                try:
+                    await self.on_change(project, scenario)
+                except Exception as e:
+                    # остаемся на прежней версии сценария
+                    logger.error(
+                        "scenario %s/%s not reloaded: %s", project, scenario, e
+                    )
@@ -1,10 +1,24 @@
+import asyncio
+import json
+import sys
 import typing as tp
 
 import uvicorn
 from fastapi import APIRouter
 from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import WebSocket
+from fastapi import WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
 
+from src import metrics
 from src import settings
+from src import tracing
+from src.adapters.web_adapter import WebSession
+from src.log import SAMPLED
+from src.log import setup_logging
 from src.settings import logger
 
 
@@ -16,10 +30,23 @@ class Web:
         message_handler: tp.Callable[
             [tp.Dict[str, tp.Any]], tp.Awaitable[tp.Dict[str, tp.Any]]
         ],
+        batch_handler: tp.Callable[
+            [tp.List[tp.Dict[str, tp.Any]]], tp.Awaitable[tp.List[tp.Dict[str, tp.Any]]]
+        ]
+        | None = None,
+        stream_handler: tp.Callable[
+            [tp.Dict[str, tp.Any]], tp.AsyncIterator[tp.Dict[str, tp.Any]]
+        ]
+        | None = None,
+        session_opener: tp.Callable[[tp.Dict[str, tp.Any]], tp.Awaitable[WebSession]]
+        | None = None,
     ) -> None:
         self.host = host
         self.port = port
         self.message_handler = message_handler
+        self.batch_handler = batch_handler
+        self.stream_handler = stream_handler
+        self.session_opener = session_opener
         self.app = FastAPI()
         self.router = APIRouter()
         self.router.add_api_route(
@@ -28,25 +55,173 @@ class Web:
         self.router.add_api_route(
             path="/message_text", endpoint=self.message_text, methods=["POST"]
         )
+        if batch_handler is not None:
+            self.router.add_api_route(
+                path="/message_batch", endpoint=self.message_batch, methods=["POST"]
+            )
+        if session_opener is not None:
+            self.router.add_api_websocket_route(path="/ws", endpoint=self.websocket)
+        self.router.add_api_route(
+            path="/metrics",
+            endpoint=self.metrics,
+            methods=["GET"],
+            response_class=PlainTextResponse,
+        )
+        self.router.add_api_route(
+            path="/debug/traces", endpoint=self.traces, methods=["GET"]
+        )
         self.app.include_router(self.router)
 
     @staticmethod
     async def healthcheck() -> tp.Dict[str, str]:
         return {"status": "ok"}
 
-    async def message_text(self, body: tp.Dict[str, tp.Any]) -> tp.Dict[str, tp.Any]:
-        logger.info(f"incoming request: {body}")
+    @staticmethod
+    async def metrics() -> PlainTextResponse:
+        """Метрики в текстовом формате Prometheus (пусто, если METRICS_ENABLED выключен)"""
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    @staticmethod
+    async def traces(limit: int | None = None) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Медленные трейсы ходов (TRACING_ENABLED), новые первыми"""
+        return tracing.get_traces(limit)
+
+    async def message_text(
+        self, body: tp.Dict[str, tp.Any], stream: bool = False
+    ) -> tp.Any:
+        """
+        Ответ на сообщение целиком; со stream=true (если веб собран с stream_handler) -
+        NDJSON, строка на каждое исходящее событие по мере готовности
+        """
+        logger.debug("incoming request: %s", body, extra=SAMPLED)
+        if stream and self.stream_handler is not None:
+            return StreamingResponse(
+                self._ndjson(self.stream_handler(body)),
+                media_type="application/x-ndjson",
+            )
         events = await self.message_handler(body)
-        print(events)
+        logger.debug("response: %s", events, extra=SAMPLED)
         return events
 
+    @staticmethod
+    async def _ndjson(
+        lines: tp.AsyncIterator[tp.Dict[str, tp.Any]]
+    ) -> tp.AsyncIterator[str]:
+        async for line in lines:
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    async def message_batch(
+        self, body: tp.List[tp.Dict[str, tp.Any]]
+    ) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Пачка сообщений одним запросом, ответы в том же порядке"""
+        if len(body) > settings.WEB_BATCH_MAX_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"batch is larger than {settings.WEB_BATCH_MAX_SIZE} messages",
+            )
+        logger.debug("incoming batch of %s messages", len(body), extra=SAMPLED)
+        return await self.batch_handler(body)  # type: ignore
+
+    def add_webhook(
+        self,
+        path: str,
+        handler: tp.Callable[
+            [tp.Dict[str, tp.Any], tp.Mapping[str, str]], tp.Awaitable[bool]
+        ],
+    ) -> None:
+        """
+        Вебхук внешнего сервиса: handler принимает тело и заголовки и сразу отвечает,
+        False - некуда положить (503), PermissionError - чужой запрос (403)
+        """
+
+        async def webhook(request: Request) -> tp.Any:
+            update = await request.json()
+            try:
+                accepted = await handler(update, request.headers)
+            except PermissionError:
+                raise HTTPException(status_code=403)
+            if not accepted:
+                raise HTTPException(status_code=503, detail="queue is full")
+            return {"ok": True}
+
+        self.app.add_api_route(path=path, endpoint=webhook, methods=["POST"])
+
+    async def websocket(self, websocket: WebSocket) -> None:
+        """
+        Веб-чат через WebSocket: первое сообщение как в /message_text привязывает
+        пользователя к подключению, дальше {"text", "intent"}. На каждое сообщение -
+        кадры по мере исполнения хода, последний {"done": true} или {"error": ...}
+        """
+        await websocket.accept()
+        try:
+            unparsed_event = await websocket.receive_json()
+            try:
+                session = await self.session_opener(unparsed_event)  # type: ignore
+            except Exception as e:
+                logger.exception("socket session not opened: %s", unparsed_event)
+                await websocket.send_json({"error": repr(e)})
+                await websocket.close(code=1008)
+                return
+            if not unparsed_event.get("text") and not unparsed_event.get("intent"):
+                unparsed_event = await websocket.receive_json()
+            while True:
+                logger.debug(
+                    "incoming socket message: %s", unparsed_event, extra=SAMPLED
+                )
+                async for frame in session.handle(unparsed_event):
+                    await websocket.send_json(frame)
+                unparsed_event = await websocket.receive_json()
+        except WebSocketDisconnect:
+            return
+
     async def start(self) -> None:
+        # логирование настроено здесь, uvicorn пишет в те же обработчики через корень
+        setup_logging()
         config = uvicorn.Config(
             self.app,
             host=self.host,
             port=self.port,
-            log_level="debug",
-            log_config=settings.LOGGING,
+            log_level=settings.LOG_LEVEL.lower(),
+            log_config=None,
         )
         server = uvicorn.Server(config)
         await server.serve()
+
+    async def start_workers(
+        self, workers: int, app_factory: str, stop_timeout: float = 10.0
+    ) -> None:
+        """
+        Запуск веба в нескольких процессах под супервизором uvicorn
+        Каждый воркер сам собирает приложение через app_factory ("module:function").
+        При отмене или ошибке родителя супервизор останавливается: SIGTERM, после
+        stop_timeout секунд - SIGKILL, чтобы не оставлять процессы с занятым портом
+        """
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "uvicorn",
+            app_factory,
+            "--factory",
+            "--host",
+            str(self.host),
+            "--port",
+            str(self.port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            settings.LOG_LEVEL.lower(),
+        )
+        try:
+            return_code = await process.wait()
+        finally:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=stop_timeout)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+        if return_code != 0:
+            raise Exception(f"Web workers exited with code {return_code}")
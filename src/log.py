@@ -0,0 +1,82 @@
+"""
+Настройка логирования: уровень и формат из окружения, сэмплирование логов горячего пути
+и запись через очередь, чтобы вывод не блокировал event loop
+
+Сообщения пишутся лениво (logger.debug("... %s", value)): аргументы форматируются,
+только если запись прошла уровень и сэмплирование
+"""
+import atexit
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+import random
+import typing as tp
+
+from src import settings
+
+# extra для записей горячего пути: из них проходит доля LOG_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+# атрибуты LogRecord, остальные поля записи пришли через extra
+_RECORD_FIELDS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class SampleFilter(logging.Filter):
+    """Пропускает долю rate записей, помеченных SAMPLED, остальные - все"""
+
+    def __init__(self, rate: float = 1.0) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON, поля из extra попадают в запись как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        res: tp.Dict[str, tp.Any] = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.filename}:{record.lineno}",
+        }
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_FIELDS:
+                res[k] = v
+        if record.exc_info:
+            res["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(res, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> None:
+    """
+    Применяет settings.LOGGING и переносит обработчики корневого логгера за очередь:
+    в event loop остается только постановка записи в очередь, вывод идет в потоке
+    """
+    global _listener
+    if _listener is not None:
+        return
+    logging.config.dictConfig(settings.LOGGING)
+    root = logging.getLogger()
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(settings.LOG_SAMPLE_RATE))
+    _listener = logging.handlers.QueueListener(
+        log_queue, *root.handlers, respect_handler_level=True
+    )
+    root.handlers = [queue_handler]
+    _listener.start()
+    atexit.register(_listener.stop)
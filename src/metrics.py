@@ -0,0 +1,132 @@
+"""
+Метрики обработки в текстовом формате Prometheus
+
+Гистограммы времени исполнения нод, вызовов репозиториев, отправки и обработки
+сообщений шиной. Пишутся только при METRICS_ENABLED, иначе места вызова проверяют
+флаг и сразу идут дальше. Реестр живет в процессе: при нескольких воркерах веба каждый
+отдает на /metrics свои значения
+"""
+import bisect
+import time
+import typing as tp
+from contextlib import contextmanager
+
+from src import settings
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tp.Sequence[str], values: tp.Sequence[str]) -> str:
+    return ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+
+class Histogram:
+    """Гистограмма с метками, значения в секундах"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tp.Sequence[str],
+        buckets: tp.Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # значения меток -> (попадания по корзинам + переполнение, сумма)
+        self.series: tp.Dict[tp.Tuple[str, ...], tp.Tuple[tp.List[int], float]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts, total = self.series.get(label_values) or (
+            [0] * (len(self.buckets) + 1),
+            0.0,
+        )
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.series[label_values] = (counts, total + value)
+
+    def clear(self) -> None:
+        self.series.clear()
+
+    def render(self) -> tp.List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, (counts, total) in self.series.items():
+            labels = _format_labels(self.label_names, label_values)
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            series = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{series} {total}")
+            lines.append(f"{self.name}_count{series} {cumulative}")
+        return lines
+
+
+NODE_SECONDS = Histogram(
+    "dialog_node_execute_seconds",
+    "Execution time of scenario nodes",
+    ("project", "scenario", "node_type", "node_id"),
+)
+REPO_SECONDS = Histogram(
+    "dialog_repo_call_seconds",
+    "Duration of repository calls",
+    ("repo", "method"),
+)
+SEND_SECONDS = Histogram(
+    "dialog_sender_send_seconds",
+    "Duration of sending messages to outer services",
+    ("sender", "project"),
+)
+BUS_SECONDS = Histogram(
+    "dialog_bus_dispatch_seconds",
+    "Handling time of bus messages by subscribers",
+    ("subscriber", "event_type"),
+)
+REGISTRY: tp.List[Histogram] = [NODE_SECONDS, REPO_SECONDS, SEND_SECONDS, BUS_SECONDS]
+
+
+@contextmanager
+def timer(histogram: Histogram, *label_values: str) -> tp.Iterator[None]:
+    """Время блока в гистограмму, в том числе при исключении"""
+    if not settings.METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *label_values)
+
+
+def render() -> str:
+    lines: tp.List[str] = []
+    for histogram in REGISTRY:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
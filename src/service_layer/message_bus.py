@@ -1,8 +1,12 @@
+import time
 import typing as tp
 from abc import ABC
 from abc import abstractmethod
+from collections import deque
 
+from src import settings
 from src.domain.model import Event
+from src.metrics import BUS_SECONDS
 
 
 class Subscriber(tp.Protocol):
@@ -16,8 +20,17 @@ class MessageBus(ABC):
         """Initialize of bus"""
 
     @abstractmethod
-    def register(self, subscriber: Subscriber) -> None:
-        """Register subscriber in bus"""
+    def register(
+        self,
+        subscriber: Subscriber,
+        event_type: tp.Type[Event] | None = None,
+        project_name: str | None = None,
+    ) -> None:
+        """
+        Register subscriber in bus
+        :param event_type: только события этого класса (и наследников), None - все
+        :param project_name: только события этого проекта, None - всех проектов
+        """
 
     @abstractmethod
     def unregister(self, subscriber: Subscriber) -> None:
@@ -31,25 +44,84 @@ class MessageBus(ABC):
 class ConcreteMessageBus(MessageBus):
     def __init__(self) -> None:
         """Initialize of bus"""
-        self.queue: tp.List[Event] = []
-        self.services: tp.List[Subscriber] = []
+        # подписки в порядке регистрации: (подписчик, класс события, проект)
+        self.subscriptions: tp.List[
+            tp.Tuple[Subscriber, tp.Type[Event] | None, str | None]
+        ] = []
+        # (класс события, проект) -> подписчики, считается при первом таком событии.
+        # Проект в ключе - только из подписок, остальные (имя проекта приходит от
+        # клиента) идут под None, поэтому таблица не растет от входящих событий
+        self.routes: tp.Dict[tp.Tuple[tp.Type[Event], str | None], tp.List[Subscriber]]
+        self.routes = {}
+        self.projects: tp.Set[str] = set()
+
+    @property
+    def services(self) -> tp.List[Subscriber]:
+        return [x[0] for x in self.subscriptions]
 
-    def register(self, subscriber: Subscriber) -> None:
+    def register(
+        self,
+        subscriber: Subscriber,
+        event_type: tp.Type[Event] | None = None,
+        project_name: str | None = None,
+    ) -> None:
         """Register subscriber in bus"""
-        self.services.append(subscriber)
+        self.subscriptions.append((subscriber, event_type, project_name))
+        self._reset_routes()
 
     def unregister(self, subscriber: Subscriber) -> None:
-        """Unregister subscriber in bus"""
-        self.services.remove(subscriber)
+        """Unregister subscriber in bus (первую его подписку, как list.remove)"""
+        for i, subscription in enumerate(self.subscriptions):
+            if subscription[0] is subscriber:
+                del self.subscriptions[i]
+                self._reset_routes()
+                return
+        raise ValueError(f"{subscriber} is not registered")
+
+    def _reset_routes(self) -> None:
+        self.routes.clear()
+        self.projects = {x[2] for x in self.subscriptions if x[2] is not None}
+
+    def subscribers(self, message: Event) -> tp.List[Subscriber]:
+        """Подписчики события по таблице маршрутов"""
+        project_name = getattr(message, "project_name", None)
+        if project_name not in self.projects:
+            # на проект без своих подписок подходят только подписки на все проекты
+            project_name = None
+        key = (type(message), project_name)
+        subscribers = self.routes.get(key)
+        if subscribers is None:
+            subscribers = [
+                sub
+                for sub, event_type, project_name in self.subscriptions
+                if (event_type is None or issubclass(key[0], event_type))
+                and (project_name is None or project_name == key[1])
+            ]
+            self.routes[key] = subscribers
+        return subscribers
 
     async def public_message(self, message: tp.Union[Event, tp.List[Event]]) -> None:
-        """Public and handle message"""
+        """
+        Public and handle message
+        Очередь своя у каждого вызова: конкурентные вызовы (ходы разных чатов) не
+        разбирают события друг друга, и вызов возвращается, когда его события обработаны
+        """
+        queue: tp.Deque[Event] = deque()
         if isinstance(message, tp.List):
-            self.queue += message
+            queue += message
         elif isinstance(message, Event):
-            self.queue.append(message)
-        while self.queue:
-            current_message = self.queue.pop(0)
-            for sub in self.services:
-                events = await sub.handle_message(current_message)
-                self.queue += events
+            queue.append(message)
+        while queue:
+            current_message = queue.popleft()
+            for sub in self.subscribers(current_message):
+                if settings.METRICS_ENABLED:
+                    start = time.perf_counter()
+                    events = await sub.handle_message(current_message)
+                    BUS_SECONDS.observe(
+                        time.perf_counter() - start,
+                        type(sub).__name__,
+                        type(current_message).__name__,
+                    )
+                else:
+                    events = await sub.handle_message(current_message)
+                queue += events
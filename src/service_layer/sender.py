@@ -6,6 +6,7 @@ from abc import abstractmethod
 import aiogram
 
 from src.domain.model import OutEvent
+from src.log import SAMPLED
 from src.settings import logger
 
 
@@ -23,11 +24,17 @@ class Sender(ABC):
 
 
 class TgSender(Sender):
-    def __init__(self, bot: aiogram.Bot, project_name: str) -> None:
-        """Initialize of sender"""
+    def __init__(
+        self, bot: aiogram.Bot, project_name: str, user_prefix: str = ""
+    ) -> None:
+        """
+        Initialize of sender
+        user_prefix - пространство id пользователей бота (см. TgPoller), в chat_id не идет
+        """
         super().__init__()
         self.bot = bot
         self.project_name = project_name
+        self.user_prefix = user_prefix
 
     @staticmethod
     async def _search_linked_message(
@@ -60,14 +67,15 @@ class TgSender(Sender):
         history: tp.List[tp.Dict[str, str]],
     ) -> str:
         """Send to outer service"""
-        logger.info("send message")
+        logger.debug("send message to %s", event.user.outer_id, extra=SAMPLED)
+        chat_id = event.user.outer_id.removeprefix(self.user_prefix)
         if event.node_to_edit:
             keyboard = await self.get_keyboard(event)
             message_id_to_edit = await self._search_linked_message(
                 history=history, linked_node_id=event.node_to_edit
             )
             res = await self.bot.edit_message_text(
-                chat_id=event.user.outer_id,
+                chat_id=chat_id,
                 text=event.text,
                 message_id=message_id_to_edit,
                 reply_markup=keyboard,
@@ -75,7 +83,7 @@ class TgSender(Sender):
         else:
             keyboard = await self.get_keyboard(event)
             res = await self.bot.send_message(
-                chat_id=event.user.outer_id,
+                chat_id=chat_id,
                 text=event.text,
                 reply_markup=keyboard,
             )
@@ -0,0 +1,58 @@
+import asyncio
+import typing as tp
+
+from src.settings import logger
+
+
+class KeyedWorkerPool:
+    """
+    Пул воркеров с очередью на каждого: задачи с одним ключом (чат) всегда попадают
+    к одному воркеру и выполняются по порядку, задачи разных ключей - параллельно
+    Задач в очередях и в работе не больше max_in_flight, submit ждет освобождения места
+    """
+
+    def __init__(self, workers: int, max_in_flight: int) -> None:
+        self.queues: tp.List[asyncio.Queue[tp.Callable[[], tp.Awaitable[None]]]] = [
+            asyncio.Queue() for _ in range(workers)
+        ]
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.tasks: tp.List[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._work(q)) for q in self.queues]
+
+    async def submit(
+        self, key: tp.Hashable, job: tp.Callable[[], tp.Awaitable[None]]
+    ) -> None:
+        """Постановка задачи в очередь воркера ключа"""
+        self.start()
+        await self.slots.acquire()
+        self.in_flight += 1
+        self.queues[hash(key) % len(self.queues)].put_nowait(job)
+
+    async def join(self) -> None:
+        """Ожидание выполнения всех поставленных задач"""
+        for q in self.queues:
+            await q.join()
+
+    async def stop(self) -> None:
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _work(
+        self, queue: asyncio.Queue[tp.Callable[[], tp.Awaitable[None]]]
+    ) -> None:
+        while True:
+            job = await queue.get()
+            try:
+                await job()
+            except Exception:
+                logger.exception("worker pool job failed")
+            finally:
+                self.in_flight -= 1
+                self.slots.release()
+                queue.task_done()
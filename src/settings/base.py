@@ -1,6 +1,11 @@
 import logging
+from os import getenv
 
-LOG_LEVEL = "DEBUG"
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO").upper()
+# формат логов: "text" - строкой, "json" - одна запись в строке JSON
+LOG_FORMAT = getenv("LOG_FORMAT", "text")
+# доля записей горячего пути (extra=SAMPLED), которые попадают в лог
+LOG_SAMPLE_RATE = float(getenv("LOG_SAMPLE_RATE", 0.01))
 COMMON_FORMAT_STRING = " [%(levelname)-4s] [%(asctime)s] >> %(message)s"
 USER_FORMAT_STRING = (
     "[L:%(lineno)d] [%(filename)s | %(funcName)s] [%(name)s]" + COMMON_FORMAT_STRING
@@ -15,12 +20,13 @@ LOGGING = {
         "standard": {
             "datefmt": "%Y-%m-%d %H:%M:%S",
             "format": USER_FORMAT_STRING,
-        }
+        },
+        "json": {"()": "src.log.JsonFormatter"},
     },
     "handlers": {
         "console": {
             "class": "logging.StreamHandler",
-            "formatter": "standard",
+            "formatter": "json" if LOG_FORMAT == "json" else "standard",
             "level": LOG_LEVEL,
         }
     },
@@ -1,3 +1,4 @@
+import json
 from os import getenv
 
 DB_NAME = getenv("DB_NAME", "postgres")
@@ -19,3 +20,68 @@ else:
 REDIS_HOST = getenv("REDIS_HOST", "localhost")
 REDIS_PORT = getenv("REDIS_PORT", "6379")
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
+
+# перезагрузка сценариев при изменении файлов в src/scenarios без рестарта
+SCENARIOS_WATCH = getenv("SCENARIOS_WATCH", "") in ("1", "true", "True")
+SCENARIOS_WATCH_INTERVAL = float(getenv("SCENARIOS_WATCH_INTERVAL", 1.0))
+
+# файл снимка сценариев, общий для всех воркеров через mmap (пусто - не использовать)
+SCENARIO_SNAPSHOT_PATH = getenv("SCENARIO_SNAPSHOT_PATH", "")
+
+# количество процессов веба, при > 1 веб запускается под супервизором uvicorn,
+# состояние пользователей должно храниться во внешних БД и Redis,
+# SCENARIOS_WATCH с несколькими воркерами не поддерживается
+WEB_WORKERS = int(getenv("WEB_WORKERS", 1))
+
+# лок пользователя на время хода: "memory" - в пределах процесса, "redis" - между процессами
+USER_LOCK_BACKEND = getenv("USER_LOCK_BACKEND", "memory")
+# время жизни redis-лока и максимальное ожидание его захвата, в секундах
+USER_LOCK_TIMEOUT = float(getenv("USER_LOCK_TIMEOUT", 30))
+
+# склейка записей пользователей, контекстов и истории в одну транзакцию
+DB_WRITE_BATCHING = getenv("DB_WRITE_BATCHING", "") in ("1", "true", "True")
+DB_WRITE_BATCH_WINDOW_MS = float(getenv("DB_WRITE_BATCH_WINDOW_MS", 5))
+DB_WRITE_BATCH_SIZE = int(getenv("DB_WRITE_BATCH_SIZE", 100))
+
+# боты Telegram в одном процессе: JSON {"проект": "токен бота"}
+TG_BOTS = json.loads(
+    getenv("TG_BOTS", '{"demo": "5023614422:AAEIwysH_RgMug_GpVV8b3ZpEw4kVnRL3IU"}')
+)
+# проект, пользователи бота которого хранятся с id Telegram без префикса "<проект>:"
+# (так хранились пользователи единственного бота до TG_BOTS), пусто - префикс у всех
+TG_PLAIN_ID_PROJECT = getenv("TG_PLAIN_ID_PROJECT", "demo")
+# Telegram: публичный адрес приложения для вебхука (пусто - long polling), путь вебхука,
+# (при нескольких ботах - с /<проект> на конце), секрет для заголовка
+# X-Telegram-Bot-Api-Secret-Token и очередь принятых обновлений
+TG_WEBHOOK_URL = getenv("TG_WEBHOOK_URL", "")
+TG_WEBHOOK_PATH = getenv("TG_WEBHOOK_PATH", "/telegram/webhook")
+TG_WEBHOOK_SECRET = getenv("TG_WEBHOOK_SECRET", "")
+TG_WEBHOOK_QUEUE_SIZE = int(getenv("TG_WEBHOOK_QUEUE_SIZE", 1000))
+# воркеры обработки обновлений Telegram (чат всегда у одного воркера)
+# и максимум обновлений в работе, дальше прием ждет
+TG_WORKERS = int(getenv("TG_WORKERS", 32))
+TG_MAX_IN_FLIGHT = int(getenv("TG_MAX_IN_FLIGHT", 1000))
+# адрес Bot API (пусто - api.telegram.org), например локальный фейковый сервер для тестов
+TG_API_SERVER = getenv("TG_API_SERVER", "")
+
+# /message_batch: максимум сообщений в запросе и пользователей, обрабатываемых параллельно
+WEB_BATCH_MAX_SIZE = int(getenv("WEB_BATCH_MAX_SIZE", 1000))
+WEB_BATCH_CONCURRENCY = int(getenv("WEB_BATCH_CONCURRENCY", 32))
+
+# кэш пользователей перед репозиторием (0 - выключен), время жизни записи в секундах,
+# кэш живет в процессе, с WEB_WORKERS > 1 не поддерживается
+USER_CACHE_SIZE = int(getenv("USER_CACHE_SIZE", 0))
+USER_CACHE_TTL = float(getenv("USER_CACHE_TTL", 60))
+
+# время жизни контекста пользователя в Redis в секундах (0 - бессрочно)
+CONTEXT_TTL = int(getenv("CONTEXT_TTL", 0))
+
+# сбор метрик (время нод, репозиториев, отправки и шины), отдаются на /metrics
+METRICS_ENABLED = getenv("METRICS_ENABLED", "") in ("1", "true", "True")
+
+# трассировка ходов: трейсы дольше TRACE_SLOW_MS хранятся в буфере (отдаются на /debug/traces)
+TRACING_ENABLED = getenv("TRACING_ENABLED", "") in ("1", "true", "True")
+TRACE_SLOW_MS = float(getenv("TRACE_SLOW_MS", 100))
+TRACE_BUFFER_SIZE = int(getenv("TRACE_BUFFER_SIZE", 100))
+# OTLP gRPC коллектор для экспорта трейсов, например localhost:4317 (пусто - не экспортировать)
+TRACE_OTLP_ENDPOINT = getenv("TRACE_OTLP_ENDPOINT", "")
@@ -0,0 +1,186 @@
+"""
+Трассировка хода пользователя: дерево спанов от входящего события до отправки
+
+Корень открывает trace() на входе (веб, поллер, EPWrapper), внутренние места
+открывают span(), который без активного трейса ничего не делает. Трейсы дольше
+TRACE_SLOW_MS попадают в кольцевой буфер (отдается на /debug/traces) и, если задан
+TRACE_OTLP_ENDPOINT и установлен opentelemetry-sdk, экспортируются в коллектор
+"""
+import contextvars
+import time
+import typing as tp
+from collections import deque
+
+from src import settings
+from src.settings import logger
+
+
+class Span:
+    def __init__(self, name: str, attributes: tp.Dict[str, tp.Any]) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.children: tp.List[Span] = []
+        self.wall_start = 0.0
+        self.start = 0.0
+        self.end = 0.0
+        self.error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def set(self, **attributes: tp.Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> tp.Dict[str, tp.Any]:
+        res: tp.Dict[str, tp.Any] = {
+            "name": self.name,
+            "start": self.wall_start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "children": [x.to_dict() for x in self.children],
+        }
+        if self.error:
+            res["error"] = self.error
+        return res
+
+
+class _NoopSpan:
+    """Заглушка, когда трейс не идет: те же методы, никакой работы"""
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        return None
+
+    def set(self, **attributes: tp.Any) -> None:
+        return None
+
+
+_NOOP = _NoopSpan()
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+TRACES: tp.Deque[tp.Dict[str, tp.Any]] = deque(maxlen=settings.TRACE_BUFFER_SIZE)
+
+
+class _SpanContext:
+    def __init__(self, span: Span, parent: Span | None) -> None:
+        self.span = span
+        self.parent = parent
+        self.token: contextvars.Token | None = None  # type: ignore
+
+    def __enter__(self) -> Span:
+        self.span.wall_start = time.time()
+        self.span.start = time.perf_counter()
+        if self.parent is not None:
+            self.parent.children.append(self.span)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type: tp.Any, exc: tp.Any, tb: tp.Any) -> None:
+        self.span.end = time.perf_counter()
+        if exc is not None:
+            self.span.error = repr(exc)
+        if self.token is not None:
+            _current.reset(self.token)
+        if self.parent is None:
+            _finish(self.span)
+
+
+def is_active() -> bool:
+    return _current.get() is not None
+
+
+def trace(name: str, **attributes: tp.Any) -> tp.Any:
+    """Корень трейса; внутри уже идущего трейса - обычный спан"""
+    parent = _current.get()
+    if parent is None and not settings.TRACING_ENABLED:
+        return _NOOP
+    return _SpanContext(Span(name, attributes), parent)
+
+
+def span(name: str, **attributes: tp.Any) -> tp.Any:
+    """Спан внутри текущего трейса, без трейса ничего не делает"""
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return _SpanContext(Span(name, attributes), parent)
+
+
+def _finish(root: Span) -> None:
+    if root.duration * 1000 < settings.TRACE_SLOW_MS:
+        return
+    TRACES.append(root.to_dict())
+    if _exporter is not None:
+        try:
+            _exporter.export(root)
+        except Exception as e:
+            logger.error("trace export failed: %s", e)
+
+
+def get_traces(limit: int | None = None) -> tp.List[tp.Dict[str, tp.Any]]:
+    """Сохраненные медленные трейсы, новые первыми"""
+    traces = list(TRACES)[::-1]
+    return traces[:limit] if limit else traces
+
+
+class OtelExporter:
+    """Экспорт готового дерева спанов через OpenTelemetry OTLP (gRPC)"""
+
+    def __init__(self, endpoint: str) -> None:
+        from opentelemetry.exporter.otlp.proto.grpc import trace_exporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(
+            resource=Resource.create({"service.name": "dialog-constructor"})
+        )
+        # отправка идет из фонового потока процессора, event loop не ждет сеть
+        provider.add_span_processor(
+            BatchSpanProcessor(
+                trace_exporter.OTLPSpanExporter(endpoint=endpoint, insecure=True)
+            )
+        )
+        self.tracer = provider.get_tracer(__name__)
+
+    def export(self, root: Span) -> None:
+        from opentelemetry import trace as otel_trace
+
+        # perf_counter не привязан к эпохе, время спанов считается от начала корня
+        epoch_shift = root.wall_start - root.start
+
+        def emit(span: Span, context: tp.Any) -> None:
+            otel_span = self.tracer.start_span(
+                span.name,
+                context=context,
+                start_time=int((span.start + epoch_shift) * 1e9),
+                attributes={k: str(v) for k, v in span.attributes.items()},
+            )
+            if span.error:
+                otel_span.set_attribute("error", span.error)
+            child_context = otel_trace.set_span_in_context(otel_span)
+            for child in span.children:
+                emit(child, child_context)
+            otel_span.end(end_time=int((span.end + epoch_shift) * 1e9))
+
+        emit(root, None)
+
+
+_exporter: OtelExporter | None = None
+
+
+def setup_export() -> None:
+    """Подключение экспорта в коллектор, если он задан в настройках"""
+    global _exporter
+    if not settings.TRACE_OTLP_ENDPOINT:
+        return
+    try:
+        _exporter = OtelExporter(settings.TRACE_OTLP_ENDPOINT)
+    except ImportError:
+        logger.warning(
+            "TRACE_OTLP_ENDPOINT is set, but opentelemetry-sdk and "
+            "opentelemetry-exporter-otlp are not installed, export disabled"
+        )
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import typing as tp
 
@@ -5,6 +6,7 @@ import pytest
 from sqlalchemy import func
 from sqlalchemy import select
 
+from src.adapters.alchemy.batching import BatchingSQLAlchemyRepo
 from src.adapters.alchemy.models import out_messages
 from src.adapters.alchemy.models import projects
 from src.adapters.alchemy.models import scenario_texts
@@ -65,6 +67,22 @@ async def test_users_update(alchemy_repo: tp.Awaitable[SQLAlchemyRepo]) -> None:
         assert result.scalar_one() == 2
 
 
+@pytest.mark.asyncio
+async def test_users_update_fields(
+    alchemy_repo: tp.Awaitable[SQLAlchemyRepo],
+) -> None:
+    repo = await alchemy_repo
+    user = await repo.get_or_create_user(outer_id="1", name="test")
+
+    changed_user = User(outer_id="1", name="other", current_node_id="id_2")
+    await repo.update_user(changed_user, fields=["current_node_id"])
+    assert await repo.get_or_create_user(outer_id="1") == User(
+        outer_id="1", name="test", current_node_id="id_2"
+    )
+    await repo.update_user(user, fields=[])
+    assert (await repo.get_or_create_user(outer_id="1")).current_node_id == "id_2"
+
+
 @pytest.mark.asyncio
 async def test_update_ctx(alchemy_repo: tp.Awaitable[SQLAlchemyRepo]) -> None:
     repo = await alchemy_repo
@@ -237,6 +255,9 @@ async def test_add_scenario(
         )
         assert parsed_scenario_from_db == mock_scenario
 
+        scenarios_from_db = await session.execute(select(scenarios))
+        assert scenarios_from_db.first().scenario_bin is not None
+
 
 @pytest.mark.asyncio
 async def test_add_scenario_texts(
@@ -312,6 +333,16 @@ async def test_get_scenario_text(
         assert first_text == "test substitution"
         assert second_text == "text"
 
+        all_texts = await repo.get_scenario_texts(
+            scenario_name=mock_scenario.name,
+            project_name="test project",
+            session=session,
+        )
+        assert all_texts == {
+            "TEXT_mock_scenario": "test substitution",
+            "another": "text",
+        }
+
 
 @pytest.mark.asyncio
 async def test_get_scenarios_metadata(
@@ -357,3 +388,184 @@ async def test_get_scenarios_metadata(
                 matchtext_scenario.name,
             ),
         ]
+
+
+@pytest.mark.asyncio
+async def test_scenario_hash_and_texts_upsert(
+    alchemy_repo: tp.Awaitable[SQLAlchemyRepo], mock_scenario: Scenario
+) -> None:
+    repo = await alchemy_repo
+    async_session = repo.session()
+    async with async_session() as session:
+        await repo.create_project("test project", session=session)
+        scenario_hash = await repo.get_scenario_hash(
+            name=mock_scenario.name, project_name="test project", session=session
+        )
+        assert scenario_hash is None
+
+        await repo.add_scenario(
+            scenario=mock_scenario, project_name="test project", session=session
+        )
+        await repo.add_scenario_texts(
+            scenario_name=mock_scenario.name,
+            project_name="test project",
+            texts={"TEXT_mock_scenario": "test substitution", "another": "text"},
+            content_hash="first",
+            session=session,
+        )
+        scenarios_from_db = await session.execute(select(scenarios))
+        scenario_id = scenarios_from_db.first().id
+
+        await repo.add_scenario(
+            scenario=mock_scenario, project_name="test project", session=session
+        )
+        # сценарий обновлен, тексты еще нет: хэш не должен совпасть ни с каким
+        scenario_hash = await repo.get_scenario_hash(
+            name=mock_scenario.name, project_name="test project", session=session
+        )
+        assert scenario_hash is None
+        await repo.add_scenario_texts(
+            scenario_name=mock_scenario.name,
+            project_name="test project",
+            texts={"TEXT_mock_scenario": "new substitution", "another": "text"},
+            content_hash="second",
+            session=session,
+        )
+        scenario_hash = await repo.get_scenario_hash(
+            name=mock_scenario.name, project_name="test project", session=session
+        )
+        assert scenario_hash == "second"
+
+        scenarios_from_db = await session.execute(select(scenarios))
+        scenarios_rows = scenarios_from_db.fetchall()
+        assert len(scenarios_rows) == 1
+        assert scenarios_rows[0].id == scenario_id
+
+        texts_from_db = await session.execute(select(scenario_texts))
+        texts = texts_from_db.fetchall()
+        assert len(texts) == 2
+        prepared_texts = {x.template_name: x.template_value for x in texts}
+        assert prepared_texts == {
+            "TEXT_mock_scenario": "new substitution",
+            "another": "text",
+        }
+
+
+@pytest.mark.asyncio
+async def test_batching_repo_writes() -> None:
+    repo = BatchingSQLAlchemyRepo(window_ms=5, batch_size=100)
+    await repo._recreate_db()  # noqa
+    first = await repo.get_or_create_user(outer_id="1")
+    second = await repo.get_or_create_user(outer_id="2")
+    await repo.update_user_context(first, {"a_loopCount": "1", "kept": "old"})
+
+    first.current_scenario_name = "test"
+    first.current_node_id = "id_2"
+    second.nickname = "second"
+
+    async def first_turn() -> None:
+        await repo.update_user(first)
+        await repo.update_user_context(first, {"kept": "new"})
+        await repo.clear_user_context(first)
+        await repo.add_to_user_history(first, {"id_2": "100"})
+
+    async def second_turn() -> None:
+        await repo.update_user(second)
+        await repo.update_user_context(second, {"key": "value"})
+        await repo.add_to_user_history(second, {"id_1": "200"})
+
+    await asyncio.gather(first_turn(), second_turn())
+    assert repo.pending == []
+
+    assert await repo.get_or_create_user(outer_id="1") == first
+    assert await repo.get_or_create_user(outer_id="2") == second
+    assert await repo.get_user_context(first) == {"kept": "new"}
+    assert await repo.get_user_context(second) == {"key": "value"}
+    assert await repo.get_user_history(first) == [{"id_2": "100"}]
+    assert await repo.get_user_history(second) == [{"id_1": "200"}]
+
+    with pytest.raises(Exception):
+        await repo.update_user_context(User(outer_id="absent"), {"key": "value"})
+
+
+@pytest.mark.asyncio
+async def test_batching_repo_flush_by_size() -> None:
+    repo = BatchingSQLAlchemyRepo(window_ms=60_000, batch_size=2)
+    await repo._recreate_db()  # noqa
+    user = await repo.get_or_create_user(outer_id="1")
+    await asyncio.wait_for(
+        asyncio.gather(
+            repo.add_to_user_history(user, {"id_1": "1"}),
+            repo.add_to_user_history(user, {"id_2": "2"}),
+        ),
+        timeout=5,
+    )
+    assert await repo.get_user_history(user) == [{"id_1": "1"}, {"id_2": "2"}]
+    assert repo.flush_task is None
+
+
+@pytest.mark.asyncio
+async def test_batching_repo_concurrent_flushes() -> None:
+    # пачка из одной записи: каждая запись - отдельный конкурентный flush
+    repo = BatchingSQLAlchemyRepo(window_ms=60_000, batch_size=1)
+    await repo._recreate_db()  # noqa
+    user = await repo.get_or_create_user(outer_id="1")
+    await asyncio.gather(
+        *[repo.update_user_context(user, {f"key_{i}": str(i)}) for i in range(10)]
+    )
+    assert await repo.get_user_context(user) == {f"key_{i}": str(i) for i in range(10)}
+    async_session = repo.session()
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count()).select_from(select(user_contexts).subquery())
+        )
+        assert result.scalar_one() == 1
+
+
+@pytest.mark.asyncio
+async def test_batching_repo_user_fields() -> None:
+    repo = BatchingSQLAlchemyRepo(window_ms=5)
+    await repo._recreate_db()  # noqa
+    await repo.get_or_create_user(outer_id="1", name="name")
+    first = User(outer_id="1", name="stale", current_node_id="id_1")
+    second = User(outer_id="1", name="stale", nickname="nick")
+    await asyncio.gather(
+        repo.update_user(first, fields=["current_node_id"]),
+        repo.update_user(second, fields=["nickname"]),
+        repo.update_user(second, fields=[]),
+    )
+    assert await repo.get_or_create_user(outer_id="1") == User(
+        outer_id="1", name="name", nickname="nick", current_node_id="id_1"
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batching", [False, True])
+async def test_commit_turn_matches_two_steps(batching: bool) -> None:
+    repo = BatchingSQLAlchemyRepo(window_ms=1) if batching else SQLAlchemyRepo()
+    await repo._recreate_db()  # noqa
+    cases = [
+        ({}, {"a": "1"}, False),
+        ({"a": "1"}, {}, True),
+        ({"a": "1", "__id_1_loopCount": "2"}, {"b": "2"}, False),
+        (
+            {"a": "1", "__id_1_loopCount": "2"},
+            {"a": "3", "__id_2_loopCount": "1"},
+            True,
+        ),
+    ]
+    for i, (exists_ctx, ctx_to_update, scenario_finished) in enumerate(cases):
+        two_steps_user = await repo.get_or_create_user(outer_id=f"two_steps_{i}")
+        user = await repo.get_or_create_user(outer_id=f"commit_{i}")
+        if exists_ctx:
+            await repo.update_user_context(two_steps_user, exists_ctx)
+            await repo.update_user_context(user, exists_ctx)
+
+        await repo.update_user_context(two_steps_user, ctx_to_update)
+        if scenario_finished:
+            await repo.clear_user_context(two_steps_user)
+        await repo.commit_turn(user, ctx_to_update, scenario_finished)
+
+        assert await repo.get_user_context(user) == await repo.get_user_context(
+            two_steps_user
+        )
@@ -1,10 +1,27 @@
+import json
+import typing as tp
+
 import pytest
 from fastapi.testclient import TestClient
 
+from src import settings
 from src.adapters.ep_wrapper import EPWrapper
+from src.adapters.repository import InMemoryContextRepo
 from src.adapters.repository import InMemoryRepo
+from src.adapters.snapshot import build_snapshot
+from src.adapters.web_adapter import WebAdapter
+from src.bootstrap import WEB_WORKER_COMPONENTS_ENV
+from src.bootstrap import _class_path
 from src.bootstrap import bootstrap
+from src.bootstrap import create_web_worker_app
+from src.bootstrap import scenario_hash
+from src.bootstrap import tg_user_prefix
+from src.bootstrap import upload_scenario
+from src.bootstrap import upload_scenarios_to_repo
+from src.bootstrap import wrap_user_cache
 from src.domain.events import EventProcessor
+from src.domain.model import Scenario
+from src.domain.scenario_loader import XMLParser
 from src.entrypoints.web import Web
 from src.service_layer.message_bus import ConcreteMessageBus
 
@@ -12,6 +29,32 @@ from src.service_layer.message_bus import ConcreteMessageBus
 # client = TestClient(web.app)
 
 
+class CountingRepo(InMemoryRepo):
+    def __init__(self) -> None:
+        super().__init__()
+        self.added_scenarios: tp.List[str] = []
+        self.added_texts: tp.List[str] = []
+        self.fail_texts = False
+
+    async def add_scenario(self, scenario: Scenario, project_name: str) -> None:
+        self.added_scenarios.append(scenario.name)
+        await super().add_scenario(scenario, project_name)
+
+    async def add_scenario_texts(
+        self,
+        scenario_name: str,
+        project_name: str,
+        texts: tp.Dict[str, str],
+        content_hash: str | None = None,
+    ) -> None:
+        if self.fail_texts:
+            raise Exception("texts write failed")
+        self.added_texts.append(scenario_name)
+        await super().add_scenario_texts(
+            scenario_name, project_name, texts, content_hash
+        )
+
+
 @pytest.mark.asyncio
 async def test_bootstrap() -> None:
     # init_app = await bootstrap(
@@ -28,3 +71,132 @@ async def test_bootstrap() -> None:
     # )
     # await init_app
     assert True
+
+
+def test_scenario_hash() -> None:
+    first_hash = scenario_hash("./src/scenarios/demo/hello")
+    assert first_hash == scenario_hash("./src/scenarios/demo/hello")
+    assert first_hash != scenario_hash("./src/scenarios/demo/quiz")
+
+
+def test_scenario_hash_skips_pycache(tmp_path: tp.Any) -> None:
+    (tmp_path / "scenario.py").write_text("scenario = None")
+    (tmp_path / "texts").mkdir()
+    (tmp_path / "texts" / "b.json").write_text("{}")
+    first_hash = scenario_hash(str(tmp_path))
+    (tmp_path / "__pycache__").mkdir()
+    (tmp_path / "__pycache__" / "scenario.cpython-311.pyc").write_bytes(b"\x00")
+    assert scenario_hash(str(tmp_path)) == first_hash
+    (tmp_path / "texts" / "a.json").write_text("{}")
+    assert scenario_hash(str(tmp_path)) != first_hash
+
+
+@pytest.mark.asyncio
+async def test_upload_unchanged_scenarios_skipped() -> None:
+    repo = CountingRepo()
+    parser = XMLParser()
+
+    await upload_scenarios_to_repo(repo=repo, parser=parser)
+    assert "hello" in repo.added_scenarios
+    assert len(repo.added_scenarios) == len(repo.added_texts)
+    metadata = await repo.get_all_scenarios_metadata()
+    assert ("demo", "hello") in metadata
+
+    repo.added_scenarios.clear()
+    repo.added_texts.clear()
+    await upload_scenarios_to_repo(repo=repo, parser=parser)
+    assert repo.added_scenarios == []
+    assert repo.added_texts == []
+    assert await repo.get_all_scenarios_metadata() == metadata
+
+
+@pytest.mark.asyncio
+async def test_upload_retried_after_texts_failure() -> None:
+    repo = CountingRepo()
+    parser = XMLParser()
+    await repo.create_project("demo")
+    repo.fail_texts = True
+    with pytest.raises(Exception, match="texts write failed"):
+        await upload_scenario(
+            repo=repo, parser=parser, project="demo", scenario="hello"
+        )
+    assert await repo.get_scenario_hash(name="hello", project_name="demo") is None
+
+    # тексты не записались, поэтому следующий запуск загружает сценарий заново
+    repo.fail_texts = False
+    assert await upload_scenario(
+        repo=repo, parser=parser, project="demo", scenario="hello"
+    )
+    assert repo.added_texts == ["hello"]
+    assert await repo.get_scenario_hash(name="hello", project_name="demo") is not None
+
+
+@pytest.mark.asyncio
+async def test_web_worker_app(tmp_path: tp.Any, monkeypatch: tp.Any) -> None:
+    repo = InMemoryRepo()
+    await upload_scenarios_to_repo(repo=repo, parser=XMLParser())
+    snapshot_path = str(tmp_path / "scenarios.snapshot")
+    await build_snapshot(repo=repo, path=snapshot_path)
+
+    monkeypatch.setattr(settings, "SCENARIO_SNAPSHOT_PATH", snapshot_path)
+    monkeypatch.setenv(
+        WEB_WORKER_COMPONENTS_ENV,
+        json.dumps(
+            dict(
+                repo=_class_path(InMemoryRepo),
+                ctx_repo=_class_path(InMemoryContextRepo),
+                ep=_class_path(EventProcessor),
+                ep_wrapper=_class_path(EPWrapper),
+                bus=_class_path(ConcreteMessageBus),
+                web=_class_path(Web),
+                web_adapter=_class_path(WebAdapter),
+            )
+        ),
+    )
+    app = create_web_worker_app()
+    with TestClient(app) as client:
+        response = client.post(
+            "/message_text",
+            json={
+                "user_id": "worker_user",
+                "text": "hi",
+                "project_name": "demo",
+                "security": {"headers": []},
+                "integration_url": "",
+            },
+        )
+    assert response.status_code == 200
+    assert response.json()["user_id"] == "worker_user"
+    assert response.json()["events"]
+
+
+@pytest.mark.asyncio
+async def test_web_workers_refuse_scenario_watch(monkeypatch: tp.Any) -> None:
+    monkeypatch.setattr(settings, "WEB_WORKERS", 2)
+    monkeypatch.setattr(settings, "SCENARIOS_WATCH", True)
+    with pytest.raises(Exception, match="SCENARIOS_WATCH"):
+        await bootstrap(
+            repo=InMemoryRepo,
+            ctx_repo=InMemoryContextRepo,
+            ep=EventProcessor,
+            ep_wrapper=EPWrapper,
+            bus=ConcreteMessageBus,
+            web=Web,
+            web_adapter=WebAdapter,
+        )
+
+
+def test_user_cache_refused_with_web_workers(monkeypatch: tp.Any) -> None:
+    monkeypatch.setattr(settings, "USER_CACHE_SIZE", 10)
+    monkeypatch.setattr(settings, "WEB_WORKERS", 2)
+    with pytest.raises(Exception, match="USER_CACHE_SIZE"):
+        wrap_user_cache(InMemoryRepo())
+
+
+def test_tg_user_prefix_stable(monkeypatch: tp.Any) -> None:
+    monkeypatch.setattr(settings, "TG_PLAIN_ID_PROJECT", "demo")
+    # id не зависят от числа ботов: у старого бота без префикса, у остальных - с ним
+    assert tg_user_prefix("demo") == ""
+    assert tg_user_prefix("shop") == "shop:"
+    monkeypatch.setattr(settings, "TG_PLAIN_ID_PROJECT", "")
+    assert tg_user_prefix("demo") == "demo:"
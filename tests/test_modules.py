@@ -1,14 +1,26 @@
+import asyncio
+import json
+import logging
 import typing as tp
 
 import pytest
 
 from src.adapters.ep_wrapper import EPWrapper
 from src.adapters.poller_adapter import PollerAdapter
+from src.adapters.redis_context import RedisContextRepo
+from src.adapters.renderer import Renderer
 from src.adapters.repository import InMemoryContextRepo
 from src.adapters.repository import InMemoryRepo
 from src.adapters.sender_wrapper import SenderWrapper
+from src.adapters.snapshot import ScenarioSnapshot
+from src.adapters.snapshot import SnapshotRepo
+from src.adapters.snapshot import build_snapshot
+from src.adapters.user_cache import CachedUserRepo
+from src.adapters.user_lock import InMemoryUserLock
 from src.domain.events import EventProcessor
+from src.domain.model import Button
 from src.domain.model import EditMessage
+from src.domain.model import Event
 from src.domain.model import InEvent
 from src.domain.model import InMessage
 from src.domain.model import MatchText
@@ -17,10 +29,16 @@ from src.domain.model import OutEvent
 from src.domain.model import OutMessage
 from src.domain.model import Scenario
 from src.domain.model import SetVariable
+from src.domain.model import TrackedContext
 from src.domain.model import User
 from src.entrypoints.poller import Poller
+from src.entrypoints.scenario_watcher import ScenarioWatcher
+from src.log import SAMPLED
+from src.log import JsonFormatter
+from src.log import SampleFilter
 from src.service_layer.message_bus import ConcreteMessageBus
 from src.service_layer.sender import Sender
+from src.service_layer.worker_pool import KeyedWorkerPool
 from tests.conftest import FakeListener
 
 
@@ -147,8 +165,6 @@ async def test_message_bus(mock_scenario: Scenario) -> None:
     assert user.current_node_id is None
     assert user.current_scenario_name is None
 
-    assert len(bus.queue) == 0
-
 
 @pytest.mark.asyncio
 async def test_context_saving(mock_scenario: Scenario) -> None:
@@ -675,7 +691,6 @@ async def test_different_projects(mock_scenario: Scenario) -> None:
     assert listener.events[1].project_name == "test_project"
     assert user.current_node_id is None
     assert user.current_scenario_name is None
-    assert len(bus.queue) == 0
 
     in_event = InEvent(user=user, text="Hi!", project_name="another_project")
 
@@ -687,4 +702,722 @@ async def test_different_projects(mock_scenario: Scenario) -> None:
     assert listener.events[3].project_name == "another_project"
     assert user.current_node_id is None
     assert user.current_scenario_name is None
-    assert len(bus.queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_scenario_swap(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    out_node = OutMessage(
+        element_id="id_2",
+        value="TEXT1",
+        next_ids=["id_3"],
+        node_type=NodeType.outMessage,
+    )
+    wait_node = InMessage(
+        element_id="id_3", value="", next_ids=["id_4"], node_type=NodeType.inMessage
+    )
+    last_node = OutMessage(
+        element_id="id_4", value="TEXT2", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario(
+        "test",
+        "id_1",
+        {"id_1": in_node, "id_2": out_node, "id_3": wait_node, "id_4": last_node},
+    )
+
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+
+    ctx_repo = InMemoryContextRepo()
+
+    ep = EventProcessor()
+    wrapped_ep = EPWrapper(event_processor=ep, repo=repo, ctx_repo=ctx_repo)
+    await wrapped_ep.add_scenario(
+        scenario_name=mock_scenario.name, project_name="test_project"
+    )
+    await wrapped_ep.add_scenario(
+        scenario_name=test_scenario.name, project_name="test_project"
+    )
+
+    kept_user = User(outer_id="1")
+    lost_user = User(outer_id="2")
+    for user in (kept_user, lost_user):
+        out_events = await wrapped_ep.process_event(
+            InEvent(user=user, text="Hi!", project_name="test_project")
+        )
+        assert out_events[0].text == "TEXT1"  # type: ignore
+        assert user.current_node_id == "id_3"
+    lost_user.current_node_id = "id_removed"
+    await repo.update_user(lost_user)
+
+    new_last_node = OutMessage(
+        element_id="id_4", value="NEW_TEXT2", next_ids=[], node_type=NodeType.outMessage
+    )
+    new_scenario = Scenario(
+        "test",
+        "id_1",
+        {"id_1": in_node, "id_2": out_node, "id_3": wait_node, "id_4": new_last_node},
+    )
+    wrapped_ep.register_scenario(scenario=new_scenario, project_name="test_project")
+    assert await wrapped_ep.find("test", "test_project") is new_scenario
+
+    out_events = await wrapped_ep.process_event(
+        InEvent(user=kept_user, text="any", project_name="test_project")
+    )
+    assert out_events[0].text == "NEW_TEXT2"  # type: ignore
+    assert kept_user.current_node_id is None
+
+    out_events = await wrapped_ep.process_event(
+        InEvent(user=lost_user, text="Hi!", project_name="test_project")
+    )
+    assert out_events[0].text == "TEXT1"  # type: ignore
+    assert lost_user.current_node_id == "id_3"
+
+
+@pytest.mark.asyncio
+async def test_scenario_watcher(tmp_path: tp.Any) -> None:
+    scenario_dir = tmp_path / "test_project" / "test"
+    scenario_dir.mkdir(parents=True)
+    (scenario_dir / "text_templates.json").write_text("{}")
+
+    changed: tp.List[tp.Tuple[str, str]] = []
+
+    async def on_change(project: str, scenario: str) -> None:
+        changed.append((project, scenario))
+
+    watcher = ScenarioWatcher(path=str(tmp_path), on_change=on_change, interval=0.01)
+    task = asyncio.create_task(watcher.watch())
+    await asyncio.sleep(0.05)
+    assert changed == []
+
+    (scenario_dir / "text_templates.json").write_text('{"TEXT1": "changed"}')
+    (tmp_path / "test_project" / "new").mkdir()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if len(changed) == 2:
+            break
+    task.cancel()
+    assert sorted(changed) == [("test_project", "new"), ("test_project", "test")]
+
+
+@pytest.mark.asyncio
+async def test_scenario_snapshot(
+    tmp_path: tp.Any, mock_scenario: Scenario, intent_scenario: Scenario
+) -> None:
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.create_project("another_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=intent_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="another_project")
+    await repo.add_scenario_texts(
+        scenario_name=intent_scenario.name,
+        project_name="test_project",
+        texts={"TEXT_intent_scenario": "Привет, {{ name }}"},
+    )
+
+    path = str(tmp_path / "scenarios.snapshot")
+    await build_snapshot(repo=repo, path=path)
+
+    snapshot = ScenarioSnapshot(path)
+    assert snapshot.metadata() == await repo.get_all_scenarios_metadata()
+    assert snapshot.get_scenario("intent_test", "test_project") == intent_scenario
+    assert snapshot.get_scenario_texts("intent_test", "test_project") == {
+        "TEXT_intent_scenario": "Привет, {{ name }}"
+    }
+    with pytest.raises(Exception):
+        snapshot.get_scenario("intent_test", "another_project")
+    snapshot.close()
+
+    snapshot_repo = SnapshotRepo(repo=repo, path=path)
+    assert (
+        await snapshot_repo.get_scenario_by_name("default", "another_project")
+        == mock_scenario
+    )
+    assert (
+        await snapshot_repo.get_scenario_text(
+            "intent_test", "test_project", "TEXT_intent_scenario"
+        )
+        == "Привет, {{ name }}"
+    )
+    assert (
+        await snapshot_repo.get_scenario_text("intent_test", "test_project", "absent")
+        == "absent"
+    )
+    user = await snapshot_repo.get_or_create_user(outer_id="1")
+    assert user is await repo.get_or_create_user(outer_id="1")
+
+    await repo.add_scenario_texts(
+        scenario_name=intent_scenario.name,
+        project_name="test_project",
+        texts={"TEXT_intent_scenario": "Пока"},
+    )
+    await build_snapshot(repo=repo, path=path)
+    snapshot_repo.reload()
+    assert (
+        await snapshot_repo.get_scenario_text(
+            "intent_test", "test_project", "TEXT_intent_scenario"
+        )
+        == "Пока"
+    )
+
+
+@pytest.mark.asyncio
+async def test_in_memory_user_lock() -> None:
+    user_lock = InMemoryUserLock()
+    order: tp.List[str] = []
+
+    async def turn(user: User, name: str) -> None:
+        async with user_lock.lock(user):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    await asyncio.gather(
+        turn(User(outer_id="1"), "first"),
+        turn(User(outer_id="1"), "second"),
+        turn(User(outer_id="2"), "other"),
+    )
+    assert order.index("first end") < order.index("second start")
+    # другой пользователь не ждет первого
+    assert order.index("other start") < order.index("first end")
+    assert user_lock.locks == {}
+
+
+class SlowContextRepo(InMemoryContextRepo):
+    async def get_user_context(self, user: User) -> tp.Dict[str, str]:
+        await asyncio.sleep(0.01)
+        return await super().get_user_context(user)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_events_of_one_user(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    wait_node = InMessage(
+        element_id="id_2", value="", next_ids=["id_3"], node_type=NodeType.inMessage
+    )
+    out_node = OutMessage(
+        element_id="id_3", value="answer", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario(
+        "test", "id_1", {"id_1": in_node, "id_2": wait_node, "id_3": out_node}
+    )
+
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=SlowContextRepo()
+    )
+    await wrapped_ep.add_scenario(scenario_name="default", project_name="test_project")
+    await wrapped_ep.add_scenario(scenario_name="test", project_name="test_project")
+
+    # пользователь прочитан из хранилища дважды, до обработки первого события
+    await repo.get_or_create_user(outer_id="1")
+    first = InEvent(user=User(outer_id="1"), text="Hi!", project_name="test_project")
+    second = InEvent(user=User(outer_id="1"), text="ok", project_name="test_project")
+    first_out, second_out = await asyncio.gather(
+        wrapped_ep.process_event(first), wrapped_ep.process_event(second)
+    )
+
+    assert first_out == []
+    assert [e.text for e in second_out] == ["answer"]  # type: ignore
+    user = await repo.get_or_create_user(outer_id="1")
+    assert user.current_scenario_name is None
+
+
+class UserCountingRepo(InMemoryRepo):
+    def __init__(self) -> None:
+        super().__init__()
+        self.user_reads = 0
+        self.updated_fields: tp.List[tp.Sequence[str] | None] = []
+
+    async def get_or_create_user(self, **kwargs: tp.Any) -> User:
+        self.user_reads += 1
+        return await super().get_or_create_user(**kwargs)
+
+    async def update_user(
+        self, user: User, fields: tp.Sequence[str] | None = None
+    ) -> User:
+        self.updated_fields.append(fields)
+        return await super().update_user(user, fields=fields)
+
+
+@pytest.mark.asyncio
+async def test_cached_user_repo() -> None:
+    repo = UserCountingRepo()
+    cached_repo = CachedUserRepo(repo=repo, max_size=2, ttl=60)
+
+    user = await cached_repo.get_or_create_user(outer_id="1")
+    assert await cached_repo.get_or_create_user(outer_id="1") == user
+    assert repo.user_reads == 1
+
+    # изменения пользователя не попадают в кэш без update_user
+    user.current_node_id = "id_2"
+    assert (await cached_repo.get_or_create_user(outer_id="1")).current_node_id is None
+
+    await cached_repo.update_user(user)
+    assert repo.updated_fields == [["current_node_id"]]
+    await cached_repo.update_user(user)
+    assert repo.updated_fields == [["current_node_id"]]
+    user.name = "not saved"
+    await cached_repo.update_user(user, fields=[])
+    assert repo.updated_fields == [["current_node_id"]]
+    user.name = None
+    assert (await cached_repo.get_or_create_user(outer_id="1")).current_node_id == (
+        "id_2"
+    )
+    assert (await repo.get_or_create_user(outer_id="1")).current_node_id == "id_2"
+
+    # незаписанные поля не попадают в кэш
+    user.name = "not saved"
+    user.current_node_id = "id_3"
+    await cached_repo.update_user(user, fields=["current_node_id"])
+    assert repo.updated_fields[-1] == ["current_node_id"]
+    cached_user = await cached_repo.get_or_create_user(outer_id="1")
+    assert cached_user.current_node_id == "id_3"
+    assert cached_user.name is None
+
+    # вытеснение самого старого пользователя
+    await cached_repo.get_or_create_user(outer_id="2")
+    await cached_repo.get_or_create_user(outer_id="3")
+    assert list(cached_repo.users) == ["2", "3"]
+
+    expired_repo = CachedUserRepo(repo=repo, max_size=2, ttl=0)
+    reads = repo.user_reads
+    await expired_repo.get_or_create_user(outer_id="1")
+    await asyncio.sleep(0.001)
+    await expired_repo.get_or_create_user(outer_id="1")
+    assert repo.user_reads == reads + 2
+
+
+class WritesCountingContextRepo(InMemoryContextRepo):
+    def __init__(self) -> None:
+        super().__init__()
+        self.writes: tp.List[tp.Any] = []
+
+    async def update_user_context(
+        self, user: User, ctx_to_update: tp.Dict[str, str]
+    ) -> None:
+        self.writes.append(dict(ctx_to_update))
+        await super().update_user_context(user, ctx_to_update)
+
+    async def clear_user_context(self, user: User) -> None:
+        self.writes.append("clear")
+        await super().clear_user_context(user)
+
+    async def commit_turn(
+        self, user: User, ctx_to_update: tp.Dict[str, str], scenario_finished: bool
+    ) -> None:
+        self.writes.append((dict(ctx_to_update), scenario_finished))
+        await super().commit_turn(user, ctx_to_update, scenario_finished)
+
+
+@pytest.mark.asyncio
+async def test_no_writes_for_unchanged_turn(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    set_variable = SetVariable(
+        element_id="id_2",
+        value="user(test_var1)",
+        next_ids=["id_3"],
+        node_type=NodeType.setVariable,
+    )
+    out_node = OutMessage(
+        element_id="id_3", value="TEXT1", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario(
+        "test", "id_1", {"id_1": in_node, "id_2": set_variable, "id_3": out_node}
+    )
+
+    repo = UserCountingRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+    ctx_repo = WritesCountingContextRepo()
+    await ctx_repo.update_user_context(User(outer_id="1"), {"other": "value"})
+    ctx_repo.writes.clear()
+
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    await wrapped_ep.add_scenario(scenario_name="default", project_name="test_project")
+    await wrapped_ep.add_scenario(scenario_name="test", project_name="test_project")
+
+    user = User(outer_id="1")
+    out_events = await wrapped_ep.process_event(
+        InEvent(user=user, text="something", project_name="test_project")
+    )
+    assert len(out_events) == 1
+    assert repo.updated_fields == []
+    assert ctx_repo.writes == []
+
+    await wrapped_ep.process_event(
+        InEvent(user=user, text="Hi!", project_name="test_project")
+    )
+    assert repo.updated_fields == []
+    assert ctx_repo.writes == [({"test_var1": "Hi!"}, False)]
+    assert await ctx_repo.get_user_context(user) == {
+        "other": "value",
+        "test_var1": "Hi!",
+    }
+
+    ctx_repo.writes.clear()
+    await wrapped_ep.process_event(
+        InEvent(user=user, text="Hi!", project_name="test_project")
+    )
+    assert ctx_repo.writes == []
+
+
+def test_tracked_context() -> None:
+    ctx = TrackedContext({"a": "1", "b": "2"})
+    ctx.update({"a": "1"})
+    ctx["b"] = "3"
+    ctx |= {"c": "4"}
+    ctx.setdefault("a", "5")
+    assert ctx.delta() == {"b": "3", "c": "4"}
+    ctx.attach({"__headers__": "{}", "c": "5"})
+    assert ctx["__headers__"] == "{}"
+    assert ctx.delta() == {"b": "3"}
+
+    user = User(outer_id="1", name="test")
+    assert user.changed_fields() == []
+    user.current_scenario_name = "test"
+    user.current_node_id = "id_1"
+    user.current_scenario_name = None
+    assert user.changed_fields() == ["current_node_id"]
+    user.mark_saved()
+    assert user.changed_fields() == []
+
+
+COMMIT_TURN_CASES = [
+    ({}, {"a": "1"}, False),
+    ({"a": "1"}, {}, True),
+    ({"a": "1", "__id_1_loopCount": "2"}, {"b": "2"}, False),
+    ({"a": "1", "__id_1_loopCount": "2"}, {"a": "3", "__id_2_loopCount": "1"}, True),
+    ({"__id_1_loopCount": "2"}, {}, True),
+]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "exists_ctx,ctx_to_update,scenario_finished", COMMIT_TURN_CASES
+)
+async def test_commit_turn_matches_two_steps(
+    exists_ctx: tp.Dict[str, str],
+    ctx_to_update: tp.Dict[str, str],
+    scenario_finished: bool,
+) -> None:
+    user = User(outer_id="1")
+    two_steps_repo = InMemoryContextRepo()
+    await two_steps_repo.update_user_context(user, exists_ctx)
+    await two_steps_repo.update_user_context(user, ctx_to_update)
+    if scenario_finished:
+        await two_steps_repo.clear_user_context(user)
+
+    ctx_repo = InMemoryContextRepo()
+    await ctx_repo.update_user_context(user, exists_ctx)
+    await ctx_repo.commit_turn(user, ctx_to_update, scenario_finished)
+
+    assert await ctx_repo.get_user_context(
+        user
+    ) == await two_steps_repo.get_user_context(user)
+
+
+def test_log_sampling_and_json() -> None:
+    def make_record(**extra: tp.Any) -> logging.LogRecord:
+        record = logging.LogRecord(
+            "test", logging.DEBUG, "test.py", 1, "user %s: %s", ("1", "hi"), None
+        )
+        record.__dict__.update(extra)
+        return record
+
+    assert SampleFilter(0.0).filter(make_record())
+    assert not SampleFilter(0.0).filter(make_record(**SAMPLED))
+    assert SampleFilter(1.0).filter(make_record(**SAMPLED))
+
+    res = json.loads(JsonFormatter().format(make_record(chat_id=42, **SAMPLED)))
+    assert res["message"] == "user 1: hi"
+    assert res["level"] == "DEBUG"
+    assert res["chat_id"] == 42
+    assert "sampled" not in res
+
+
+@pytest.mark.asyncio
+async def test_renderer() -> None:
+    class CountingTextsRepo(InMemoryRepo):
+        texts_calls = 0
+
+        async def get_scenario_texts(
+            self, scenario_name: str, project_name: str
+        ) -> tp.Dict[str, str]:
+            self.texts_calls += 1
+            return await super().get_scenario_texts(scenario_name, project_name)
+
+    repo = CountingTextsRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(
+        scenario=Scenario("test", "id_1", {}), project_name="test_project"
+    )
+    await repo.add_scenario_texts(
+        scenario_name="test",
+        project_name="test_project",
+        texts={"HELLO": "Привет, {{ name }}", "BTN": "Да, {{ name }}"},
+    )
+    ctx_repo = InMemoryContextRepo()
+    user = User(outer_id="1", name="test")
+    await ctx_repo.update_user_context(user, {"name": "Вася"})
+
+    def make_event(text: str, buttons: tp.List[Button] | None = None) -> OutEvent:
+        return OutEvent(
+            user=user,
+            text=text,
+            linked_node_id="id_1",
+            scenario_name="test",
+            project_name="test_project",
+            buttons=buttons,
+        )
+
+    events = [
+        make_event("HELLO"),
+        make_event("{{ name }}!", [Button("BTN", "чат", "BTN", None)]),
+    ]
+    renderer = Renderer(repo=repo, ctx_repo=ctx_repo)
+    await renderer.render(events)
+    assert [e.text for e in events] == ["Привет, Вася", "Вася!"]
+    assert events[1].buttons[0].text == "Да, Вася"  # type: ignore
+    assert events[1].buttons[0].text_to_bot == "Да, Вася"  # type: ignore
+    assert all(e.rendered for e in events)
+    assert repo.texts_calls == 1
+
+    # отрендеренные события дальше по шине не рендерятся повторно
+    sender_wrapper = SenderWrapper(sender=FakeSender(), repo=repo, ctx_repo=ctx_repo)
+    await sender_wrapper.handle_message(events[0])
+    assert sender_wrapper.sender.out_messages[0].text == "Привет, Вася"  # type: ignore
+    assert repo.texts_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_keyed_worker_pool() -> None:
+    pool = KeyedWorkerPool(workers=4, max_in_flight=4)
+    done: tp.List[tp.Tuple[int, int]] = []
+    release_slow = asyncio.Event()
+    fast_done = asyncio.Event()
+
+    def make_job(chat_id: int, i: int) -> tp.Callable[[], tp.Awaitable[None]]:
+        async def job() -> None:
+            if chat_id == 0:
+                await release_slow.wait()
+            else:
+                await asyncio.sleep(0.001 * (3 - i))
+            done.append((chat_id, i))
+            if len([x for x in done if x[0] == 1]) == 3:
+                fast_done.set()
+
+        return job
+
+    await pool.submit(0, make_job(0, 0))
+    for i in range(3):
+        await pool.submit(1, make_job(1, i))
+    # медленный чат не держит остальные, порядок внутри чата сохраняется
+    await asyncio.wait_for(fast_done.wait(), timeout=1)
+    assert done == [(1, 0), (1, 1), (1, 2)]
+
+    # в работе уже max_in_flight, прием ждет
+    await pool.submit(0, make_job(0, 1))
+    await pool.submit(0, make_job(0, 2))
+    await pool.submit(0, make_job(0, 3))
+    assert pool.in_flight == 4
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(pool.submit(0, make_job(0, 4)), timeout=0.05)
+    release_slow.set()
+    await asyncio.wait_for(pool.join(), timeout=1)
+    assert [x for x in done if x[0] == 0] == [(0, 0), (0, 1), (0, 2), (0, 3)]
+    assert pool.in_flight == 0
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_senders_by_project() -> None:
+    repo = InMemoryRepo()
+    ctx_repo = InMemoryContextRepo()
+    bus = ConcreteMessageBus()
+    senders = {}
+    for project in ("first", "second"):
+        senders[project] = FakeSender()
+        bus.register(
+            SenderWrapper(
+                sender=senders[project],
+                repo=repo,
+                ctx_repo=ctx_repo,
+                project_name=project,
+            )
+        )
+
+    user = User(outer_id="second:1", name="test")
+    event = OutEvent(
+        user=user,
+        text="TEXT1",
+        linked_node_id="id_1",
+        scenario_name="test",
+        project_name="second",
+        rendered=True,
+    )
+    await bus.public_message(event)
+    assert senders["first"].out_messages == []
+    assert [x.text for x in senders["second"].out_messages] == ["TEXT1"]
+    assert await repo.get_user_history(user) == [{"id_1": "outer_id_1"}]
+
+
+@pytest.mark.asyncio
+async def test_bus_routing() -> None:
+    bus = ConcreteMessageBus()
+    everything = FakeListener()
+    in_events = FakeListener()
+    first = FakeListener()
+    second = FakeListener()
+    bus.register(everything)
+    bus.register(in_events, event_type=InEvent)
+    bus.register(first, event_type=OutEvent, project_name="first")
+    bus.register(second, event_type=OutEvent, project_name="second")
+
+    user = User(outer_id="1", name="test")
+    in_event = InEvent(user=user, text="hi", project_name="first")
+    out_event = OutEvent(
+        user=user,
+        text="TEXT",
+        linked_node_id="id_1",
+        scenario_name="test",
+        project_name="second",
+    )
+    await bus.public_message([in_event, out_event])
+    assert everything.events == [in_event, out_event]
+    assert in_events.events == [in_event]
+    assert first.events == []
+    assert second.events == [out_event]
+    assert (OutEvent, "second") in bus.routes
+
+    # новая подписка сбрасывает таблицу маршрутов
+    late = FakeListener()
+    bus.register(late, event_type=OutEvent)
+    assert bus.routes == {}
+    bus.unregister(second)
+    await bus.public_message(out_event)
+    assert late.events == [out_event]
+    assert second.events == [out_event]
+    assert bus.services == [everything, in_events, first, late]
+
+    # проекты без подписок не добавляют маршрутов
+    for i in range(10):
+        await bus.public_message(
+            InEvent(user=user, text="hi", project_name=f"unknown_{i}")
+        )
+    assert set(bus.routes) == {(InEvent, None), (OutEvent, None)}
+    assert len(everything.events) == 13
+    assert len(in_events.events) == 11
+
+    # unregister снимает одну подписку, как раньше list.remove
+    bus.register(everything, event_type=OutEvent)
+    bus.unregister(everything)
+    assert bus.services == [in_events, first, late, everything]
+    bus.unregister(everything)
+    with pytest.raises(ValueError):
+        bus.unregister(everything)
+
+
+@pytest.mark.asyncio
+async def test_redis_commit_turn_matches_two_steps() -> None:
+    fakeredis = pytest.importorskip("fakeredis.aioredis")
+    client = fakeredis.FakeRedis(decode_responses=True)
+    redis_repo = RedisContextRepo(client)
+    memory_repo = InMemoryContextRepo()
+    user = User(outer_id="1")
+    # вложенные значения, числа и "/" не должны меняться при проходе через скрипт
+    exists_ctx: tp.Dict[str, tp.Any] = {
+        "nested": {"list": [1, 2.5, {"url": "http://a/b"}], "empty": {}},
+        "float": 0.1 + 0.2,
+        "big": 12345678901234567,
+        "empty_list": [],
+        "__id_1_loopCount": "2",
+    }
+    cases: tp.List[tp.Tuple[tp.Dict[str, tp.Any], bool]] = [
+        ({}, False),
+        ({"a": "1/2", "__id_2_loopCount": "1"}, False),
+        ({"nested": {"x": 1e-20}, "b": None}, True),
+        ({}, True),
+    ]
+    await redis_repo.update_user_context(user, exists_ctx)
+    await memory_repo.update_user_context(user, exists_ctx)
+    for ctx_to_update, scenario_finished in cases:
+        await redis_repo.commit_turn(user, ctx_to_update, scenario_finished)
+        await memory_repo.update_user_context(user, ctx_to_update)
+        if scenario_finished:
+            await memory_repo.clear_user_context(user)
+        assert await redis_repo.get_user_context(
+            user
+        ) == await memory_repo.get_user_context(user)
+    assert "__id_1_loopCount" not in await redis_repo.get_user_context(user)
+
+    # контекст старого формата переносится в хэш при первом чтении
+    legacy_user = User(outer_id="2")
+    await client.set("2", json.dumps({"a": "1", "f": 1.5}))
+    assert await redis_repo.get_user_context(legacy_user) == {"a": "1", "f": 1.5}
+    assert await client.get("2") is None
+    await redis_repo.commit_turn(legacy_user, {"b": "2"}, False)
+    # при существующем хэше ключ старого формата уже не читается
+    await client.set("2", json.dumps({"a": "stale"}))
+    assert await redis_repo.get_user_context(legacy_user) == {
+        "a": "1",
+        "f": 1.5,
+        "b": "2",
+    }
+
+
+@pytest.mark.asyncio
+async def test_bus_concurrent_chats_order() -> None:
+    bus = ConcreteMessageBus()
+    sent: tp.Dict[str, tp.List[str]] = {}
+
+    class Turn:
+        async def handle_message(self, message: Event) -> tp.List[Event]:
+            assert isinstance(message, InEvent)
+            await asyncio.sleep(0.001 * (int(message.user.outer_id) % 3))
+            return [
+                OutEvent(
+                    user=message.user,
+                    text=f"{message.user.outer_id}-{i}",
+                    linked_node_id=f"id_{i}",
+                    scenario_name="test",
+                )
+                for i in range(3)
+            ]
+
+    class Sender:
+        async def handle_message(self, message: Event) -> tp.List[Event]:
+            assert isinstance(message, OutEvent)
+            # отправка медленнее для первых сообщений, чтобы перемешать чаты
+            await asyncio.sleep(0.001 * (3 - int(message.text.split("-")[1])))
+            sent.setdefault(message.user.outer_id, []).append(message.text)
+            return []
+
+    bus.register(Turn(), event_type=InEvent)
+    bus.register(Sender(), event_type=OutEvent)
+
+    async def chat_turn(chat_id: str) -> None:
+        await bus.public_message(
+            InEvent(user=User(outer_id=chat_id), text="hi", project_name="test")
+        )
+        # вызов возвращается после отправки всех событий своего хода
+        assert sent[chat_id] == [f"{chat_id}-{i}" for i in range(3)]
+
+    await asyncio.gather(*[chat_turn(str(i)) for i in range(8)])
+    assert len(sent) == 8
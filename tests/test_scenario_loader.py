@@ -1,3 +1,5 @@
+import pytest
+
 from src.domain.model import DataExtract
 from src.domain.model import EditMessage
 from src.domain.model import GetVariable
@@ -12,6 +14,9 @@ from src.domain.model import RemoteRequest
 from src.domain.model import Scenario
 from src.domain.model import SetVariable
 from src.domain.scenario_loader import XMLParser
+from src.domain.scenario_serializer import dump_scenario
+from src.domain.scenario_serializer import load_scenario
+from src.domain.scenario_validator import ScenarioValidator
 
 
 def test_scenario_loader_hello() -> None:
@@ -372,3 +377,50 @@ def test_scenario_loader_loop_counter() -> None:
         buttons=None,
         procedural_source=False,
     ) == scenario.get_node_by_id("_ooN2HpQA74DP4gcZHRg-23")
+
+
+def test_scenario_validator() -> None:
+    parser = XMLParser()
+    root_id, nodes = parser.parse(input_stuff="./tests/resources/weather.xml")
+    scenario = Scenario(
+        name="weather", root_id=root_id, nodes={x.element_id: x for x in nodes}
+    )
+    ScenarioValidator().validate(scenario)
+
+    broken_node = OutMessage(
+        element_id="id_2",
+        value="TEXT1",
+        next_ids=["id_404"],
+        node_type=NodeType.outMessage,
+        buttons=[("button", "id_405", "", "")],
+    )
+    broken_scenario = Scenario(
+        name="broken", root_id="id_1", nodes={"id_2": broken_node}
+    )
+    with pytest.raises(ValueError) as e:
+        ScenarioValidator().validate(broken_scenario)
+    assert "id_1" in str(e.value)
+    assert "id_404" in str(e.value)
+    assert "id_405" in str(e.value)
+
+
+def test_scenario_binary_serialization() -> None:
+    parser = XMLParser()
+    for path in ("hello", "weather", "loop_counter"):
+        root_id, nodes = parser.parse(input_stuff=f"./tests/resources/{path}.xml")
+        scenario = Scenario(
+            name=path,
+            root_id=root_id,
+            nodes={x.element_id: x for x in nodes},
+            intent_names=["intent"],
+        )
+        nodes[-1].procedural_source = True
+        data = dump_scenario(scenario)
+        assert isinstance(data, bytes)
+        assert load_scenario(data) == scenario
+        assert load_scenario(memoryview(data)) == scenario
+
+    with pytest.raises(ValueError):
+        load_scenario(b"JSON" + data[4:])
+    with pytest.raises(ValueError):
+        load_scenario(data[:4] + b"\xff" + data[5:])
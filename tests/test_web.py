@@ -1,21 +1,35 @@
+import asyncio
+import json
 import typing as tp
 
+import aiogram
 import pytest
 from fastapi.testclient import TestClient
 
+from src import metrics
+from src import settings
+from src import tracing
 from src.adapters.ep_wrapper import EPWrapper
+from src.adapters.metrics_repo import MetricsContextRepo
+from src.adapters.metrics_repo import MetricsRepo
 from src.adapters.repository import InMemoryContextRepo
 from src.adapters.repository import InMemoryRepo
 from src.adapters.web_adapter import WebAdapter
+from src.bootstrap import poll_with_shared_pool
 from src.domain.events import EventProcessor
+from src.domain.model import EditMessage
 from src.domain.model import InEvent
 from src.domain.model import MatchText
 from src.domain.model import NodeType
 from src.domain.model import OutEvent
 from src.domain.model import OutMessage
 from src.domain.model import Scenario
+from src.domain.model import User
+from src.entrypoints.poller import TgPoller
+from src.entrypoints.poller import TgWebhook
 from src.entrypoints.web import Web
 from src.service_layer.message_bus import ConcreteMessageBus
+from src.service_layer.worker_pool import KeyedWorkerPool
 from tests.conftest import FakeListener
 
 
@@ -172,4 +186,594 @@ async def test_web_adapter_integration(mock_scenario: Scenario) -> None:
     assert user.current_node_id is None
     assert user.current_scenario_name is None
 
-    assert len(bus.queue) == 0
+
+@pytest.mark.asyncio
+async def test_metrics(mock_scenario: Scenario, monkeypatch: tp.Any) -> None:
+    for histogram in metrics.REGISTRY:
+        histogram.clear()
+    monkeypatch.setattr(settings, "METRICS_ENABLED", True)
+
+    repo = MetricsRepo(InMemoryRepo())
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario_texts(
+        scenario_name=mock_scenario.name,
+        project_name="test_project",
+        texts={"TEXT_mock_scenario": "Подключаем оператора"},
+    )
+    ctx_repo = MetricsContextRepo(InMemoryContextRepo())
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    await wrapped_ep.add_scenario(
+        scenario_name=mock_scenario.name, project_name="test_project"
+    )
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep)
+    web_adapter = WebAdapter(
+        repo=repo, bus=bus, ep_wrapped=wrapped_ep, ctx_repo=ctx_repo
+    )
+    _web = Web(host="localhost", port=8080, message_handler=web_adapter.message_handler)
+    web_client = TestClient(_web.app)
+
+    data_message = {
+        "user_id": "test1",
+        "text": "60",
+        "project_name": "test_project",
+        "security": {"headers": []},
+        "integration_url": "",
+    }
+    assert web_client.post("/message_text", json=data_message).status_code == 200
+    response = web_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert (
+        'dialog_node_execute_seconds_count{project="test_project",scenario="default",'
+        'node_type="outMessage",node_id="id_2"} 1'
+    ) in lines
+    assert any(
+        x.startswith(
+            'dialog_repo_call_seconds_count{repo="InMemoryRepo",method="get_or_create_user"}'
+        )
+        for x in lines
+    )
+    assert (
+        'dialog_bus_dispatch_seconds_count{subscriber="EPWrapper",event_type="InEvent"} 1'
+    ) in lines
+
+    # выключенные метрики ничего не пишут
+    monkeypatch.setattr(settings, "METRICS_ENABLED", False)
+    assert web_client.post("/message_text", json=data_message).status_code == 200
+    assert web_client.get("/metrics").text.splitlines() == lines
+
+
+@pytest.mark.asyncio
+async def test_debug_traces(mock_scenario: Scenario, monkeypatch: tp.Any) -> None:
+    monkeypatch.setattr(settings, "TRACING_ENABLED", True)
+    monkeypatch.setattr(settings, "TRACE_SLOW_MS", 0)
+    tracing.TRACES.clear()
+
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario_texts(
+        scenario_name=mock_scenario.name,
+        project_name="test_project",
+        texts={"TEXT_mock_scenario": "Подключаем оператора"},
+    )
+    ctx_repo = InMemoryContextRepo()
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    await wrapped_ep.add_scenario(
+        scenario_name=mock_scenario.name, project_name="test_project"
+    )
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep)
+    web_adapter = WebAdapter(
+        repo=repo, bus=bus, ep_wrapped=wrapped_ep, ctx_repo=ctx_repo
+    )
+    _web = Web(host="localhost", port=8080, message_handler=web_adapter.message_handler)
+    web_client = TestClient(_web.app)
+
+    data_message = {
+        "user_id": "test1",
+        "text": "60",
+        "project_name": "test_project",
+        "security": {"headers": []},
+        "integration_url": "",
+    }
+    assert web_client.post("/message_text", json=data_message).status_code == 200
+    traces = web_client.get("/debug/traces").json()
+    assert len(traces) == 1
+    root = traces[0]
+    assert root["name"] == "web_message"
+    assert root["attributes"] == {"project": "test_project", "user": "test1"}
+    assert [x["name"] for x in root["children"]] == [
+        "user_lookup",
+        "turn",
+        "templating",
+    ]
+    turn = root["children"][1]
+    assert [x["name"] for x in turn["children"]] == [
+        "user_lookup",
+        "context_load",
+        "scenario",
+        "persist",
+        "render",
+    ]
+    nodes = turn["children"][2]["children"]
+    assert [x["attributes"]["node_id"] for x in nodes] == ["id_2"]
+    assert nodes[0]["attributes"]["node_type"] == "outMessage"
+
+    # быстрые ходы в буфер не попадают
+    monkeypatch.setattr(settings, "TRACE_SLOW_MS", 10_000)
+    assert web_client.post("/message_text", json=data_message).status_code == 200
+    assert len(web_client.get("/debug/traces").json()) == 1
+
+
+@pytest.mark.asyncio
+async def test_message_batch(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    out_node = OutMessage(
+        element_id="id_2", value="TEXT1", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario("test", "id_1", {"id_1": in_node, "id_2": out_node})
+
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+    ctx_repo = InMemoryContextRepo()
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    for scenario in (test_scenario, mock_scenario):
+        await wrapped_ep.add_scenario(
+            scenario_name=scenario.name, project_name="test_project"
+        )
+    listener = FakeListener()
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep)
+    bus.register(listener)
+    web_adapter = WebAdapter(
+        repo=repo, bus=bus, ep_wrapped=wrapped_ep, ctx_repo=ctx_repo
+    )
+    _web = Web(
+        host="localhost",
+        port=8080,
+        message_handler=web_adapter.message_handler,
+        batch_handler=web_adapter.batch_handler,
+    )
+    web_client = TestClient(_web.app)
+
+    def message(user_id: str, text: str) -> tp.Dict[str, tp.Any]:
+        return {
+            "user_id": user_id,
+            "text": text,
+            "project_name": "test_project",
+            "security": {"headers": []},
+            "integration_url": "",
+        }
+
+    broken = message("user3", "Hi!")
+    del broken["text"]
+    batch = [
+        message("user1", "Hi!"),
+        message("user2", "60"),
+        broken,
+        message("user1", "60"),
+    ]
+    response = web_client.post("/message_batch", json=batch)
+    assert response.status_code == 200
+    results = response.json()
+    assert [x["user_id"] for x in results] == ["user1", "user2", "user3", "user1"]
+    assert [x["text"] for x in results[0]["events"]] == ["TEXT1"]
+    assert [x["intent_name"] for x in results[1]["events"]] == ["default"]
+    assert "error" in results[2]
+    assert [x["intent_name"] for x in results[3]["events"]] == ["default"]
+
+    # сообщения одного пользователя обработаны по порядку
+    user1_texts = [
+        x.text
+        for x in listener.events
+        if isinstance(x, InEvent) and x.user.outer_id == "user1"
+    ]
+    assert user1_texts == ["Hi!", "60"]
+
+    response = web_client.post(
+        "/message_batch",
+        json=[message("user1", "Hi!")] * (settings.WEB_BATCH_MAX_SIZE + 1),
+    )
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_message_text_stream(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    first_node = OutMessage(
+        element_id="id_2",
+        value="TEXT1",
+        next_ids=["id_3"],
+        node_type=NodeType.outMessage,
+    )
+    second_node = OutMessage(
+        element_id="id_3", value="TEXT2", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario(
+        "test", "id_1", {"id_1": in_node, "id_2": first_node, "id_3": second_node}
+    )
+
+    repo = InMemoryRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+    await repo.add_scenario_texts(
+        scenario_name="test",
+        project_name="test_project",
+        texts={"TEXT2": "url {{ __integration_url__ }}"},
+    )
+    ctx_repo = InMemoryContextRepo()
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    for scenario in (test_scenario, mock_scenario):
+        await wrapped_ep.add_scenario(
+            scenario_name=scenario.name, project_name="test_project"
+        )
+    listener = FakeListener()
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep)
+    bus.register(listener)
+    web_adapter = WebAdapter(
+        repo=repo, bus=bus, ep_wrapped=wrapped_ep, ctx_repo=ctx_repo
+    )
+    _web = Web(
+        host="localhost",
+        port=8080,
+        message_handler=web_adapter.message_handler,
+        stream_handler=web_adapter.stream_handler,
+    )
+    web_client = TestClient(_web.app)
+
+    data_message = {
+        "user_id": "test1",
+        "text": "Hi!",
+        "project_name": "test_project",
+        "security": {"headers": []},
+        "integration_url": "https://test-url.ru",
+    }
+    response = web_client.post("/message_text?stream=true", json=data_message)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(x) for x in response.text.splitlines()]
+    assert [[e["text"] for e in x["events"]] for x in lines[:-1]] == [
+        ["TEXT1"],
+        ["url https://test-url.ru"],
+    ]
+    assert lines[-1] == {"user_id": "test1", "done": True}
+    assert [type(x) for x in listener.events] == [InEvent, OutEvent, OutEvent]
+
+    # без stream ответ прежний
+    response = web_client.post("/message_text", json=data_message)
+    assert [x["text"] for x in response.json()["events"]] == [
+        "TEXT1",
+        "url https://test-url.ru",
+    ]
+
+    # ошибка хода приходит последней строкой
+    response = web_client.post(
+        "/message_text?stream=true", json={**data_message, "project_name": "unknown"}
+    )
+    lines = [json.loads(x) for x in response.text.splitlines()]
+    assert len(lines) == 1 and "error" in lines[0]
+
+
+@pytest.mark.asyncio
+async def test_websocket_session(mock_scenario: Scenario) -> None:
+    in_node = MatchText(
+        element_id="id_1", value="Hi!", next_ids=["id_2"], node_type=NodeType.matchText
+    )
+    out_node = OutMessage(
+        element_id="id_2",
+        value="TEXT1",
+        next_ids=["id_3"],
+        node_type=NodeType.outMessage,
+    )
+    edit_node = EditMessage(
+        element_id="id_3",
+        value="TEXT2",
+        next_ids=["id_2", "id_4"],
+        node_type=NodeType.editMessage,
+    )
+    out_node2 = OutMessage(
+        element_id="id_4", value="TEXT3", next_ids=[], node_type=NodeType.outMessage
+    )
+    test_scenario = Scenario(
+        "test",
+        "id_1",
+        {"id_1": in_node, "id_2": out_node, "id_3": edit_node, "id_4": out_node2},
+    )
+
+    class LookupCountingRepo(InMemoryRepo):
+        lookups = 0
+
+        async def get_or_create_user(self, **kwargs: tp.Any) -> User:
+            self.lookups += 1
+            return await super().get_or_create_user(**kwargs)
+
+    repo = LookupCountingRepo()
+    await repo.create_project("test_project")
+    await repo.add_scenario(scenario=mock_scenario, project_name="test_project")
+    await repo.add_scenario(scenario=test_scenario, project_name="test_project")
+    ctx_repo = InMemoryContextRepo()
+    wrapped_ep = EPWrapper(
+        event_processor=EventProcessor(), repo=repo, ctx_repo=ctx_repo
+    )
+    for scenario in (test_scenario, mock_scenario):
+        await wrapped_ep.add_scenario(
+            scenario_name=scenario.name, project_name="test_project"
+        )
+    bus = ConcreteMessageBus()
+    bus.register(wrapped_ep)
+    web_adapter = WebAdapter(
+        repo=repo, bus=bus, ep_wrapped=wrapped_ep, ctx_repo=ctx_repo
+    )
+    _web = Web(
+        host="localhost",
+        port=8080,
+        message_handler=web_adapter.message_handler,
+        session_opener=web_adapter.open_session,
+    )
+    web_client = TestClient(_web.app)
+
+    with web_client.websocket_connect("/ws") as websocket:
+        websocket.send_json(
+            {
+                "user_id": "test1",
+                "text": "Hi!",
+                "project_name": "test_project",
+                "security": {"headers": [["Cookie", "JSESSIONID=1"]]},
+                "integration_url": "https://test-url.ru",
+            }
+        )
+        frames = [websocket.receive_json() for _ in range(4)]
+        assert [(x["message_id"], x["edit"]) for x in frames[:3]] == [
+            ("id_2", None),
+            ("id_3", "id_2"),
+            ("id_4", None),
+        ]
+        assert [x["events"][0]["text"] for x in frames[:3]] == [
+            "TEXT1",
+            "TEXT2",
+            "TEXT3",
+        ]
+        assert frames[3] == {"user_id": "test1", "done": True}
+        lookups = repo.lookups
+
+        # дальше пользователь не ищется в адаптере, остается только обновление в ходе
+        websocket.send_json({"text": "60"})
+        frames = [websocket.receive_json() for _ in range(2)]
+        assert frames[0]["events"][0]["intent_name"] == "default"
+        assert frames[1]["done"]
+        assert repo.lookups == lookups + 1
+
+    # метаданные запроса в хранилище контекста не пишутся
+    user = await repo.get_or_create_user(outer_id="test1")
+    ctx = await ctx_repo.get_user_context(user)
+    assert "__integration_url__" not in ctx
+
+
+@pytest.mark.asyncio
+async def test_telegram_webhook() -> None:
+    repo = InMemoryRepo()
+    received: tp.List[InEvent] = []
+
+    async def message_handler(event: InEvent) -> None:
+        received.append(event)
+
+    async def user_finder(user_dict: tp.Dict[str, str]) -> User:
+        return await repo.get_or_create_user(**user_dict)
+
+    webhook = TgWebhook(
+        message_handler=message_handler,
+        user_finder=user_finder,
+        project_name="test_project",
+        bot=aiogram.Bot(token="123456:TEST"),
+        url="https://example.org/",
+        secret_token="s3cret",
+        queue_size=1,
+    )
+    assert webhook.url == "https://example.org/telegram/webhook"
+    _web = Web(host="localhost", port=8080, message_handler=fake_message_handler)
+    webhook.mount(_web)
+    web_client = TestClient(_web.app)
+
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+            "text": "Hi!",
+        },
+    }
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+    assert web_client.post("/telegram/webhook", json=update).status_code == 403
+    response = web_client.post("/telegram/webhook", json=update, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
+    # очередь заполнена, Telegram повторит доставку
+    response = web_client.post("/telegram/webhook", json=update, headers=headers)
+    assert response.status_code == 503
+
+    worker = asyncio.create_task(webhook.process_updates())
+    await asyncio.wait_for(webhook.queue.join(), timeout=5)
+    await asyncio.wait_for(webhook.pool.join(), timeout=5)
+    worker.cancel()
+    await webhook.pool.stop()
+    assert len(received) == 1
+    assert received[0].text == "Hi!"
+    assert received[0].user.outer_id == "42"
+    assert received[0].project_name == "test_project"
+
+
+@pytest.mark.asyncio
+async def test_web_workers_stopped_with_parent(monkeypatch: tp.Any) -> None:
+    processes: tp.List[asyncio.subprocess.Process] = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake_supervisor(*args: tp.Any) -> asyncio.subprocess.Process:
+        # супервизор, который не реагирует на SIGTERM и живет, пока его не убьют
+        process = await create_subprocess_exec(
+            args[0],
+            "-c",
+            "import signal, time\n"
+            "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+            "print('ready', flush=True)\n"
+            "time.sleep(60)",
+            stdout=asyncio.subprocess.PIPE,
+        )
+        processes.append(process)
+        return process
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", fake_supervisor)
+    _web = Web(host="localhost", port=8080, message_handler=fake_message_handler)
+    task = asyncio.create_task(
+        _web.start_workers(workers=2, app_factory="app:factory", stop_timeout=0.2)
+    )
+    while not processes:
+        await asyncio.sleep(0.01)
+    assert processes[0].stdout is not None
+    await processes[0].stdout.readline()
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert processes[0].returncode is not None
+
+
+class FakeUpdatesBot(aiogram.Bot):
+    """Бот с обновлениями из списка пачек вместо запросов к Telegram"""
+
+    def __init__(self, batches: tp.List[tp.List[tp.Dict[str, tp.Any]]]) -> None:
+        super().__init__(token="123456:TEST")
+        self.batches = batches
+        self.offsets: tp.List[int | None] = []
+
+    async def delete_webhook(self, *args: tp.Any, **kwargs: tp.Any) -> bool:
+        return True
+
+    async def get_updates(
+        self, offset: int | None = None, **kwargs: tp.Any
+    ) -> tp.List[aiogram.types.Update]:
+        self.offsets.append(offset)
+        if not self.batches:
+            await asyncio.sleep(3600)
+        return [aiogram.types.Update.to_object(x) for x in self.batches.pop(0)]
+
+
+def _tg_update(update_id: int, chat_id: int, text: str) -> tp.Dict[str, tp.Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_telegram_polling_backpressure() -> None:
+    repo = InMemoryRepo()
+    received: tp.List[str] = []
+    release = asyncio.Event()
+
+    async def message_handler(event: InEvent) -> None:
+        await release.wait()
+        received.append(str(event.text))
+
+    async def user_finder(user_dict: tp.Dict[str, str]) -> User:
+        return await repo.get_or_create_user(**user_dict)
+
+    bot = FakeUpdatesBot(
+        [[_tg_update(1, 1, "a"), _tg_update(2, 2, "b")], [_tg_update(3, 1, "c")]]
+    )
+    poller = TgPoller(
+        message_handler=message_handler,
+        user_finder=user_finder,
+        project_name="test_project",
+        bot=bot,
+        workers=2,
+        max_in_flight=1,
+    )
+    task = asyncio.create_task(poller.poll())
+    await asyncio.sleep(0.05)
+    # пул заполнен первым обновлением, второе ждет места, новые не запрашиваются
+    assert bot.offsets == [None]
+    assert poller.pool.in_flight == 1
+
+    release.set()
+    for _ in range(100):
+        if len(received) == 3:
+            break
+        await asyncio.sleep(0.01)
+    assert sorted(received) == ["a", "b", "c"]
+    assert bot.offsets == [None, 3, 4]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.asyncio
+async def test_telegram_pollers_share_pool() -> None:
+    repo = InMemoryRepo()
+    received: tp.List[str] = []
+
+    async def message_handler(event: InEvent) -> None:
+        received.append(f"{event.project_name}:{event.text}")
+
+    async def user_finder(user_dict: tp.Dict[str, str]) -> User:
+        return await repo.get_or_create_user(**user_dict)
+
+    pool = KeyedWorkerPool(workers=2, max_in_flight=10)
+    first, second = [
+        TgPoller(
+            message_handler=message_handler,
+            user_finder=user_finder,
+            project_name=project,
+            bot=FakeUpdatesBot([[_tg_update(1, 1, "a")]]),
+            pool=pool,
+        )
+        for project in ("first", "second")
+    ]
+    first_task = asyncio.create_task(first.poll())
+    for _ in range(100):
+        if received:
+            break
+        await asyncio.sleep(0.01)
+    first_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first_task
+    # остановка одного поллера не останавливает общий пул
+    assert pool.tasks and not any(t.done() for t in pool.tasks)
+
+    task = asyncio.create_task(poll_with_shared_pool([second], pool))
+    for _ in range(100):
+        if len(received) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert received == ["first:a", "second:a"]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert pool.tasks == []